@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# On-air check of the Improv advertisement from the controller's own HCI
+# traffic, for the advertising watchdog of the onboarding servers.
+#
+# BlueZ's LEAdvertisingManager1.ActiveInstances counts registrations, not what
+# the controller is doing, so it stays at 1 through the "ghost advertising"
+# state (an advertising set the controller stopped - typically ended by a
+# connection attempt that was then aborted - and BlueZ never re-enabled). The
+# kernel's HCI monitor channel (what btmon reads) carries every HCI command
+# and event of every controller. AdvertState replays the advertising-related
+# ones into the controller's view of its advertising sets:
+#
+#   LE Set [Extended] Advertising / Scan Response Data   what each set carries
+#   LE Set [Extended] Advertising Enable                 which sets are on
+#   LE Remove / Clear Advertising Sets, HCI Reset        sets going away
+#   LE Advertising Set Terminated, LE Connection         the controller
+#     Complete (peripheral role)                         stopping on its own
+#
+# Commands take effect when their Command Complete reports success. "Our"
+# advertisement is an enabled set whose advertising or scan-response data
+# contains one of the markers (the Improv service UUID, the device name).
+# The state is unknown until the first advertising command is seen after the
+# socket was opened: the monitor has no replay of the current state.
+#
+# Standard library only (ctypes for the bind: Python's socket module cannot
+# bind an HCI socket to a channel). The socket is injectable so the parsing
+# can be driven off-target from a synthetic stream (improv_fakes.FakeHciMonitor)
+# or a capture: read_btsnoop() loads `btmon -w` files (see
+# scripts/target/hci-replay.py).
+#
+
+import logging
+import os
+import socket
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# linux/socket.h, net/bluetooth/hci.h / hci_mon.h
+AF_BLUETOOTH = 31
+BTPROTO_HCI = 1
+HCI_DEV_NONE = 0xFFFF
+HCI_CHANNEL_MONITOR = 2
+SOCKADDR_HCI = struct.Struct("=HHH")  # family, dev, channel
+MON_HDR = struct.Struct("<HHH")  # opcode, index, len
+
+HCI_MON_NEW_INDEX = 0
+HCI_MON_DEL_INDEX = 1
+HCI_MON_COMMAND_PKT = 2
+HCI_MON_EVENT_PKT = 3
+
+# HCI commands (OGF 0x03 controller, 0x08 LE)
+HCI_RESET = 0x0C03
+LE_SET_ADV_DATA = 0x2008
+LE_SET_SCAN_RSP_DATA = 0x2009
+LE_SET_ADV_ENABLE = 0x200A
+LE_SET_EXT_ADV_DATA = 0x2037
+LE_SET_EXT_SCAN_RSP_DATA = 0x2038
+LE_SET_EXT_ADV_ENABLE = 0x2039
+LE_REMOVE_ADV_SET = 0x203C
+LE_CLEAR_ADV_SETS = 0x203D
+
+# HCI events
+EVT_CMD_COMPLETE = 0x0E
+EVT_LE_META = 0x3E
+LE_CONN_COMPLETE = 0x01
+LE_ENH_CONN_COMPLETE = 0x0A
+LE_ENH_CONN_COMPLETE_V2 = 0x29
+LE_ADV_SET_TERMINATED = 0x12
+ROLE_PERIPHERAL = 0x01
+
+# Extended data operations (fragments of one set's data).
+EXT_OP_INTERMEDIATE = 0x00
+EXT_OP_FIRST = 0x01
+EXT_OP_LAST = 0x02
+EXT_OP_COMPLETE = 0x03
+EXT_OP_UNCHANGED = 0x04
+
+# Set key of legacy advertising (extended handles are 0x00-0xEF).
+LEGACY = -1
+
+# btsnoop files (btmon -w): file header, record header, the monitor datalink,
+# and the record clock (microseconds since year 0) at the Unix epoch.
+BTSNOOP_HDR = struct.Struct(">8sII")
+BTSNOOP_REC = struct.Struct(">IIIIq")
+BTSNOOP_MAGIC = b"btsnoop\0"
+BTSNOOP_MONITOR = 2001
+BTSNOOP_EPOCH_US = 0x00E03AB44A676000
+
+_TRACKED = (HCI_RESET, LE_SET_ADV_DATA, LE_SET_SCAN_RSP_DATA, LE_SET_ADV_ENABLE,
+            LE_SET_EXT_ADV_DATA, LE_SET_EXT_SCAN_RSP_DATA,
+            LE_SET_EXT_ADV_ENABLE, LE_REMOVE_ADV_SET, LE_CLEAR_ADV_SETS)
+
+
+def uuid_marker(uuid_str):
+    """The bytes of a 128-bit UUID as it appears in advertising data."""
+    return bytes.fromhex(uuid_str.replace("-", ""))[::-1]
+
+
+class _Set:
+    __slots__ = ("data", "scan_rsp", "enabled")
+
+    def __init__(self):
+        self.data = b""
+        self.scan_rsp = b""
+        self.enabled = False
+
+
+class AdvertState:
+    """Advertising sets of controller `index`, rebuilt from monitor packets.
+
+    `feed()` takes one monitor packet (header included) and returns True when
+    `on_air()` changed. `off_since` is when our advertisement last went off
+    the air (monotonic, or the replay's clock), None while it is on.
+    """
+
+    def __init__(self, markers, index=0):
+        self.markers = [bytes(m) for m in markers if m]
+        self.index = index
+        self.sets = {}
+        self.known = False
+        self.off_since = None
+        self.packets = 0
+        self._pending = {}  # opcode -> parameters of the command in flight
+        self._on_air = None
+
+    def on_air(self):
+        """True/False if our advertisement is/is not enabled on the
+        controller; None if no advertising command has been seen yet."""
+        if not self.known:
+            return None
+        return any(s.enabled and self._ours(s) for s in self.sets.values())
+
+    def _ours(self, adv_set):
+        return any(m in adv_set.data or m in adv_set.scan_rsp
+                   for m in self.markers)
+
+    def _set(self, handle):
+        adv_set = self.sets.get(handle)
+        if adv_set is None:
+            adv_set = self.sets[handle] = _Set()
+        return adv_set
+
+    def feed(self, packet, now=None):
+        if len(packet) < MON_HDR.size:
+            return False
+        opcode, index, length = MON_HDR.unpack_from(packet)
+        if index != self.index:
+            return False
+        self.packets += 1
+        payload = packet[MON_HDR.size:MON_HDR.size + length]
+        try:
+            if opcode == HCI_MON_COMMAND_PKT:
+                self._command(payload)
+            elif opcode == HCI_MON_EVENT_PKT:
+                self._event(payload)
+            elif opcode == HCI_MON_DEL_INDEX:
+                self.sets.clear()
+                self._pending.clear()
+            else:
+                return False
+        except (struct.error, IndexError):
+            return False  # truncated packet: nothing to learn from it
+        on_air = self.on_air()
+        if on_air == self._on_air:
+            return False
+        self._on_air = on_air
+        if on_air is False:
+            self.off_since = time.monotonic() if now is None else now
+        elif on_air:
+            self.off_since = None
+        return True
+
+    def _command(self, payload):
+        cmd, plen = struct.unpack_from("<HB", payload)
+        if cmd in _TRACKED:
+            self._pending[cmd] = payload[3:3 + plen]
+
+    def _event(self, payload):
+        evt, plen = payload[0], payload[1]
+        params = payload[2:2 + plen]
+        if evt == EVT_CMD_COMPLETE:
+            _ncmd, cmd, status = struct.unpack_from("<BHB", params)
+            args = self._pending.pop(cmd, None)
+            if args is not None and status == 0:
+                self._apply(cmd, args)
+        elif evt == EVT_LE_META:
+            sub = params[0]
+            if sub == LE_ADV_SET_TERMINATED:
+                # status, handle, connection handle, completed events
+                status, handle = params[1], params[2]
+                if handle in self.sets:
+                    self.sets[handle].enabled = False
+                logger.debug("HCI: advertising set %d terminated (status %d)",
+                             handle, status)
+            elif sub in (LE_CONN_COMPLETE, LE_ENH_CONN_COMPLETE,
+                         LE_ENH_CONN_COMPLETE_V2):
+                # status, connection handle, role: a peripheral connection
+                # ends legacy advertising (extended sets report their own
+                # termination).
+                if params[1] == 0 and params[4] == ROLE_PERIPHERAL and \
+                        LEGACY in self.sets:
+                    self.sets[LEGACY].enabled = False
+
+    def _apply(self, cmd, args):
+        self.known = True
+        if cmd == HCI_RESET or cmd == LE_CLEAR_ADV_SETS:
+            self.sets.clear()
+        elif cmd == LE_SET_ADV_DATA:
+            self._set(LEGACY).data = args[1:1 + args[0]]
+        elif cmd == LE_SET_SCAN_RSP_DATA:
+            self._set(LEGACY).scan_rsp = args[1:1 + args[0]]
+        elif cmd == LE_SET_ADV_ENABLE:
+            self._set(LEGACY).enabled = bool(args[0])
+        elif cmd in (LE_SET_EXT_ADV_DATA, LE_SET_EXT_SCAN_RSP_DATA):
+            handle, op, n = args[0], args[1], args[3]
+            fragment = args[4:4 + n]
+            adv_set = self._set(handle)
+            attr = "data" if cmd == LE_SET_EXT_ADV_DATA else "scan_rsp"
+            if op in (EXT_OP_COMPLETE, EXT_OP_FIRST):
+                setattr(adv_set, attr, fragment)
+            elif op in (EXT_OP_INTERMEDIATE, EXT_OP_LAST):
+                setattr(adv_set, attr, getattr(adv_set, attr) + fragment)
+        elif cmd == LE_SET_EXT_ADV_ENABLE:
+            enable, count = args[0], args[1]
+            if count == 0:  # all sets
+                for adv_set in self.sets.values():
+                    adv_set.enabled = bool(enable)
+            for i in range(count):
+                self._set(args[2 + 4 * i]).enabled = bool(enable)
+        elif cmd == LE_REMOVE_ADV_SET:
+            self.sets.pop(args[0], None)
+
+
+def read_btsnoop(path):
+    """[(unix time, monitor packet)] of a btsnoop monitor capture."""
+    packets = []
+    with open(path, "rb") as f:
+        magic, _version, datalink = BTSNOOP_HDR.unpack(f.read(BTSNOOP_HDR.size))
+        if magic != BTSNOOP_MAGIC or datalink != BTSNOOP_MONITOR:
+            raise ValueError(f"{path}: not a btsnoop monitor capture")
+        while True:
+            head = f.read(BTSNOOP_REC.size)
+            if len(head) < BTSNOOP_REC.size:
+                break
+            _orig, incl, flags, _drops, ts = BTSNOOP_REC.unpack(head)
+            data = f.read(incl)
+            # The record flags carry the monitor header: index << 16 | opcode.
+            packets.append(((ts - BTSNOOP_EPOCH_US) / 1e6,
+                            MON_HDR.pack(flags & 0xFFFF, flags >> 16, len(data))
+                            + data))
+    return packets
+
+
+def write_btsnoop(path, packets):
+    """Write [(unix time, monitor packet)] as a btsnoop monitor capture."""
+    with open(path, "wb") as f:
+        f.write(BTSNOOP_HDR.pack(BTSNOOP_MAGIC, 1, BTSNOOP_MONITOR))
+        for t, packet in packets:
+            opcode, index, length = MON_HDR.unpack_from(packet)
+            data = packet[MON_HDR.size:MON_HDR.size + length]
+            f.write(BTSNOOP_REC.pack(len(data), len(data),
+                                     (index << 16) | opcode, 0,
+                                     int(t * 1e6) + BTSNOOP_EPOCH_US))
+            f.write(data)
+
+
+def open_monitor():
+    """A non-blocking socket on the kernel's HCI monitor channel (needs
+    CAP_NET_RAW)."""
+    import ctypes
+
+    sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW | socket.SOCK_NONBLOCK |
+                         socket.SOCK_CLOEXEC, BTPROTO_HCI)
+    addr = SOCKADDR_HCI.pack(AF_BLUETOOTH, HCI_DEV_NONE, HCI_CHANNEL_MONITOR)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.bind(sock.fileno(), ctypes.c_char_p(addr), len(addr)) != 0:
+        err = ctypes.get_errno()
+        sock.close()
+        raise OSError(err, f"HCI monitor bind: {os.strerror(err)}")
+    return sock
+
+
+def open_replay(path):
+    """A non-blocking client of a monitor stream served on a Unix
+    SOCK_SEQPACKET socket (one monitor packet per message)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+class AdvertMonitor:
+    """Feeds an AdvertState from a monitor socket on the event loop.
+
+    `on_change()` is called (on the loop) whenever `on_air()` changes. A
+    socket error stops the monitor: `live` goes False and `on_air()` None, so
+    the caller falls back to what it did without it.
+    """
+
+    RECV_SIZE = MON_HDR.size + 0xFFFF
+
+    def __init__(self, state, sock_factory=open_monitor):
+        self.state = state
+        self._sock_factory = sock_factory
+        self._sock = None
+        self._loop = None
+        self._on_change = None
+        self.live = False
+
+    def start(self, loop, on_change=None):
+        self._sock = self._sock_factory()
+        self._loop = loop
+        self._on_change = on_change
+        loop.add_reader(self._sock.fileno(), self._readable)
+        self.live = True
+
+    def on_air(self):
+        return self.state.on_air() if self.live else None
+
+    def close(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+        self.live = False
+
+    def _readable(self):
+        changed = False
+        while True:
+            try:
+                packet = self._sock.recv(self.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.warning(f"HCI monitor failed ({e!r}); on-air check off")
+                self.close()
+                changed = True
+                break
+            if not packet:
+                logger.warning("HCI monitor stream ended; on-air check off")
+                self.close()
+                changed = True
+                break
+            changed |= self.state.feed(packet)
+        if changed and self._on_change is not None:
+            self._on_change()
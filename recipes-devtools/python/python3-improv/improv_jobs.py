@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Bounded, prioritised worker pool for the blocking work of the Improv
+# onboarding servers (nmcli, file reads, D-Bus round trips made synchronously).
+#
+# asyncio's default executor is a ThreadPoolExecutor with an unbounded FIFO:
+# if nmcli wedges, status refreshes queue up behind each other, a Wi-Fi
+# provisioning request waits behind all of them, and nothing ever gives up on
+# a stuck job. JobQueue instead runs a fixed number of worker threads off a
+# priority queue - PROVISION before STATUS before DIAGNOSTICS, FIFO within a
+# class - and:
+#
+#   * coalesces: a job submitted with a `key` that is already pending (queued,
+#     not yet running) shares the pending job's future instead of queueing a
+#     second copy, so at most one status refresh ever waits;
+#   * times out: a job still running `timeout` seconds after it started fails
+#     its future with TimeoutError (the caller is released at once) and the
+#     child processes the worker thread spawned are sent SIGTERM, then SIGKILL
+#     after KILL_GRACE_SECS, which unblocks the subprocess call the thread is
+#     stuck in. Children are found per thread via
+#     /proc/self/task/<tid>/children (CONFIG_PROC_CHILDREN); without it they
+#     are only killed when no other job is running (and not at all by a queue
+#     created with kill_unattributed=False);
+#   * counts: queue depth per class, queue wait and run time are reported to
+#     the `on_start` / `on_done` hooks and in `stats`.
+#
+# Environment:
+#   IMPROV_WORKERS  worker threads (default 2)
+#
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Job classes, highest priority first.
+PROVISION = 0
+STATUS = 1
+DIAGNOSTICS = 2
+CLASS_NAMES = ("provision", "status", "diagnostics")
+
+WORKERS = int(os.getenv("IMPROV_WORKERS", "2"))
+# Between SIGTERM and SIGKILL for the children of a timed-out job.
+KILL_GRACE_SECS = 1.0
+
+
+def _thread_children(tid):
+    """PIDs of the processes forked by thread `tid` of this process, or None
+    if the kernel does not expose per-thread children."""
+    try:
+        with open(f"/proc/self/task/{tid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return None
+
+
+def _process_children(pid):
+    """Direct children of `pid`, from every thread's children file."""
+    out = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return out
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                out.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return out
+
+
+def _own_children():
+    """Direct children of this process, by scanning /proc (fallback)."""
+    me = os.getpid()
+    out = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+            # comm may contain spaces/parens; ppid is the 2nd field after it.
+            if int(stat.rsplit(")", 1)[1].split()[1]) == me:
+                out.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            pass
+    return out
+
+
+def _descendants(pids):
+    """`pids` and everything below them (e.g. sudo -> nmcli), leaves first."""
+    out, todo = [], list(pids)
+    while todo:
+        pid = todo.pop()
+        out.append(pid)
+        todo.extend(_process_children(pid))
+    return out[::-1]
+
+
+def _signal_all(pids, sig):
+    sent = 0
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+            sent += 1
+        except OSError:  # already gone, or not ours to kill (EPERM)
+            pass
+    return sent
+
+
+class _Job:
+    __slots__ = ("fn", "args", "name", "priority", "key", "timeout", "future",
+                 "submitted", "started", "tid")
+
+    def __init__(self, fn, args, priority, key, timeout, name=None):
+        self.fn = fn
+        self.args = args
+        self.name = name or getattr(fn, "__name__", "job")
+        self.priority = priority
+        self.key = key
+        self.timeout = timeout
+        self.future = concurrent.futures.Future()
+        self.submitted = time.monotonic()
+        self.started = None
+        self.tid = None
+
+
+class JobQueue:
+    """Fixed pool of worker threads fed from a priority queue.
+
+    `on_start(cls_name, wait_secs)` and `on_done(cls_name, job_name, secs, ok)`
+    are called on the worker thread around every job (metrics hooks).
+    `kill_unattributed=False` stops a timed-out job from killing the whole
+    process's children when they cannot be attributed per thread; set it on
+    every queue but one when a process has several.
+    """
+
+    def __init__(self, workers=WORKERS, name="improv", on_start=None,
+                 on_done=None, kill_unattributed=True):
+        self.workers = max(1, workers)
+        self.name = name
+        self.on_start = on_start
+        self.on_done = on_done
+        self.kill_unattributed = kill_unattributed
+        self._cv = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending = {}  # coalescing key -> queued _Job
+        self._running = set()
+        self._threads = []
+        self._closed = False
+        self.stats = {"submitted": 0, "coalesced": 0, "timeouts": 0,
+                      "killed": 0}
+
+    # --- submission ----------------------------------------------------------
+
+    def submit(self, fn, *args, priority=STATUS, key=None, timeout=None,
+               name=None):
+        """Queue `fn(*args)`; returns a concurrent.futures.Future. `name`
+        labels the job in logs and hooks (default: fn.__name__)."""
+        with self._cv:
+            if self._closed:
+                raise RuntimeError("job queue is shut down")
+            if key is not None:
+                job = self._pending.get(key)
+                if job is not None:
+                    self.stats["coalesced"] += 1
+                    return job.future
+            job = _Job(fn, args, priority, key, timeout, name)
+            if key is not None:
+                self._pending[key] = job
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self.stats["submitted"] += 1
+            if len(self._threads) < self.workers and \
+                    len(self._heap) > self._idle():
+                self._spawn()
+            # Workers and the timeout watchdog share the condition: wake all.
+            self._cv.notify_all()
+        return job.future
+
+    async def run(self, fn, *args, priority=STATUS, key=None, timeout=None):
+        """Await `fn(*args)` on the pool. Cancelling the caller does not stop a
+        job that already started; its timeout does."""
+        return await asyncio.wrap_future(
+            self.submit(fn, *args, priority=priority, key=key, timeout=timeout))
+
+    def depth(self):
+        """Queued (not yet running) jobs per class name."""
+        with self._cv:
+            out = dict.fromkeys(CLASS_NAMES, 0)
+            for priority, _seq, _job in self._heap:
+                out[CLASS_NAMES[priority]] += 1
+            return out
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def shutdown(self):
+        """Stop the workers once the queue is drained (not waited for)."""
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+
+    # --- workers -------------------------------------------------------------
+
+    def _idle(self):
+        return len(self._threads) - len(self._running)
+
+    def _spawn(self):
+        t = threading.Thread(target=self._worker, daemon=True,
+                             name=f"{self.name}-{len(self._threads)}")
+        self._threads.append(t)
+        if len(self._threads) == 1:
+            threading.Thread(target=self._watchdog, daemon=True,
+                             name=f"{self.name}-timeouts").start()
+        t.start()
+
+    def _worker(self):
+        tid = threading.get_native_id()
+        while True:
+            with self._cv:
+                while not self._heap and not self._closed:
+                    self._cv.wait()
+                if not self._heap:
+                    return
+                _prio, _seq, job = heapq.heappop(self._heap)
+                if job.key is not None and self._pending.get(job.key) is job:
+                    del self._pending[job.key]
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                job.started = time.monotonic()
+                job.tid = tid
+                self._running.add(job)
+                self._cv.notify_all()  # re-arm the watchdog
+            cls = CLASS_NAMES[job.priority]
+            if self.on_start is not None:
+                self.on_start(cls, job.started - job.submitted)
+            ok = False
+            try:
+                result = job.fn(*job.args)
+                ok = True
+            except BaseException as e:
+                result = e
+            finally:
+                with self._cv:
+                    self._running.discard(job)
+                if self.on_done is not None:
+                    self.on_done(cls, job.name,
+                                 time.monotonic() - job.started, ok)
+            # The watchdog may already have failed the future with a timeout;
+            # the late result is dropped.
+            try:
+                if ok:
+                    job.future.set_result(result)
+                else:
+                    job.future.set_exception(result)
+            except concurrent.futures.InvalidStateError:
+                pass
+
+    def _watchdog(self):
+        """Fail and kill running jobs that overran their timeout."""
+        while True:
+            with self._cv:
+                if self._closed and not self._running:
+                    return
+                now = time.monotonic()
+                expired, wake = [], None
+                for job in self._running:
+                    if job.timeout is None or job.future.done():
+                        continue
+                    due = job.started + job.timeout
+                    if due <= now:
+                        expired.append(job)
+                    elif wake is None or due < wake:
+                        wake = due
+                if not expired:
+                    self._cv.wait(None if wake is None else wake - now)
+                    continue
+                others = len(self._running) - len(expired)
+            for job in expired:
+                self._expire(job, others)
+
+    def _expire(self, job, others):
+        self.stats["timeouts"] += 1
+        try:
+            job.future.set_exception(TimeoutError(
+                f"{job.name} still running after {job.timeout:g}s"))
+        except concurrent.futures.InvalidStateError:
+            return
+        children = _thread_children(job.tid)
+        if children is None:
+            # No per-thread attribution: only safe if nothing else is running.
+            children = (_own_children()
+                        if others == 0 and self.kill_unattributed else [])
+        pids = _descendants(children)
+        logger.warning("job %s (%s) timed out after %gs; killing %d child "
+                       "process(es)", job.name, CLASS_NAMES[job.priority],
+                       job.timeout, len(pids))
+        if not pids:
+            return
+        self.stats["killed"] += _signal_all(pids, signal.SIGTERM)
+        threading.Timer(KILL_GRACE_SECS, self._kill_leftovers,
+                        (job, pids)).start()
+
+    def _kill_leftovers(self, job, pids):
+        # Once the job has returned its children are reaped and their PIDs may
+        # already belong to someone else.
+        with self._cv:
+            if job not in self._running:
+                return
+        _signal_all(pids, signal.SIGKILL)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Logging backend for the Improv onboarding servers. Under systemd every record
+# is a write to the journald stream socket; done inline that write (and the
+# message formatting) runs on the BLE event loop thread. Here the loop thread
+# only enqueues the LogRecord: a QueueListener thread formats it and does the
+# I/O. Records are not pre-formatted on enqueue (unlike the stdlib
+# QueueHandler), so `logger.debug("x %s", obj)` costs a level check when DEBUG
+# is off and a queue put when it is on.
+#
+# Per-call-site rate limiting keeps a hot path (a central polling a
+# characteristic, a flapping link) from flooding the journal: each site may
+# emit IMPROV_LOG_RATE records per IMPROV_LOG_RATE_WINDOW seconds, the next
+# record after a quiet window reports how many were dropped. ERROR and above
+# are never dropped.
+#
+# Environment:
+#   IMPROV_LOG_LEVEL        DEBUG/INFO/WARNING/... (default INFO)
+#   IMPROV_LOG_RATE         records per site per window (default 20, 0 = off)
+#   IMPROV_LOG_RATE_WINDOW  window in seconds (default 60)
+#
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+FORMAT = "%(levelname)s:%(name)s:%(message)s"  # journald adds the timestamp
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop records beyond `rate` per `window` seconds per call site.
+
+    The first record let through after a drop carries the count in
+    `record.suppressed`; the record's message is left alone (see
+    SuppressedFormatter).
+    """
+
+    def __init__(self, rate, window):
+        super().__init__()
+        self.rate = rate
+        self.window = window
+        self._sites = {}  # (pathname, lineno) -> [window start, emitted, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                dropped = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+                if dropped:
+                    record.suppressed = dropped
+                return True
+            if site[1] < self.rate:
+                site[1] += 1
+                return True
+            site[2] += 1
+            return False
+
+
+class SuppressedFormatter(logging.Formatter):
+    """Formatter that appends RateLimitFilter's drop count to the message."""
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        dropped = getattr(record, "suppressed", 0)
+        return f"{text} [{dropped} similar suppressed]" if dropped else text
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stdlib prepare() merges msg/args and formats exc_info on the calling
+    thread so records can be pickled; records stay in-process here, so they are
+    passed through as-is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def setup(default_level="INFO"):
+    """Install the queue handler on the root logger (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return _listener
+    level = os.getenv("IMPROV_LOG_LEVEL", default_level).upper()
+    root = logging.getLogger()
+    try:
+        root.setLevel(int(level) if level.isdigit() else level)
+    except (TypeError, ValueError):
+        root.setLevel(default_level)
+
+    out = logging.StreamHandler(sys.stderr)
+    out.setFormatter(SuppressedFormatter(FORMAT))
+    q = queue.SimpleQueue()
+    handler = DeferredQueueHandler(q)
+    handler.addFilter(RateLimitFilter(
+        int(os.getenv("IMPROV_LOG_RATE", "20")),
+        float(os.getenv("IMPROV_LOG_RATE_WINDOW", "60"))))
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(q, out)
+    _listener.start()
+    # Flush what is queued on a normal exit (os._exit skips this, as it skips
+    # every other handler).
+    atexit.register(stop)
+    return _listener
+
+
+def stop():
+    """Drain the queue and stop the listener; call before os._exit()."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
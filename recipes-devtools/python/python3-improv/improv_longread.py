@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Offset-aware long reads (ATT Read / Read Blob) for the Improv onboarding
+# servers.
+#
+# A value longer than one ATT response (MTU - 1 bytes) is read in pieces: the
+# central sends a Read, then Read Blob requests at increasing offsets until a
+# response comes back short. BlueZ forwards each of them to the application
+# as GattCharacteristic1.ReadValue with an "offset" option and returns what
+# the application answers, cut to MTU - 1; it does not slice the value itself.
+# bless drops the options and answers every request with the whole value, so
+# a long read of a value longer than MTU - 1 repeats its first bytes. Even
+# with offsets honoured, a value that changes between two requests would be
+# stitched together from two versions.
+#
+# SnapshotStore keeps each long value with a generation number, bumped when
+# its bytes change. A read at offset 0 pins the current generation for that
+# central, and the Read Blob requests that follow are served from the pinned
+# snapshot, so a long read always returns one version whole. A pin lasts until
+# the same central reads the value from offset 0 again, or for PIN_SECS.
+#
+# ReadValueHook answers ReadValue on bless's own D-Bus connection, with the
+# options, before bless dispatches the call.
+#
+# Environment:
+#   IMPROV_LONG_READ_PIN_SECS   how long a pinned snapshot is kept (default 10)
+#
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PIN_SECS = float(os.getenv("IMPROV_LONG_READ_PIN_SECS", "10"))
+
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+# BlueZ turns these D-Bus errors into the matching ATT error codes.
+ERROR_INVALID_OFFSET = "org.bluez.Error.InvalidOffset"
+ERROR_FAILED = "org.bluez.Error.Failed"
+
+
+class InvalidOffset(ValueError):
+    pass
+
+
+class SnapshotStore:
+    """Generation-versioned values, read whole or from an offset.
+
+    `set()` is called wherever a value is published; `read()` from the D-Bus
+    read path. Both may run on different threads.
+    """
+
+    def __init__(self, pin_secs=PIN_SECS):
+        self.pin_secs = pin_secs
+        self._lock = threading.Lock()
+        self._values = {}  # key -> (generation, bytes)
+        self._pins = {}  # (key, client) -> (generation, bytes, monotonic)
+        # Reads from offset 0, Read Blob requests, Read Blob requests served
+        # from a snapshot the value had already moved on from, and ones that
+        # found no pin (expired, or no read from offset 0 first).
+        self.stats = {"reads": 0, "blobs": 0, "pinned_stale": 0, "unpinned": 0}
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def set(self, key, data):
+        """Publish a new value; returns True if its bytes changed."""
+        data = bytes(data)
+        with self._lock:
+            generation, current = self._values.get(key, (0, None))
+            if data == current:
+                return False
+            self._values[key] = (generation + 1, data)
+            return True
+
+    def get(self, key):
+        """(generation, bytes) of the current value, or (0, b"")."""
+        return self._values.get(key, (0, b""))
+
+    def read(self, key, offset=0, client=None):
+        """The value from `offset`: the current one for a read from 0 (pinned
+        for `client`), the pinned one for a Read Blob."""
+        now = time.monotonic()
+        with self._lock:
+            generation, data = self._values.get(key, (0, b""))
+            if offset == 0:
+                self.stats["reads"] += 1
+                self._pins[(key, client)] = (generation, data, now)
+                self._expire(now)
+            else:
+                self.stats["blobs"] += 1
+                pin = self._pins.get((key, client))
+                if pin is not None and now - pin[2] < self.pin_secs:
+                    if pin[0] != generation:
+                        self.stats["pinned_stale"] += 1
+                    data = pin[1]
+                else:
+                    self.stats["unpinned"] += 1
+            if offset > len(data):
+                raise InvalidOffset(f"offset {offset} past the end of a "
+                                    f"{len(data)}-byte value")
+            return data[offset:]
+
+    def _expire(self, now):
+        for pin_key, pin in list(self._pins.items()):
+            if now - pin[2] >= self.pin_secs:
+                del self._pins[pin_key]
+
+
+def read_options(options):
+    """(offset, device path or None) from ReadValue's a{sv} options."""
+    def value(name, default):
+        v = options.get(name)
+        return default if v is None else getattr(v, "value", v)
+    return int(value("offset", 0)), value("device", None)
+
+
+class ReadValueHook:
+    """Answers ReadValue for selected characteristic object paths on a
+    dbus-next or dbus-fast connection (bless's), before the library dispatches
+    it.
+
+    `read(key, offset, device)` returns the bytes from `offset` and raises
+    InvalidOffset past the end; it runs on the connection's event loop.
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.paths = {}  # characteristic object path -> key
+        self.failures = 0
+
+    def add(self, path, key):
+        self.paths[path] = key
+
+    def install(self, bus):
+        bus.add_message_handler(self._on_message)
+
+    def _on_message(self, msg):
+        if (msg.message_type.name != "METHOD_CALL"
+                or msg.member != "ReadValue"
+                or msg.interface != GATT_CHRC_IFACE
+                or msg.path not in self.paths):
+            return None
+        message = type(msg)
+        try:
+            offset, device = read_options(msg.body[0] if msg.body else {})
+            value = self.read(self.paths[msg.path], offset, device)
+        except InvalidOffset as e:
+            return message.new_error(msg, ERROR_INVALID_OFFSET, str(e))
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"read of {msg.path} failed: {e!r}")
+            return message.new_error(msg, ERROR_FAILED, str(e))
+        return message.new_method_return(msg, "ay", [bytes(value)])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Wi-Fi scan cache for the Improv onboarding servers.
+#
+# The Improv "request scanned Wi-Fi networks" RPC (GET_WIFI_NETWORKS) is
+# answered while the phone waits, and a scan takes seconds (an active scan of
+# every 2.4 and 5 GHz channel). So the servers keep the latest scan results
+# here - fed from NetworkManager's access-point list, re-read when NM reports
+# a finished scan or an AP appearing or disappearing - and answer from memory.
+# Entries are one per SSID (the strongest BSS; hidden SSIDs are dropped),
+# ranked by signal.
+#
+# A scan older than IMPROV_SCAN_TTL_SECS is still served but is stale: the
+# servers ask NM for a new one, and only a fresh scan is trusted to say that
+# an SSID is out of range.
+#
+# Environment:
+#   IMPROV_SCAN_TTL_SECS       age at which a scan goes stale (default 30)
+#   IMPROV_SCAN_MAX_NETWORKS   networks reported over Improv (default 20)
+#
+
+import collections
+import os
+import threading
+import time
+
+SCAN_TTL_SECS = float(os.getenv("IMPROV_SCAN_TTL_SECS", "30"))
+SCAN_MAX_NETWORKS = int(os.getenv("IMPROV_SCAN_MAX_NETWORKS", "20"))
+
+# One BSS as NM reports it. `strength` is NM's 0-100 signal quality.
+AccessPoint = collections.namedtuple(
+    "AccessPoint", "ssid strength secured bssid frequency",
+    defaults=("", 0))
+
+
+def strength_to_rssi(strength):
+    """dBm for an NM signal quality (the inverse of NM's mapping, which is
+    linear from -100 dBm = 0 to -40 dBm = 100)."""
+    return round(-100 + 0.6 * max(0, min(100, strength)))
+
+
+def rank(aps):
+    """Strongest BSS per non-empty SSID, strongest first (ties by SSID)."""
+    best = {}
+    for ap in aps:
+        ssid = bytes(ap.ssid)
+        if not ssid.strip(b"\0"):
+            continue  # hidden network
+        if ssid not in best or ap.strength > best[ssid].strength:
+            best[ssid] = ap._replace(ssid=ssid)
+    return sorted(best.values(), key=lambda ap: (-ap.strength, ap.ssid))
+
+
+class ScanCache:
+    """Ranked networks of the latest scan and how old it is.
+
+    `update()` is called from whichever thread re-read the scan (the loop for
+    the D-Bus path, a job-queue worker for nmcli); readers get an immutable
+    snapshot.
+    """
+
+    def __init__(self, ttl=SCAN_TTL_SECS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._networks = ()
+        self._scanned = None  # monotonic time of the scan, None: never
+        self.updates = 0
+
+    def update(self, aps, age=0.0):
+        """Replace the contents with the APs of a scan that finished `age`
+        seconds ago. Returns True if the ranked list changed."""
+        networks = tuple(rank(aps))
+        with self._lock:
+            changed = networks != self._networks
+            self._networks = networks
+            self._scanned = time.monotonic() - max(0.0, age)
+            self.updates += 1
+        return changed
+
+    def age(self):
+        """Seconds since the scan, or None if there has been none."""
+        scanned = self._scanned
+        return None if scanned is None else time.monotonic() - scanned
+
+    def fresh(self):
+        age = self.age()
+        return age is not None and age < self.ttl
+
+    def networks(self, limit=SCAN_MAX_NETWORKS):
+        return list(self._networks[:limit])
+
+    def visible(self, ssid):
+        """True/False if a fresh scan has/has not seen `ssid`; None if there is
+        no fresh scan to tell."""
+        if not self.fresh():
+            return None
+        ssid = bytes(ssid)
+        return any(ap.ssid == ssid for ap in self._networks)
+
+    def rpc_results(self, limit=SCAN_MAX_NETWORKS):
+        """GET_WIFI_NETWORKS results, one per network: SSID, RSSI (dBm, as a
+        decimal string) and whether authentication is required."""
+        return [[ap.ssid, str(strength_to_rssi(ap.strength)),
+                 "YES" if ap.secured else "NO"]
+                for ap in self.networks(limit)]
@@ -0,0 +1,1269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Device-Status providers shared by the Improv onboarding servers.
+#
+# Each block of the Device-Status document (`net`, `time`, `sec`, `ota`, and
+# whatever comes next) is a StatusProvider registered on a StatusRegistry with
+# its own cadence, timeout and cache policy. The registry assembles the
+# document in one blocking `collect()` call that the servers run off the BLE
+# event loop; fresh blocks come from its StatusCache, and a block is dropped
+# from the cache the moment one of its watched source files changes (inotify,
+# FileWatcher) or the server calls `invalidate()` from a D-Bus signal. Nothing
+# is re-read or re-forked on a refresh unless its cadence ran out or its
+# source changed.
+#
+# Board profiles (BOARD_PROFILES) pick the blocks each board reports and the
+# board-specific facts behind them (secure element, OTA unit, U-Boot flag).
+# `register_profile()` registers the standard providers for a profile; a
+# server replaces any of them by registering its own under the same name (the
+# e-ink server serves `net` from its NetworkManager D-Bus monitor this way).
+#
+# Servers without a refresh scheduler of their own use StatusPublisher: the
+# cached JSON value for reads plus a loop that collects off the BLE loop, at a
+# short cadence while a central is subscribed and a long one otherwise. A read
+# only asks for a new collection once the value is older than the short
+# cadence, so a phone polling the characteristic does not fork per read.
+# `bless_status_publisher()` wires one to a bless server's Device-Status
+# characteristic (the same UUIDs on every board).
+#
+# `pack_advert_summary()` condenses the document into the few bytes a server
+# can put in its advertisement (see "advertised summary" below).
+# `encode_device_status_cbor()` is the compact form of the whole document, and
+# StatusDeltas tracks which blocks changed since they were last notified, for
+# servers that publish those alongside the JSON.
+#
+# Environment:
+#   IMPROV_BOARD_PROFILE              profile name (default: per server)
+#   IMPROV_STATUS_TTL_SECS            backstop TTL of a watched block (3600)
+#   IMPROV_STATUS_TTL_UNWATCHED_SECS  TTL of a block whose sources are not
+#                                     watched (30)
+#   IMPROV_STATUS_DEADLINE_SECS       how long one collection waits for its
+#                                     providers before publishing (1.0)
+#   IMPROV_STATUS_KILL_GRACE_SECS     how long a compute may run past its
+#                                     provider's timeout before it is killed (2)
+#   IMPROV_NET_POLL_SECS              StatusPublisher cadence while a central
+#                                     is subscribed (5)
+#   IMPROV_STATUS_IDLE_SECS           StatusPublisher cadence otherwise (300)
+#   IMPROV_TIME_DRIFT_SECS            clock jump that makes StatusDeltas count
+#                                     an otherwise unchanged `time` block (30)
+#
+
+import asyncio
+import concurrent.futures
+import ctypes
+import fcntl
+import json
+import logging
+import os
+import re
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import improv_jobs
+
+# In-process nl80211 client (same recipe) for SSID/RSSI without forking
+# nmcli; falls back to nmcli + /proc/net/wireless if absent.
+try:
+    import nl80211
+except ImportError:  # pragma: no cover - depends on the image
+    nl80211 = None
+
+logger = logging.getLogger(__name__)
+
+# Source files (module level so off-target benchmarks can point them at
+# fixtures).
+TIMESYNC_STAMP = "/run/systemd/timesync/synchronized"
+SOTA_CONFIG = "/var/sota/sota.toml"
+OS_RELEASE = "/etc/os-release"
+PROC_NET_WIRELESS = "/proc/net/wireless"
+
+# A watched block is invalidated the moment its source changes, so its TTL is
+# only a backstop for a missed event; blocks whose sources could not be watched
+# fall back to the short TTL.
+STATUS_TTL_SECS = int(os.getenv("IMPROV_STATUS_TTL_SECS", "3600"))
+STATUS_TTL_UNWATCHED_SECS = int(os.getenv("IMPROV_STATUS_TTL_UNWATCHED_SECS", "30"))
+
+# The Dynamic Devices vendor Network Status service and its Device-Status
+# (JSON) characteristic.
+DEVICE_STATUS_SERVICE_UUID = "e5f10001-9d3a-4b7c-8a21-6f2c9b4d7e10"
+DEVICE_STATUS_CHAR_UUID = "e5f10002-9d3a-4b7c-8a21-6f2c9b4d7e10"
+# StatusPublisher refreshes every NET_POLL_SECS while a central is subscribed,
+# every STATUS_IDLE_SECS otherwise; a stale read or a watched source changing
+# refreshes sooner.
+NET_POLL_SECS = int(os.getenv("IMPROV_NET_POLL_SECS", "5"))
+STATUS_IDLE_SECS = int(os.getenv("IMPROV_STATUS_IDLE_SECS", "300"))
+
+# Bound on every subprocess a provider forks, unless it sets its own.
+DEFAULT_TIMEOUT = 4.0
+
+# Providers run concurrently; a collection publishes what is ready after this
+# long and late blocks follow in a second notification (see collect()).
+STATUS_DEADLINE_SECS = float(os.getenv("IMPROV_STATUS_DEADLINE_SECS", "1.0"))
+# A compute still running this long after its provider's timeout is wedged
+# (the nmcli binding, for one, forks without a timeout): the registry's job
+# queue fails it and kills what its thread forked.
+STATUS_KILL_GRACE_SECS = float(os.getenv("IMPROV_STATUS_KILL_GRACE_SECS", "2"))
+# `time.epoch` advances on every refresh; that alone is not a change. The time
+# block only counts as changed when its source/synced state changes or the
+# wall clock jumps by at least this much relative to the monotonic clock.
+TIME_DRIFT_SECS = int(os.getenv("IMPROV_TIME_DRIFT_SECS", "30"))
+
+# BlueZ/bless characteristic-value ceiling (see shrink_to_att).
+ATT_VALUE_MAX = 512
+
+BOARD_PROFILES = {
+    "imx93-jaguar-eink": {
+        "blocks": ("net", "time", "sec", "ota"),
+        # i.MX93 on-die EdgeLock Enclave (OP-TEE /dev/tee0 present).
+        "secure_element": "ele",
+        # U-Boot flag the NXP boot script gates authenticated boot on.
+        "sec_boot_env": "sec_boot",
+        "ota_unit": "aktualizr-lite.service",
+    },
+    "imx8mm-jaguar-inst": {
+        # No secure-boot signal is exposed to userspace on this board yet, so
+        # it reports no `sec` block rather than an all-unknown one.
+        "blocks": ("net", "time", "ota"),
+        "ota_unit": "aktualizr-lite.service",
+    },
+    "default": {
+        "blocks": ("net", "time"),
+    },
+}
+
+
+def board_profile(name):
+    """Profile `name` (unknown names get the default profile), with its name."""
+    profile = BOARD_PROFILES.get(name)
+    if profile is None:
+        logger.warning("unknown board profile %r; using default", name)
+        name, profile = "default", BOARD_PROFILES["default"]
+    return dict(profile, name=name)
+
+
+class StatusCache:
+    """Per-block value cache with a TTL per entry and explicit invalidation.
+
+    `get` runs on the status executor thread while `invalidate` is called from
+    the event loop (inotify / D-Bus callbacks), hence the lock. A TTL of None
+    caches for the process lifetime.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # block -> (value, expires_at or None)
+
+    def get(self, block, compute, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(block)
+            if entry is not None and (entry[1] is None or now < entry[1]):
+                return entry[0]
+        value = compute()
+        with self._lock:
+            self._entries[block] = (
+                value, None if ttl is None else now + ttl)
+        return value
+
+    def lookup(self, block):
+        """(True, value) if `block` is cached and fresh, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(block)
+        if entry is not None and (entry[1] is None or time.monotonic() < entry[1]):
+            return True, entry[0]
+        return False, None
+
+    def put(self, block, value, ttl):
+        with self._lock:
+            self._entries[block] = (
+                value, None if ttl is None else time.monotonic() + ttl)
+
+    def peek(self, block):
+        """Last cached value of `block` (even if expired), or None."""
+        with self._lock:
+            entry = self._entries.get(block)
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, *blocks):
+        with self._lock:
+            for block in blocks:
+                self._entries.pop(block, None)
+
+
+# inotify(7) constants (linux/inotify.h).
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+_INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class FileWatcher:
+    """inotify-based invalidation of StatusCache blocks, driven from the loop.
+
+    Watches the *parent directory* of each target (the files come and go:
+    sota.toml appears at registration, timesyncd creates/removes its stamp, and
+    os-release is replaced by rename on OTA). If a parent does not exist yet the
+    nearest existing ancestor is watched and the watch is moved down as the
+    directories appear. Uses libc via ctypes, so no extra runtime dependency.
+    """
+
+    def __init__(self, on_change):
+        self.on_change = on_change
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._targets = {}  # absolute file path -> set of blocks
+        self._wds = {}  # wd -> directory
+        self._dirs = {}  # directory -> wd
+
+    def watch(self, path, block):
+        self._targets.setdefault(path, set()).add(block)
+        self._arm(path)
+
+    def watching_path(self, path):
+        return path in self._targets and os.path.dirname(path) in self._dirs
+
+    def _arm(self, path):
+        d = os.path.dirname(path)
+        while d not in self._dirs and not os.path.isdir(d) and d != "/":
+            d = os.path.dirname(d)
+        if d in self._dirs:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, d.encode(), _INOTIFY_MASK)
+        if wd < 0:
+            logger.debug(f"inotify_add_watch({d}) failed: errno "
+                         f"{ctypes.get_errno()}")
+            return
+        self._wds[wd] = d
+        self._dirs[d] = wd
+
+    def start(self, loop):
+        loop.add_reader(self.fd, self._drain)
+
+    def _drain(self):
+        try:
+            buf = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        changed = set()
+        rearm = False
+        off = 0
+        while off + _INOTIFY_EVENT.size <= len(buf):
+            wd, mask, _cookie, nlen = _INOTIFY_EVENT.unpack_from(buf, off)
+            name = buf[off + _INOTIFY_EVENT.size:
+                       off + _INOTIFY_EVENT.size + nlen].rstrip(b"\0").decode()
+            off += _INOTIFY_EVENT.size + nlen
+            d = self._wds.get(wd)
+            if d is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                # Directory went away: fall back to an ancestor.
+                self._wds.pop(wd, None)
+                self._dirs.pop(d, None)
+                rearm = True
+                full = d
+            else:
+                full = os.path.join(d, name)
+            for target, blocks in self._targets.items():
+                if target == full or target.startswith(full + "/"):
+                    changed |= blocks
+                    if target != full:
+                        rearm = True
+        if rearm:
+            for target in self._targets:
+                self._arm(target)
+        if changed:
+            self.on_change(changed)
+
+
+class StatusProvider:
+    """One Device-Status block.
+
+    `compute` is blocking and returns the block (a dict) or None to leave it
+    out. Cache policy:
+      - cadence: seconds a computed block stays fresh while its sources are not
+        watched; 0 recomputes on every collection, None keeps the first value
+        for the process lifetime.
+      - sources: files whose change invalidates the block. Once all of them
+        (and `watched()`, if given) are being watched, the block is kept for
+        STATUS_TTL_SECS instead of `cadence`.
+      - stale_on_error: if `compute` raises, serve the last value. A block with
+        no last value (or stale_on_error=False) is published as
+        {"error": "<exception type>"} rather than dropped.
+    `timeout` bounds each subprocess the block forks (see `run`); a compute
+    that takes longer than it is logged and counted in the registry stats,
+    and one still running STATUS_KILL_GRACE_SECS later is failed and has the
+    processes it forked killed (see StatusRegistry._submit).
+    `placeholder` is published while the block has never been computed and
+    its provider misses a collection deadline (None leaves the block out).
+    `inline` marks a compute that never forks or blocks (clock reads, cached
+    values); it runs on the collecting thread instead of a registry thread,
+    which would cost more than the compute itself.
+    """
+
+    def __init__(self, name, compute, cadence=STATUS_TTL_UNWATCHED_SECS,
+                 timeout=DEFAULT_TIMEOUT, sources=(), watched=None,
+                 stale_on_error=True, placeholder=None, inline=False):
+        self.name = name
+        self.compute = compute
+        self.cadence = cadence
+        self.timeout = timeout
+        self.sources = tuple(sources)
+        self.watched = watched
+        self.stale_on_error = stale_on_error
+        self.placeholder = placeholder
+        self.inline = inline
+
+    def __repr__(self):
+        return (f"StatusProvider({self.name!r}, cadence={self.cadence}, "
+                f"timeout={self.timeout})")
+
+
+class StatusRegistry:
+    """The providers that make up one board's Device-Status document.
+
+    `collect` is blocking and runs on an executor thread; `register`,
+    `invalidate` and `start_watching` are called from the event loop.
+    `on_change(names)` is called on the loop thread when a watched source
+    changes (after the affected blocks have been invalidated) and when a block
+    that missed a collection deadline has been computed, so the server can
+    publish again.
+    """
+
+    def __init__(self, on_change=None, deadline=STATUS_DEADLINE_SECS):
+        self.on_change = on_change
+        self.deadline = deadline
+        self.cache = StatusCache()
+        self._providers = {}  # name -> StatusProvider, in document order
+        self._sources = {}  # path -> set of cache keys
+        self._watcher = None
+        self._loop = None
+        self._jobs = None  # improv_jobs.JobQueue the computes run on
+        self._pending = {}  # name -> Future of a compute still running
+        self._pending_lock = threading.Lock()
+        # name -> {"runs", "errors", "overruns", "timeouts", "late", "last_ms"}
+        self.stats = {}
+
+    def register(self, provider):
+        """Add `provider`, or replace the one registered under its name."""
+        self._providers[provider.name] = provider
+        self.stats.setdefault(provider.name, {"runs": 0, "errors": 0,
+                                              "overruns": 0, "timeouts": 0,
+                                              "late": 0, "last_ms": 0})
+        self.cache.invalidate(provider.name)
+        for path in provider.sources:
+            self.watch(path, provider.name)
+        return provider
+
+    def unregister(self, name):
+        self._providers.pop(name, None)
+        self.cache.invalidate(name)
+
+    def providers(self):
+        return list(self._providers.values())
+
+    def watch(self, path, *keys):
+        """Invalidate cache `keys` whenever `path` changes."""
+        self._sources.setdefault(path, set()).update(keys)
+        if self._watcher is not None:
+            for key in keys:
+                self._watcher.watch(path, key)
+
+    def watching(self, *paths):
+        return (self._watcher is not None and
+                all(self._watcher.watching_path(p) for p in paths))
+
+    def start_watching(self, loop):
+        """Arm inotify for every registered source. Best-effort: on failure
+        every block keeps its unwatched cadence."""
+        self._loop = loop
+        try:
+            watcher = FileWatcher(self._sources_changed)
+            for path, keys in self._sources.items():
+                for key in keys:
+                    watcher.watch(path, key)
+            watcher.start(loop)
+            self._watcher = watcher
+        except Exception as e:
+            logger.warning(f"inotify unavailable ({e!r}); status blocks use "
+                           f"a {STATUS_TTL_UNWATCHED_SECS}s TTL")
+
+    def _sources_changed(self, keys):
+        self.invalidate(*keys)
+
+    def invalidate(self, *names):
+        """Drop cached blocks (loop thread) and tell the server."""
+        self.cache.invalidate(*names)
+        if self.on_change is not None:
+            self.on_change(set(names))
+
+    def ttl(self, provider):
+        if provider.cadence is None or provider.cadence <= 0:
+            return provider.cadence
+        watched = bool(provider.sources) and self.watching(*provider.sources)
+        if watched and provider.watched is not None:
+            watched = provider.watched()
+        return max(provider.cadence, STATUS_TTL_SECS) if watched else provider.cadence
+
+    def cached(self, key, compute, sources=(), cadence=STATUS_TTL_UNWATCHED_SECS):
+        """Cache a value shared by several blocks (e.g. os-release) under
+        `key`, with the same watched/unwatched TTL rule as a provider."""
+        if sources and self.watching(*sources):
+            cadence = max(cadence, STATUS_TTL_SECS)
+        return self.cache.get(key, compute, cadence)
+
+    def block(self, name):
+        """Current value of block `name` (blocking), honouring its cache policy."""
+        provider = self._providers[name]
+        try:
+            if provider.cadence != 0:
+                return self.cache.get(name, lambda: self._compute(provider),
+                                      self.ttl(provider))
+            value = self._compute(provider)
+        except Exception as e:
+            # _compute already logged it. Nothing is cached, so the next
+            # collection retries.
+            return self._fallback(provider, e)
+        if value is not None:
+            # Not reused, but kept as the stale value for a missed deadline.
+            self.cache.put(name, value, 0)
+        return value
+
+    def _fallback(self, provider, error):
+        """What to publish for `provider` after its compute failed."""
+        stale = self.cache.peek(provider.name) if provider.stale_on_error else None
+        return stale if stale is not None else {"error": type(error).__name__}
+
+    def _compute(self, provider):
+        stats = self.stats[provider.name]
+        t0 = time.monotonic()
+        stats["runs"] += 1
+        try:
+            return provider.compute()
+        except Exception as e:
+            stats["errors"] += 1
+            logger.debug("status block %s failed: %r", provider.name, e)
+            raise
+        finally:
+            elapsed = time.monotonic() - t0
+            stats["last_ms"] = round(elapsed * 1000.0, 1)
+            if provider.timeout is not None and elapsed > provider.timeout:
+                stats["overruns"] += 1
+                logger.warning("status block %s took %.1fs (budget %.1fs)",
+                               provider.name, elapsed, provider.timeout)
+
+    def collect(self, deadline=None, **given):
+        """The Device-Status document (blocking; call off the BLE loop).
+
+        Blocks passed as keyword arguments are used as-is instead of calling
+        their provider, fresh blocks come straight from the cache and inline
+        providers are called directly. The rest are computed concurrently on
+        the registry's own threads, and the document is returned once they
+        are all done or `deadline` seconds (default: self.deadline) have
+        passed, whichever is first. A block that
+        is late is served stale from the cache, else as its placeholder, else
+        left out; when it does finish, its value is cached and `on_change`
+        fires so the server publishes a follow-up. A block whose provider
+        returns None is left out; one whose provider raises is served per
+        its stale_on_error policy (see StatusProvider).
+        """
+        if deadline is None:
+            deadline = self.deadline
+        values = {}
+        futures = {}
+        for name, provider in self._providers.items():
+            if name in given:
+                values[name] = given[name]
+                continue
+            if provider.cadence != 0:
+                hit, value = self.cache.lookup(name)
+                if hit:
+                    values[name] = value
+                    continue
+            if provider.inline:
+                values[name] = self.block(name)
+                continue
+            futures[name] = self._submit(name)
+        if futures:
+            concurrent.futures.wait(futures.values(), timeout=deadline)
+        for name, future in futures.items():
+            if future.done():
+                error = future.exception()
+                values[name] = (future.result() if error is None else
+                                self._fallback(self._providers[name], error))
+                continue
+            self.stats[name]["late"] += 1
+            logger.info("status block %s missed the %.1fs deadline", name,
+                        deadline)
+            stale = self.cache.peek(name)
+            values[name] = (stale if stale is not None
+                            else self._providers[name].placeholder)
+            future.add_done_callback(lambda _f, n=name: self._late_done(n))
+        doc = {"v": 1}
+        for name in self._providers:
+            if values.get(name) is not None:
+                doc[name] = values[name]
+        return doc
+
+    def _submit(self, name):
+        """Future computing block `name`, reusing one still in flight so a
+        slow provider never has two computes running.
+
+        The computes run on a JobQueue of their own rather than the server's:
+        collect() returns at its deadline whatever its providers are doing, so
+        a job timeout on the collection would never fire. Here each compute
+        has one, and a wedged compute's future fails with TimeoutError while
+        the processes its thread forked are killed.
+        """
+        provider = self._providers[name]
+        timeout = (None if provider.timeout is None
+                   else provider.timeout + STATUS_KILL_GRACE_SECS)
+        with self._pending_lock:
+            future = self._pending.get(name)
+            if future is not None:
+                return future
+            if self._jobs is None:
+                # The server's own queue keeps the whole-process fallback.
+                self._jobs = improv_jobs.JobQueue(
+                    workers=max(4, len(self._providers)),
+                    name="improv-status", kill_unattributed=False)
+            future = self._jobs.submit(self.block, name, timeout=timeout,
+                                       name=f"status:{name}")
+            self._pending[name] = future
+        future.add_done_callback(lambda _f: self._forget(name, future))
+        return future
+
+    def _forget(self, name, future):
+        if isinstance(future.exception(), TimeoutError):
+            self.stats[name]["timeouts"] += 1
+        with self._pending_lock:
+            if self._pending.get(name) is future:
+                del self._pending[name]
+
+    def _late_done(self, name):
+        """A late block finished (status thread): republish on the loop."""
+        if self.on_change is None or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self.on_change, {name})
+        except RuntimeError:  # loop closed during shutdown
+            pass
+
+
+def run(cmd, timeout=DEFAULT_TIMEOUT):
+    """subprocess.run for providers: captured text output, bounded."""
+    return subprocess.run(cmd, capture_output=True, timeout=timeout, text=True)
+
+
+def _nmcli():
+    """nmcli Python binding, imported on first use (only the polling path)."""
+    import nmcli
+    return nmcli
+
+
+# --- net ----------------------------------------------------------------------
+
+def get_ipv4(iface):
+    """Return the interface IPv4 via ioctl (no subprocess), or None."""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            packed = struct.pack('256s', iface[:15].encode('utf-8'))
+            addr = fcntl.ioctl(s.fileno(), 0x8915, packed)[20:24]  # SIOCGIFADDR
+            return socket.inet_ntoa(addr)
+        finally:
+            s.close()
+    except Exception:
+        return None
+
+
+_nl80211_client = None
+
+
+def get_link_info(iface):
+    """SSID/BSSID/signal/bitrate from nl80211 in one netlink round trip.
+
+    Returns None when not associated, or when nl80211 is unavailable (the
+    callers then fall back to nmcli / /proc/net/wireless).
+    """
+    global _nl80211_client
+    if nl80211 is None:
+        return None
+    try:
+        if _nl80211_client is None:
+            _nl80211_client = nl80211.Nl80211()
+        return _nl80211_client.link_info(iface)
+    except Exception as e:
+        logger.debug("nl80211 link query failed: %r", e)
+        return None
+
+
+def get_ssid(iface, timeout=DEFAULT_TIMEOUT):
+    """Best-effort current SSID (called off the BLE read path)."""
+    # 0) nl80211: no subprocess, no scan-cache walk.
+    link = get_link_info(iface)
+    if link and link.get("ssid"):
+        return link["ssid"]
+    # 1) Active AP from the scan list.
+    try:
+        out = run(["nmcli", "-t", "-f", "ACTIVE,SSID", "dev", "wifi"], timeout)
+        for line in out.stdout.splitlines():
+            if line.startswith("yes:"):
+                ssid = line.split(":", 1)[1].strip()
+                if ssid:
+                    return ssid
+    except Exception:
+        pass
+    # 2) Fall back to the SSID stored on the interface's active connection
+    #    (reliable right after provisioning, before the scan cache updates).
+    try:
+        conn = (_nmcli().device.show(iface) or {}).get("GENERAL.CONNECTION")
+        if conn and conn not in ("--", ""):
+            out = run(["nmcli", "-s", "-g", "802-11-wireless.ssid",
+                       "connection", "show", conn], timeout)
+            ssid = out.stdout.strip()
+            if ssid:
+                return ssid
+    except Exception:
+        pass
+    return None
+
+
+def get_rssi(iface):
+    """Signal level in dBm from nl80211, else /proc/net/wireless, or None."""
+    link = get_link_info(iface)
+    if link and link.get("signal") is not None and -120 <= link["signal"] <= 0:
+        return link["signal"]
+    try:
+        with open(PROC_NET_WIRELESS) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith(iface + ":"):
+                    parts = line.split()
+                    if len(parts) > 3:
+                        rssi = int(float(parts[3].rstrip(".")))
+                        if -120 <= rssi <= 0:
+                            return rssi
+    except Exception:
+        pass
+    return None
+
+
+def nm_device_state(iface):
+    """NetworkManager device-state code for `iface` via nmcli (0 if unknown)."""
+    try:
+        d = _nmcli().device.show(iface)
+        m = re.match(r"\s*(\d+)", d.get("GENERAL.STATE") or "")
+        return int(m.group(1)) if m else 0
+    except Exception as e:
+        logger.debug("nmcli device state read failed: %s", e)
+        return 0
+
+
+def net_block(iface, code, ip, get_ssid_fn):
+    """The `net` block from an NM device-state code and IPv4.
+
+    Derive link state from NetworkManager's numeric device-state code
+    (100=connected, 40..99=connecting/configuring, else disconnected). String
+    matching is unsafe here because "disconnected" contains "connected".
+
+    NM is authoritative: a lingering interface IP must NOT upgrade a
+    disconnected/failed device to "connected". If we cannot read NM's state the
+    caller passes 0 and we stay "disconnected" (conservative) rather than
+    trusting a possibly-stale IP. `get_ssid_fn` is only called when connected.
+    IP/SSID/RSSI are only surfaced when connected; a stale IP on a down
+    interface would otherwise be misreported as a live connection.
+    """
+    if code >= 100:
+        state = "connected" if ip else "connecting"
+    elif code >= 40:
+        state = "connecting"
+    else:
+        state = "disconnected"
+    block = {"bearer": "wifi", "state": state, "ssid": None, "ipv4": None,
+             "rssi": None, "iface": iface}
+    if state == "connected":
+        block["ipv4"] = ip
+        block["ssid"] = get_ssid_fn()
+        block["rssi"] = get_rssi(iface)
+    return block
+
+
+def read_net_status(iface, timeout=DEFAULT_TIMEOUT):
+    """`net` block by polling nmcli (the path without a D-Bus monitor)."""
+    return net_block(iface, nm_device_state(iface), get_ipv4(iface),
+                     lambda: get_ssid(iface, timeout))
+
+
+# --- time ---------------------------------------------------------------------
+
+def read_timesync():
+    return os.path.exists(TIMESYNC_STAMP)
+
+
+def time_block(synced):
+    """Wall-clock/time-sync status. `synced` comes from systemd-timesyncd's
+    stamp file; we report `ntp` when synced and `none` otherwise rather than
+    trusting an RTC."""
+    now = time.time()
+    return {
+        "epoch": int(now),
+        "iso": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+        "source": "ntp" if synced else "none",
+        "synced": synced,
+    }
+
+
+# --- sec ----------------------------------------------------------------------
+
+def read_secure_boot(env_name, timeout=DEFAULT_TIMEOUT):
+    """Secure-boot posture from a U-Boot environment flag. Returns 'open' |
+    'closed' | 'unknown'.
+
+    On i.MX93 the authoritative source is the EdgeLock Enclave (ELE) "get
+    info" lifecycle field (OEM_OPEN vs OEM_CLOSED / FIELD_RETURN). The kernel,
+    however, exposes no ELE MU char device (`/dev/ele_mu` absent) and no
+    lifecycle nvmem cell — the lifecycle lives behind OP-TEE/secure world —
+    so it cannot be read from Linux userspace without a dedicated OP-TEE TA.
+    That ELE-attested query remains a tracked follow-up (roadmap P0-1/P2-1,
+    BLE-BOARD-PROFILE.md §10) and needs secure-world plumbing.
+
+    As the best available userspace signal we read the U-Boot environment flag
+    the NXP boot script uses to gate authenticated boot (`sec_boot`, see the
+    board profile): 'yes' => authenticated boot enforced ('closed'), 'no' =>
+    not enforced ('open'). This reflects the *bootloader configuration* rather
+    than an ELE-attested hardware lifecycle, and — like the whole `sec` block —
+    is self-reported and untrusted until backed by attestation (P2-1). A
+    fuse/OCOTP byte heuristic is deliberately avoided: the ELE-OCOTP0 shadow
+    has non-zero UID/config words, so byte-level guessing would misreport a
+    fused board.
+    """
+    val = ""
+    try:
+        # `-n` prints just the value; falls back to parsing `k=v` for older
+        # u-boot-fw-utils that lack `-n`.
+        out = run(["fw_printenv", "-n", env_name], timeout)
+        if out.returncode == 0:
+            val = out.stdout.strip().lower()
+        else:
+            out = run(["fw_printenv", env_name], timeout)
+            if out.returncode == 0 and "=" in out.stdout:
+                val = out.stdout.strip().split("=", 1)[1].strip().lower()
+    except Exception as e:
+        logger.debug(f"secure_boot read failed: {e}")
+        return "unknown"
+    if val in ("yes", "1", "true"):
+        return "closed"
+    if val in ("no", "0", "false"):
+        return "open"
+    return "unknown"
+
+
+def read_storage_encrypted():
+    """True if any dm-crypt mapped device exists (root-free via sysfs)."""
+    import glob
+    try:
+        for p in glob.glob("/sys/block/dm-*/dm/uuid"):
+            try:
+                with open(p) as f:
+                    if f.read().startswith("CRYPT-"):
+                        return True
+            except Exception:
+                pass
+    except Exception:
+        pass
+    return False
+
+
+# --- ota ----------------------------------------------------------------------
+
+def read_os_release():
+    """Parse /etc/os-release into a dict (root-free, no subprocess)."""
+    d = {}
+    try:
+        with open(OS_RELEASE) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                k, v = line.split("=", 1)
+                d[k] = v.strip().strip('"')
+    except Exception as e:
+        logger.debug(f"os-release read failed: {e}")
+    return d
+
+
+def unit_active(unit, timeout=DEFAULT_TIMEOUT):
+    """`systemctl is-active` fallback for when no unit watcher is live."""
+    try:
+        return run(["systemctl", "is-active", unit], timeout).stdout.strip() == "active"
+    except Exception as e:
+        logger.debug(f"{unit} is-active failed: {e}")
+        return False
+
+
+def ota_block(osr, daemon):
+    """Foundries enrollment / OTA posture from os-release and sota.toml.
+
+      - `registered`: /var/sota/sota.toml exists — the config lmp-device-register
+        writes and the gate aktualizr-lite.service requires.
+      - `factory`/`tag`/`hwid`/`target`/`os_version`: baked into /etc/os-release
+        at image build time.
+      - `daemon`: the OTA unit is active.
+      - `up_to_date`: left null on purpose — only the cloud can answer that.
+    """
+    target = osr.get("IMAGE_VERSION") or None
+    if target is not None:
+        try:
+            target = int(target)
+        except (TypeError, ValueError):
+            pass
+    return {
+        "registered": os.path.exists(SOTA_CONFIG),
+        "factory": osr.get("LMP_FACTORY") or None,
+        "tag": osr.get("LMP_FACTORY_TAG") or None,
+        "hwid": osr.get("LMP_MACHINE") or None,
+        "target": target,
+        "os_version": osr.get("VERSION_ID") or osr.get("VERSION") or None,
+        "daemon": daemon,
+        "up_to_date": None,
+    }
+
+
+# --- advertised summary -------------------------------------------------------
+# A few bytes of Device-Status carried by the advertisement itself, so a
+# scanner can triage boards without connecting. They ride in the Improv
+# service data (16-bit UUID 0x4677), which the Improv BLE spec defines as
+# [current state, capabilities, 4 reserved bytes]; the summary takes the
+# reserved bytes:
+#
+#   byte 2    bit 7     summary present (clear: the spec's all-zero bytes)
+#             bit 6     provisioned (Improv PROVISIONED or Wi-Fi connected)
+#             bits 4-5  link: 0 disconnected, 1 connecting, 2 connected
+#             bits 0-3  RSSI bucket: 0 none, else 5 dB wide from -105 dBm
+#   bytes 3-5           firmware build (`ota.target`, IMAGE_VERSION), low 24
+#                       bits, little endian; 0 unknown
+#
+# Six bytes of service data are a 10-byte AD structure: exactly what a legacy
+# advertisement has left after the flags and one 128-bit service UUID.
+
+IMPROV_SERVICE_DATA_UUID = "00004677-0000-1000-8000-00805f9b34fb"
+ADVERT_LINK_STATES = ("disconnected", "connecting", "connected")
+ADVERT_SUMMARY = 0x80
+ADVERT_PROVISIONED = 0x40
+
+
+def rssi_bucket(rssi):
+    if rssi is None:
+        return 0
+    return max(1, min(15, (int(rssi) + 105) // 5))
+
+
+def bucket_rssi(bucket):
+    """Lower bound (dBm) of an RSSI bucket; None for "no reading"."""
+    return bucket * 5 - 105 if bucket else None
+
+
+def pack_advert_summary(state, capabilities, doc, provisioned):
+    """Improv service data with the summary of Device-Status `doc`. Until the
+    document has a `net` block the reserved bytes stay zero."""
+    head = bytes([state & 0xFF, capabilities & 0xFF])
+    net = (doc or {}).get("net")
+    if not isinstance(net, dict):
+        return head + bytes(4)
+    link = net.get("state")
+    flags = (ADVERT_SUMMARY
+             | (ADVERT_PROVISIONED if provisioned else 0)
+             | (ADVERT_LINK_STATES.index(link) << 4
+                if link in ADVERT_LINK_STATES else 0)
+             | rssi_bucket(net.get("rssi")))
+    build = ((doc.get("ota") or {}).get("target"))
+    build = build & 0xFFFFFF if isinstance(build, int) and build > 0 else 0
+    return head + bytes([flags]) + build.to_bytes(3, "little")
+
+
+def unpack_advert_summary(data):
+    """Fields of Improv service data (scanners, tests). The summary fields are
+    None when the advertisement carries none."""
+    data = bytes(data)
+    if len(data) < 6:
+        return None
+    out = {"state": data[0], "capabilities": data[1], "provisioned": None,
+           "link": None, "rssi_min": None, "build": None}
+    if data[2] & ADVERT_SUMMARY:
+        link = (data[2] >> 4) & 0x3
+        out.update(
+            provisioned=bool(data[2] & ADVERT_PROVISIONED),
+            link=(ADVERT_LINK_STATES[link] if link < len(ADVERT_LINK_STATES)
+                  else None),
+            rssi_min=bucket_rssi(data[2] & 0x0F),
+            build=int.from_bytes(data[3:6], "little") or None)
+    return out
+
+
+# --- standard providers -------------------------------------------------------
+
+def get_os_release(registry):
+    """Cached os-release, shared by the `ota` block and DIS FW revision;
+    invalidated by inotify when an OTA replaces the file."""
+    return registry.cached("os-release", read_os_release, (OS_RELEASE,))
+
+
+def register_profile(registry, profile, iface, daemon_state=None):
+    """Register the standard providers for the blocks `profile` reports.
+
+    `daemon_state()` may return the OTA unit's ActiveState from a live
+    watcher, or None to fall back to `systemctl is-active`.
+    """
+    blocks = profile["blocks"]
+    if "net" in blocks:
+        registry.register(StatusProvider(
+            "net", lambda: read_net_status(iface), cadence=0,
+            placeholder=net_block(iface, 0, None, None)))
+    if "time" in blocks:
+        registry.watch(TIMESYNC_STAMP, "timesync")
+        registry.register(StatusProvider(
+            "time", lambda: time_block(registry.cached(
+                "timesync", read_timesync, (TIMESYNC_STAMP,))), cadence=0,
+            inline=True))
+    if "sec" in blocks:
+        sec = StatusProvider("sec", None, cadence=None)
+
+        def compute_sec():
+            return {
+                "secure_boot": read_secure_boot(profile["sec_boot_env"],
+                                                sec.timeout),
+                "secure_element": profile.get("secure_element", "none"),
+                "storage_encrypted": read_storage_encrypted(),
+                # Improv link is Just Works / unbonded today.
+                "bonded": False,
+                # No remote attestation yet — sec is untrusted.
+                "attested": False,
+            }
+        sec.compute = compute_sec
+        registry.register(sec)
+    if "ota" in blocks:
+        unit = profile["ota_unit"]
+        registry.watch(OS_RELEASE, "os-release")
+        ota = StatusProvider(
+            "ota", None, sources=(SOTA_CONFIG, OS_RELEASE),
+            watched=lambda: daemon_state is not None and daemon_state() is not None)
+
+        def compute_ota():
+            state = daemon_state() if daemon_state is not None else None
+            daemon = (state == "active" if state is not None
+                      else unit_active(unit, ota.timeout))
+            return ota_block(get_os_release(registry), daemon)
+        ota.compute = compute_ota
+        registry.register(ota)
+    return registry
+
+
+def shrink_to_att(doc, limit=ATT_VALUE_MAX):
+    """Return compact JSON bytes that fit in one ATT value, or the best-effort
+    original. Progressive omits (never invent values): time.iso → ota.os_version
+    → ota.hwid. Truncation mid-JSON is worse than omitting a redundant field.
+    """
+    data = json.dumps(doc, separators=(",", ":")).encode("utf-8")
+    if len(data) <= limit:
+        return data
+    # 1. Drop time.iso (epoch is enough for the app).
+    if "time" in doc and isinstance(doc["time"], dict) and "iso" in doc["time"]:
+        slim = dict(doc)
+        slim["time"] = {k: v for k, v in doc["time"].items() if k != "iso"}
+        data = json.dumps(slim, separators=(",", ":")).encode("utf-8")
+        if len(data) <= limit:
+            logger.info("Device-Status shrunk: dropped time.iso (%d bytes)", len(data))
+            return data
+        doc = slim
+    # 2. Drop ota.os_version / ota.hwid (derivable from factory image / machine).
+    if "ota" in doc and isinstance(doc["ota"], dict):
+        slim = dict(doc)
+        ota = {k: v for k, v in doc["ota"].items() if k not in ("os_version", "hwid")}
+        slim["ota"] = ota
+        data = json.dumps(slim, separators=(",", ":")).encode("utf-8")
+        if len(data) <= limit:
+            logger.info("Device-Status shrunk: dropped ota.os_version/hwid (%d bytes)",
+                        len(data))
+            return data
+        doc = slim
+    logger.warning("Device-Status JSON still %d bytes > ATT max %d; truncating",
+                   len(data), limit)
+    return data[:limit]
+
+
+def _without_clock(doc):
+    """`doc` minus the fields that move just because time passes."""
+    out = dict(doc)
+    if isinstance(out.get("time"), dict):
+        out["time"] = {k: v for k, v in out["time"].items()
+                       if k not in ("epoch", "iso")}
+    return out
+
+
+# --- compact (CBOR) encoding ---------------------------------------------------
+# The JSON document is ~490 bytes, close to the 512-byte ATT ceiling. The CBOR
+# form (RFC 8949) carries the same information in well under half of that:
+# integer map keys, enums for the closed string sets, IPv4 as 4 raw bytes,
+# absent keys instead of nulls and no `time.iso` (derivable from `epoch`).
+#
+# Schema v1 (map keys are unsigned ints; any value not in an enum table below is
+# sent as its original text, so new states never break old parsers):
+#   0: schema version (1)
+#   1: net  {0 state, 1 ssid, 2 ipv4 (bstr[4]), 3 rssi, 4 iface, 5 bearer}
+#   2: time {0 epoch, 1 source, 2 synced}
+#   3: sec  {0 secure_boot, 1 secure_element, 2 storage_encrypted, 3 bonded,
+#            4 attested}
+#   4: ota  {0 registered, 1 factory, 2 tag, 3 hwid, 4 target, 5 os_version,
+#            6 daemon, 7 up_to_date}
+#   enums: net.state     disconnected=0 connecting=1 connected=2
+#          net.bearer    wifi=0
+#          time.source   none=0 ntp=1 rtc=2
+#          sec.secure_boot unknown=0 open=1 closed=2
+#          sec.secure_element none=0 ele=1
+CBOR_SCHEMA_VERSION = 1
+_CBOR_BLOCKS = {
+    "net": (1, {"state": 0, "ssid": 1, "ipv4": 2, "rssi": 3, "iface": 4,
+                "bearer": 5}),
+    "time": (2, {"epoch": 0, "source": 1, "synced": 2}),
+    "sec": (3, {"secure_boot": 0, "secure_element": 1, "storage_encrypted": 2,
+                "bonded": 3, "attested": 4}),
+    "ota": (4, {"registered": 0, "factory": 1, "tag": 2, "hwid": 3, "target": 4,
+                "os_version": 5, "daemon": 6, "up_to_date": 7}),
+}
+_CBOR_ENUMS = {
+    ("net", "state"): {"disconnected": 0, "connecting": 1, "connected": 2},
+    ("net", "bearer"): {"wifi": 0},
+    ("time", "source"): {"none": 0, "ntp": 1, "rtc": 2},
+    ("sec", "secure_boot"): {"unknown": 0, "open": 1, "closed": 2},
+    ("sec", "secure_element"): {"none": 0, "ele": 1},
+}
+
+
+def _cbor_head(major, n):
+    if n < 24:
+        return bytes([(major << 5) | n])
+    if n < 0x100:
+        return bytes([(major << 5) | 24, n])
+    if n < 0x10000:
+        return bytes([(major << 5) | 25]) + n.to_bytes(2, "big")
+    if n < 0x100000000:
+        return bytes([(major << 5) | 26]) + n.to_bytes(4, "big")
+    return bytes([(major << 5) | 27]) + n.to_bytes(8, "big")
+
+
+def cbor_encode(obj):
+    """Minimal CBOR encoder for the types the Device-Status document uses."""
+    if obj is None:
+        return b"\xf6"
+    if obj is True:
+        return b"\xf5"
+    if obj is False:
+        return b"\xf4"
+    if isinstance(obj, int):
+        return _cbor_head(0, obj) if obj >= 0 else _cbor_head(1, -1 - obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return _cbor_head(2, len(obj)) + bytes(obj)
+    if isinstance(obj, str):
+        raw = obj.encode("utf-8")
+        return _cbor_head(3, len(raw)) + raw
+    if isinstance(obj, (list, tuple)):
+        return _cbor_head(4, len(obj)) + b"".join(cbor_encode(v) for v in obj)
+    if isinstance(obj, dict):
+        return _cbor_head(5, len(obj)) + b"".join(
+            cbor_encode(k) + cbor_encode(v) for k, v in obj.items())
+    if isinstance(obj, float):
+        return b"\xfb" + struct.pack(">d", obj)
+    raise TypeError(f"cannot CBOR-encode {type(obj).__name__}")
+
+
+def encode_device_status_cbor(doc):
+    """Device-Status document -> compact CBOR bytes (schema above)."""
+    out = {0: CBOR_SCHEMA_VERSION}
+    for block, (block_key, keys) in _CBOR_BLOCKS.items():
+        values = doc.get(block)
+        if not isinstance(values, dict):
+            continue
+        packed = {}
+        for name, key in keys.items():
+            v = values.get(name)
+            if v is None:
+                continue
+            enum = _CBOR_ENUMS.get((block, name))
+            if enum is not None and v in enum:
+                v = enum[v]
+            elif block == "net" and name == "ipv4":
+                try:
+                    v = socket.inet_aton(v)
+                except (OSError, TypeError):
+                    pass
+            packed[key] = v
+        out[block_key] = packed
+    return cbor_encode(out)
+
+
+# --- block-level deltas ---------------------------------------------------------
+STATUS_BLOCKS = ("net", "time", "sec", "ota")
+
+
+class StatusDeltas:
+    """Which Device-Status blocks changed since they were last notified.
+
+    `notified` holds the last notified value of each block, and `generation`
+    is bumped on every notified change; each delta carries it, so a client
+    can detect a missed one and re-read the full snapshot.
+    """
+
+    def __init__(self, blocks=STATUS_BLOCKS, drift_secs=TIME_DRIFT_SECS):
+        self.blocks = blocks
+        self.drift_secs = drift_secs
+        self.reset()
+
+    def reset(self):
+        self.notified = {}
+        self.generation = 0
+        # Wall/monotonic clock pair recorded with the last notified time block.
+        self._time_ref = (0.0, 0.0)
+
+    def _time_drift_only(self, old, new):
+        """True if the time block only moved by the passage of time."""
+        def _rest(block):
+            return {k: v for k, v in block.items() if k not in ("epoch", "iso")}
+        if _rest(old) != _rest(new):
+            return False
+        ref_epoch, ref_mono = self._time_ref
+        expected = ref_epoch + (time.monotonic() - ref_mono)
+        return abs((new.get("epoch") or 0) - expected) < self.drift_secs
+
+    def update(self, doc):
+        """Record `doc` as notified; return the blocks that changed (time-only
+        drift excluded), or [] if there is nothing worth a notification."""
+        changed = []
+        for block in self.blocks:
+            new = doc.get(block)
+            old = self.notified.get(block)
+            if new == old:
+                continue
+            if (block == "time" and isinstance(old, dict)
+                    and isinstance(new, dict) and self._time_drift_only(old, new)):
+                continue
+            changed.append(block)
+        if changed:
+            self.generation += 1
+            for block in changed:
+                self.notified[block] = doc.get(block)
+            if "time" in changed and isinstance(doc.get("time"), dict):
+                self._time_ref = (doc["time"].get("epoch") or 0,
+                                  time.monotonic())
+        return changed
+
+    def delta(self, doc, changed, limit=ATT_VALUE_MAX):
+        """JSON bytes of the `changed` blocks of `doc`. The first delta
+        carries every block, so it gets the same ATT ceiling treatment as the
+        full snapshot."""
+        delta = {"v": 1, "g": self.generation}
+        delta.update({block: doc.get(block) for block in changed})
+        return shrink_to_att(delta, limit)
+
+
+class StatusPublisher:
+    """Device-Status JSON for servers without their own refresh scheduler.
+
+    `read()` is what a read of the status characteristic returns. `run()`
+    keeps `value` current: it collects on `executor` (off the BLE loop) every
+    `active_secs` while `active()` says a central is listening, every
+    `idle_secs` otherwise, and immediately after `refresh()`, a watched source
+    changing or a read finding the value older than `active_secs`. `notify()`
+    is called on the loop thread when anything other than the clock changed.
+    """
+
+    def __init__(self, registry, notify, active=lambda: False,
+                 active_secs=NET_POLL_SECS, idle_secs=STATUS_IDLE_SECS):
+        self.registry = registry
+        self.notify = notify
+        self.active = active
+        self.active_secs = active_secs
+        self.idle_secs = idle_secs
+        self.value = bytearray(shrink_to_att({"v": 1}))
+        self._last = None
+        self._published = float("-inf")  # monotonic
+        self._collecting = False
+        self._wake = asyncio.Event()
+        if registry.on_change is None:
+            registry.on_change = lambda _blocks: self.refresh()
+
+    def refresh(self):
+        """Collect again now (loop thread)."""
+        self._wake.set()
+
+    def read(self):
+        """The cached value, for a read (loop thread). A stale one is still
+        served, and a fresh one collected for the next read."""
+        if (not self._collecting
+                and time.monotonic() - self._published >= self.active_secs):
+            self.refresh()
+        return self.value
+
+    def publish(self, doc):
+        self.value = bytearray(shrink_to_att(doc))
+        self._published = time.monotonic()
+        key = _without_clock(doc)
+        if key != self._last:
+            self._last = key
+            self.notify(self.value)
+
+    async def run(self, executor=None):
+        loop = asyncio.get_running_loop()
+        self.registry.start_watching(loop)
+        while True:
+            self._collecting = True
+            try:
+                self.publish(await loop.run_in_executor(
+                    executor, self.registry.collect))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("status refresh failed: %r", e)
+            finally:
+                self._collecting = False
+            try:
+                await asyncio.wait_for(
+                    self._wake.wait(),
+                    timeout=self.active_secs if self.active() else self.idle_secs)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._wake.clear()
+
+
+def bless_status_publisher(server, profile, iface, **kwargs):
+    """StatusPublisher for board profile `profile`, wired to a bless server's
+    Device-Status characteristic: notifies it on change, and refreshes at the
+    short cadence while any characteristic has a subscriber."""
+    def subscribed():
+        app = getattr(server, "app", None)
+        return bool(getattr(app, "subscribed_characteristics", None))
+
+    def notify(value):
+        ch = server.get_characteristic(DEVICE_STATUS_CHAR_UUID)
+        if ch is not None:
+            ch.value = value
+            server.update_value(DEVICE_STATUS_SERVICE_UUID,
+                                DEVICE_STATUS_CHAR_UUID)
+
+    registry = register_profile(StatusRegistry(), board_profile(profile), iface)
+    return StatusPublisher(registry, notify=notify, active=subscribed, **kwargs)
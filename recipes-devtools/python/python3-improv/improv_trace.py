@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Phase-level traces of Wi-Fi provisioning attempts for the Improv onboarding
+# servers.
+#
+# A ProvisionTrace is a list of spans - phase name, monotonic start and end,
+# outcome - for one attempt. The server opens a span around each step it runs
+# itself (profile lookup, the NetworkManager call, or nmcli delete/add/keyfile
+# patch/reload/up on the fallback path) and, on the D-Bus path, one per
+# NetworkManager device state the attempt passes through:
+#
+#   prepare     NM preparing the device
+#   config      association + WPA 4-way handshake (wpa_supplicant; NM does not
+#               split them)
+#   need_auth   NM asked for secrets, i.e. the PSK was rejected
+#   ip_config   DHCP (bounded by the profile's ipv4.dhcp-timeout)
+#   ip_check    connectivity / dispatcher checks
+#
+# Finished attempts go to a TraceRing: the last IMPROV_TRACE_RING records, kept
+# as JSON lines under IMPROV_TRACE_DIR so they survive a restart, and a compact
+# summary (per-phase p50/max/failures over the ring plus the last attempt) that
+# the servers expose on a read-only diagnostics characteristic for fleet-wide
+# aggregation.
+#
+# Environment:
+#   IMPROV_TRACE_DIR   directory of the ring file (default /var/lib/improv;
+#                      empty keeps traces in memory only)
+#   IMPROV_TRACE_RING  attempts kept (default 32)
+#
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACE_DIR = os.getenv("IMPROV_TRACE_DIR", "/var/lib/improv")
+TRACE_RING = int(os.getenv("IMPROV_TRACE_RING", "32"))
+TRACE_FILE = "provision-traces.jsonl"
+# One ATT value (see improv_status.ATT_VALUE_MAX).
+SUMMARY_MAX = 512
+
+# NetworkManager device state (NMDeviceState) -> phase name.
+NM_DEVICE_PHASES = {
+    40: "prepare",
+    50: "config",
+    60: "need_auth",
+    70: "ip_config",
+    80: "ip_check",
+    90: "secondaries",
+    110: "deactivate",
+}
+
+_TIMEOUTS = (TimeoutError, asyncio.TimeoutError, subprocess.TimeoutExpired)
+
+
+class ProvisionTrace:
+    """Spans of one provisioning attempt, on the monotonic clock.
+
+    `span()` wraps a step the caller runs; `begin()` / `end()` mark phases
+    driven by signals, where only the transitions are seen. Only one span is
+    open at a time: beginning a new one ends the previous one.
+    """
+
+    def __init__(self, path):
+        self.path = path  # "dbus" / "nmcli"
+        self.t0 = time.monotonic()
+        self.wall = time.time()
+        self.spans = []  # [name, start, end, outcome]
+        self.ok = None
+        self.error = None
+        self.total = None
+        self._open = None
+
+    def begin(self, name):
+        self.end()
+        self._open = [name, time.monotonic(), None, None]
+
+    def end(self, outcome="ok"):
+        if self._open is not None:
+            self._open[2] = time.monotonic()
+            self._open[3] = outcome
+            self.spans.append(self._open)
+            self._open = None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        self.begin(name)
+        try:
+            yield
+        except _TIMEOUTS:
+            self.end("timeout")
+            raise
+        except BaseException:
+            self.end("fail")
+            raise
+        self.end()
+
+    def finish(self, ok, error=None):
+        """Close the attempt; later spans (from a job that outlived its
+        timeout) are not recorded."""
+        self.end("ok" if ok else "fail")
+        self.ok = bool(ok)
+        self.error = error if not ok else None
+        self.total = time.monotonic() - self.t0
+        return self.record()
+
+    def record(self):
+        def ms(t):
+            return round((t - self.t0) * 1000)
+
+        return {
+            "v": 1,
+            "at": int(self.wall),
+            "path": self.path,
+            "ok": self.ok,
+            "err": self.error,
+            "ms": round((self.total or 0) * 1000),
+            "spans": [[name, ms(start), ms(end) - ms(start), outcome]
+                      for name, start, end, outcome in self.spans],
+        }
+
+    def describe(self):
+        """One-line phase breakdown for the journal."""
+        return ", ".join(f"{name} {(end - start) * 1000:.0f} ms"
+                         + ("" if outcome == "ok" else f" ({outcome})")
+                         for name, start, end, outcome in self.spans)
+
+
+class TraceRing:
+    """The last `size` attempt records, persisted as JSON lines.
+
+    Construction reads the file and `add()` rewrites it (write + rename), so
+    both block: the servers run them off the BLE loop.
+    """
+
+    def __init__(self, directory=TRACE_DIR, size=TRACE_RING):
+        self.path = os.path.join(directory, TRACE_FILE) if directory else None
+        self.records = collections.deque(maxlen=max(1, size))
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        pass  # torn write of an older version; skip
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"provisioning traces unreadable: {e}")
+
+    def add(self, record):
+        self.records.append(record)
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                for r in self.records:
+                    f.write(json.dumps(r, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"could not save provisioning trace: {e}")
+
+    def summary(self, limit=SUMMARY_MAX):
+        """Compact JSON for the diagnostics characteristic:
+
+          {"v":1, "n": attempts, "ok": succeeded,
+           "ph": {phase: [p50_ms, max_ms, failures]},
+           "last": {"at", "path", "ok", "err", "ms", "sp": [[phase, ms, outcome]]}}
+        """
+        phases = {}
+        for r in self.records:
+            for name, _start, dur, outcome in r.get("spans", ()):
+                p = phases.setdefault(name, [[], 0])
+                p[0].append(dur)
+                p[1] += outcome != "ok"
+        doc = {
+            "v": 1,
+            "n": len(self.records),
+            "ok": sum(1 for r in self.records if r.get("ok")),
+            "ph": {name: [sorted(d)[len(d) // 2], max(d), fails]
+                   for name, (d, fails) in phases.items()},
+        }
+        if self.records:
+            last = self.records[-1]
+            doc["last"] = {
+                "at": last.get("at"), "path": last.get("path"),
+                "ok": last.get("ok"), "err": last.get("err"),
+                "ms": last.get("ms"),
+                "sp": [[name, dur, outcome]
+                       for name, _start, dur, outcome in last.get("spans", ())],
+            }
+        data = json.dumps(doc, separators=(",", ":")).encode()
+        if len(data) > limit and "last" in doc:
+            doc["last"].pop("sp")
+            data = json.dumps(doc, separators=(",", ":")).encode()
+        if len(data) > limit:
+            doc.pop("last", None)
+            data = json.dumps(doc, separators=(",", ":")).encode()
+        return data
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Warm restarts of the Improv onboarding servers.
+#
+# improv.service restarts the server whenever it exits, including on purpose:
+# the advertising watchdog exits when BlueZ stops answering. Each restart used
+# to start cold, with placeholder Device-Status, Device Information values
+# read only after the advertisement is up, and the Improv state back at
+# AUTHORIZED. WarmState keeps what a restart needs in a small JSON file under
+# /run: the last Device-Status document, the identity values and the
+# provisioning outcome. The file is rewritten whenever one of them changes
+# (tmpfs, so no fsync) and read back at start. The service preserves the
+# directory across restarts (RuntimeDirectoryPreserve=restart) and a reboot
+# clears it. A file written by another server version, in an earlier boot or
+# more than IMPROV_WARM_MAX_AGE_SECS ago is ignored.
+#
+# Notifier speaks systemd's notify protocol (sd_notify(3)) without
+# libsystemd. It sends READY=1 once the board is discoverable (Type=notify)
+# and STATUS= lines. While the server reports itself healthy it also sends
+# WATCHDOG=1 at half the WatchdogSec= interval.
+#
+# Environment:
+#   IMPROV_WARM_STATE          state file (default /run/improv/warm-state.json;
+#                              empty disables warm restarts)
+#   IMPROV_WARM_MAX_AGE_SECS   age beyond which the file is ignored (3600)
+#   NOTIFY_SOCKET, WATCHDOG_USEC, WATCHDOG_PID   set by systemd
+#
+
+import json
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+WARM_STATE = os.getenv("IMPROV_WARM_STATE", "/run/improv/warm-state.json")
+WARM_MAX_AGE_SECS = float(os.getenv("IMPROV_WARM_MAX_AGE_SECS", "3600"))
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+
+def _boot_id():
+    try:
+        with open(BOOT_ID) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class WarmState:
+    """Sections of server state ({name: JSON-able value}) carried across a
+    restart. `load()` returns what the previous process saved, or {}; `save()`
+    writes only when something changed. Both block briefly (a tmpfs file)."""
+
+    def __init__(self, version, path=WARM_STATE, max_age=WARM_MAX_AGE_SECS):
+        self.version = version
+        self.path = path or None
+        self.max_age = max_age
+        self.age = None  # seconds since the loaded state was saved
+        self.saves = 0
+        self._written = None
+
+    def load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                doc = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"warm state unreadable, starting cold: {e}")
+            return {}
+        if not isinstance(doc, dict):
+            return {}
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - (doc.get("at") or 0)
+        if doc.get("version") != self.version:
+            why = f"saved by server {doc.get('version')!r}"
+        elif doc.get("boot") != _boot_id():
+            why = "saved in an earlier boot"
+        elif not 0 <= age <= self.max_age:
+            why = f"{age:.0f} s old"
+        else:
+            self.age = age
+            return doc.get("state") or {}
+        logger.info(f"warm state ignored ({why}); starting cold")
+        return {}
+
+    def save(self, state):
+        if self.path is None:
+            return False
+        try:
+            body = json.dumps(state, sort_keys=True, separators=(",", ":"))
+        except (TypeError, ValueError) as e:
+            logger.debug(f"warm state not serialisable: {e}")
+            return False
+        if body == self._written:
+            return False
+        doc = json.dumps({"version": self.version, "boot": _boot_id(),
+                          "at": time.clock_gettime(time.CLOCK_BOOTTIME),
+                          "state": state}, separators=(",", ":"))
+        tmp = self.path + ".tmp"
+        try:
+            # Owner-only: the provisioning outcome carries the claim URL.
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as f:
+                f.write(doc)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.debug(f"could not save warm state: {e}")
+            return False
+        self._written = body
+        self.saves += 1
+        return True
+
+
+class Notifier:
+    """sd_notify(3) over $NOTIFY_SOCKET; every call is a no-op outside
+    systemd (or under a unit without Type=notify / WatchdogSec=)."""
+
+    def __init__(self, environ=os.environ):
+        self.address = environ.get("NOTIFY_SOCKET") or None
+        if self.address and self.address.startswith("@"):
+            self.address = "\0" + self.address[1:]  # abstract namespace
+        usec = environ.get("WATCHDOG_USEC")
+        pid = environ.get("WATCHDOG_PID")
+        self.watchdog_usec = None
+        if usec and usec.isdigit() and int(usec) > 0 and (
+                not pid or pid == str(os.getpid())):
+            self.watchdog_usec = int(usec)
+        self.sent = {}  # first word of each message -> count
+        self._sock = None
+
+    def watchdog_interval(self):
+        """Seconds between WATCHDOG=1 keep-alives (half the timeout), or None
+        if systemd is not watching."""
+        if self.address is None or self.watchdog_usec is None:
+            return None
+        return self.watchdog_usec / 2e6
+
+    def notify(self, *assignments):
+        if self.address is None:
+            return False
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX,
+                                           socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+            self._sock.sendto("\n".join(assignments).encode(), self.address)
+        except OSError as e:
+            logger.debug(f"sd_notify {assignments[0]!r} failed: {e}")
+            return False
+        key = assignments[0].split("=", 1)[0]
+        self.sent[key] = self.sent.get(key, 0) + 1
+        return True
+
+    def ready(self, status):
+        return self.notify("READY=1", f"STATUS={status}")
+
+    def status(self, status):
+        return self.notify(f"STATUS={status}")
+
+    def watchdog(self):
+        return self.notify("WATCHDOG=1")
+
+    def stopping(self, status):
+        return self.notify("STOPPING=1", f"STATUS={status}")
@@ -24,9 +24,23 @@ import subprocess
 import os
 import re
 
-logging.basicConfig(level=logging.DEBUG)
+# The improv_*.py helper modules are installed next to this script (in
+# /usr/share/improv) by python3-improv_git.bb.
+
+# Queue-backed, rate-limited logging: formatting and journal I/O happen off
+# the BLE loop. IMPROV_LOG_LEVEL sets the level (default INFO). Plain
+# basicConfig if the helper is missing.
+try:
+    import improv_logging
+    improv_logging.setup()
+except ImportError:  # pragma: no cover - depends on the image
+    logging.basicConfig(level=os.getenv("IMPROV_LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(name=__name__)
 
+# Device-Status providers, cache and refresh loop shared by all the onboarding
+# servers.
+import improv_status
+
 # NOTE: Some systems require different synchronization methods.
 trigger: Union[asyncio.Event, threading.Event]
 if sys.platform in ["darwin", "win32"]:
@@ -34,9 +48,6 @@ if sys.platform in ["darwin", "win32"]:
 else:
     trigger = asyncio.Event()
 
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(name=__name__)
-
 
 def build_gatt():
     gatt: Dict = {
@@ -69,7 +80,14 @@ def build_gatt():
                 "Properties": (GATTCharacteristicProperties.read),
                 "Permissions": (GATTAttributePermissions.readable)
             },
-        }
+        },
+        NET_STATUS_SERVICE_UUID: {
+            NET_STATUS_CHAR_UUID: {
+                "Properties": (GATTCharacteristicProperties.read |
+                               GATTCharacteristicProperties.notify),
+                "Permissions": (GATTAttributePermissions.readable)
+            },
+        },
     }
     return gatt
 
@@ -87,7 +105,11 @@ SERVER_HOST = os.getenv("IMPROV_SERVER_HOST", "api.co.uk")
 SERVICE_NAME = os.getenv("IMPROV_SERVICE_NAME", "Improv-Inst")
 CON_NAME = os.getenv("IMPROV_CONNECTION_NAME", "improv-inst")
 INTERFACE = os.getenv("IMPROV_WIFI_INTERFACE", "wlan0")
+# Association bound for one attempt, in milliseconds; DHCP then has
+# NetworkManager's default ipv4.dhcp-timeout (45 s, the profile sets none).
 TIMEOUT = int(os.getenv("IMPROV_CONNECTION_TIMEOUT", "10000"))
+# `nmcli connection up --wait` takes seconds and covers both.
+NMCLI_UP_WAIT_SECS = (TIMEOUT + 999) // 1000 + 45
 
 # Use new_event_loop() or get_event_loop() depending on Python version
 # get_event_loop() is deprecated in Python 3.10+ but still works
@@ -99,6 +121,16 @@ except RuntimeError:
     asyncio.set_event_loop(loop)
 server = BlessServer(name=SERVICE_NAME, loop=loop)
 
+# --- Device-Status (Dynamic Devices vendor Network Status service) ------------
+# Same service/characteristic UUIDs as the other boards. The document is
+# collected by improv_status off the BLE event loop and reads are served from
+# the cached JSON, so a read never forks nmcli (see StatusPublisher for the
+# cadence).
+NET_STATUS_SERVICE_UUID = improv_status.DEVICE_STATUS_SERVICE_UUID
+NET_STATUS_CHAR_UUID = improv_status.DEVICE_STATUS_CHAR_UUID
+status = improv_status.bless_status_publisher(
+    server, os.getenv("IMPROV_BOARD_PROFILE", "imx8mm-jaguar-inst"), INTERFACE)
+
 def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
     logger.warning(
         f"Creating Improv WiFi connection for '{ssid.decode('utf-8')}' with password: '{passwd.decode('utf-8')}'")
@@ -181,7 +213,7 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
         logger.debug(f"Could not verify connection file: {e}")
 
     try:
-      nmcli.connection.up(f"{CON_NAME}", TIMEOUT)
+      nmcli.connection.up(f"{CON_NAME}", NMCLI_UP_WAIT_SECS)
     except:
       print(f'Error bringing connection {CON_NAME} up')
       return None
@@ -207,18 +239,87 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
 improv_server = ImprovProtocol(wifi_connect_callback=wifi_connect,
                                max_response_bytes=200)
 
+# --- Asynchronous provisioning ------------------------------------------------
+# wifi_connect blocks for seconds (nmcli delete/add/reload, then `connection
+# up` waiting for association + DHCP). pyImprov would call it inline from
+# handle_write, on the event loop that also serves BlueZ, so WIFI_SETTINGS is
+# intercepted here and wifi_connect runs on an executor thread while the loop
+# keeps serving. Improv STATUS is notified as it moves
+# PROVISIONING -> PROVISIONED (or back to AUTHORIZED + ERROR on failure).
+_provision_task: Optional[asyncio.Task] = None
+
+def _notify_improv(target_uuid: str, values):
+    """Set an Improv characteristic to each value in turn and notify it."""
+    if isinstance(values, (bytes, bytearray)):
+        values = [values]
+    for value in values:
+        logger.debug("Setting %s to %s", target_uuid, value)
+        server.get_characteristic(target_uuid).value = value
+        success = server.update_value(ImprovUUID.SERVICE_UUID.value, target_uuid)
+        if not success:
+            logger.warning(f"Updating characteristic return status={success}")
+
+def _notify_improv_state():
+    _notify_improv(ImprovUUID.STATUS_UUID.value,
+                   bytearray(improv_server.state.value.to_bytes(1, "little")))
+
+def _notify_improv_error(error: ImprovError):
+    improv_server.last_error = error
+    _notify_improv(ImprovUUID.ERROR_UUID.value,
+                   bytearray(error.value.to_bytes(1, "little")))
+
+async def _provision(ssid: bytearray, passwd: bytearray):
+    try:
+        urls = await loop.run_in_executor(None, wifi_connect, ssid, passwd)
+    except Exception as e:
+        logger.error(f"provisioning failed: {e!r}", exc_info=True)
+        urls = None
+    if urls is not None:
+        improv_server.state = ImprovState.PROVISIONED
+        improv_server.rpc_response = improv_server.build_rpc_response(
+            ImprovCommand.WIFI_SETTINGS, urls)
+        _notify_improv(ImprovUUID.RPC_RESULT_UUID.value, improv_server.rpc_response)
+    else:
+        improv_server.state = ImprovState.AUTHORIZED
+        _notify_improv_error(ImprovError.UNABLE_TO_CONNECT)
+    _notify_improv_state()
+    # Provisioning may have changed the link; don't wait for the timer.
+    status.refresh()
+
+def _start_provisioning(value: bytearray):
+    """Validate a WIFI_SETTINGS RPC and start it as a background task."""
+    global _provision_task
+    improv_server.last_error = ImprovError.NONE
+    parsed = improv_server.parse_improv_data(value)
+    if parsed[0] == ImprovCommand.BAD_CHECKSUM or len(parsed) < 3:
+        _notify_improv_error(ImprovError.INVALID_RPC)
+        return
+    if improv_server.state.value < ImprovState.AUTHORIZED.value:
+        _notify_improv_error(ImprovError.NOT_AUTHORIZED)
+        return
+    if _provision_task is not None and not _provision_task.done():
+        # Clients retry writes; one attempt at a time against NetworkManager.
+        logger.warning("provisioning already in progress; ignoring WIFI_SETTINGS")
+        return
+    improv_server.state = ImprovState.PROVISIONING
+    _notify_improv_state()
+    _provision_task = loop.create_task(_provision(parsed[1], parsed[2]))
+
 def read_request(
         characteristic: BlessGATTCharacteristic,
         **kwargs
 ) -> bytearray:
     try:
         improv_char = ImprovUUID(characteristic.uuid)
-        logger.info(f"Reading {improv_char} : {characteristic}")
+        logger.debug("Reading %s : %s", improv_char, characteristic)
     except Exception:
-        logger.info(f"Reading {characteristic.uuid}")
+        logger.debug("Reading %s", characteristic.uuid)
         pass
     if characteristic.service_uuid == ImprovUUID.SERVICE_UUID.value:
         return improv_server.handle_read(characteristic.uuid)
+    if characteristic.uuid == NET_STATUS_CHAR_UUID:
+        # The cached document; a fresh one for the next read if it is stale.
+        return status.read()
     return characteristic.value
 
 
@@ -229,22 +330,14 @@ def write_request(
 ):
 
     if characteristic.service_uuid == ImprovUUID.SERVICE_UUID.value:
+        if (characteristic.uuid == ImprovUUID.RPC_COMMAND_UUID.value and value
+                and value[0] == ImprovCommand.WIFI_SETTINGS.value):
+            _start_provisioning(value)
+            return
         (target_uuid, target_values) = improv_server.handle_write(
             characteristic.uuid, value)
         if target_uuid != None and target_values != None:
-            for value in target_values:
-                logger.debug(
-                    f"Setting {ImprovUUID(target_uuid)} to {value}")
-                server.get_characteristic(
-                    target_uuid,
-                ).value = value
-                success = server.update_value(
-                    ImprovUUID.SERVICE_UUID.value,
-                    target_uuid
-                )
-                if not success:
-                    logger.warning(
-                        f"Updating characteristic return status={success}")
+            _notify_improv(target_uuid, target_values)
 
 async def run(loop):
 
@@ -263,6 +356,7 @@ async def run(loop):
     await server.start()
 
     logger.info("Server started")
+    status_task = loop.create_task(status.run())
 
     try:
         trigger.clear()
@@ -273,6 +367,11 @@ async def run(loop):
     except KeyboardInterrupt:
         logger.debug("Shutting Down")
         pass
+    status_task.cancel()
+    try:
+        await status_task
+    except asyncio.CancelledError:
+        pass
     await server.stop()
 
 # Actually start the server
@@ -5,6 +5,13 @@
 # Based on onboarding-server.py but with board-specific customizations
 #
 
+import time
+
+# Cold-start profile: CLOCK_BOOTTIME stamps of each startup milestone, recorded
+# by _startup_mark() and logged once the board is discoverable. Taken before the
+# imports below so their cost shows up in the profile.
+_startup_marks = {"script": time.clock_gettime(time.CLOCK_BOOTTIME)}
+
 from improv import *
 from bless import (  # type: ignore
     BlessServer,
@@ -13,25 +20,120 @@ from bless import (  # type: ignore
     GATTAttributePermissions
 )
 from bless.backends.bluezdbus.server import BlessServerBlueZDBus
-from typing import Any, Dict, Union, Optional
+from typing import Dict, Union, Optional
 import sys
 import threading
 import asyncio
 import logging
 import uuid
-import nmcli
 import os
 import re
 import subprocess
 import json
-import socket
-import struct
-import fcntl
-import time
-
-logging.basicConfig(level=logging.DEBUG)
+import hashlib
+import hmac
+import bisect
+import resource
+import traceback
+
+# dbus-fast drives the event-driven NetworkManager monitor. It is optional: if it
+# is missing we fall back to the original nmcli polling, so onboarding still works.
+# Nothing needs it until advertising is up, so it is imported by _load_dbus_fast()
+# rather than here, keeping it off the time-to-first-advertisement path.
+MessageBus = BusType = Message = MessageType = Variant = None
+
+# The improv_*.py helper modules are installed next to this script (in
+# /usr/share/improv) by python3-improv_git.bb.
+
+# Queue-backed, rate-limited logging: formatting and journal I/O happen off
+# the BLE loop. IMPROV_LOG_LEVEL sets the level (default INFO). Plain
+# basicConfig if the helper is missing.
+try:
+    import improv_logging
+except ImportError:  # pragma: no cover - depends on the image
+    improv_logging = None
+
+# Device-Status providers, cache and inotify invalidation shared by all the
+# onboarding servers.
+import improv_status
+# Bounded, prioritised worker pool for the blocking work: provisioning first,
+# status next, diagnostics last.
+import improv_jobs
+# Per-phase traces of provisioning attempts, persisted as a small ring.
+import improv_trace
+# Ranked, deduplicated Wi-Fi scan results for GET_WIFI_NETWORKS.
+import improv_scan
+# Controller advertising state from the HCI monitor channel, so the watchdog
+# only bounces an advertisement that is really off the air.
+import improv_hci
+# Offset-aware long reads over generation-versioned snapshots, answered on
+# bless's D-Bus connection.
+import improv_longread
+# Warm-restart state kept under /run and the systemd notify protocol.
+import improv_warm
+
+if improv_logging is not None:
+    improv_logging.setup()
+else:
+    logging.basicConfig(level=os.getenv("IMPROV_LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(name=__name__)
 
+_startup_marks["imports"] = time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+def _load_dbus_fast():
+    """Import dbus-fast on first use. Returns False if it is not installed."""
+    global MessageBus, BusType, Message, MessageType, Variant
+    if MessageBus is None:
+        try:
+            from dbus_fast import BusType, Message, MessageType, Variant
+            from dbus_fast.aio import MessageBus
+        except ImportError:  # pragma: no cover - depends on the image
+            return False
+    return True
+
+
+def _nmcli():
+    """nmcli, imported on first use: only the polling fallback and provisioning
+    need it, never the path to the first advertisement."""
+    import nmcli
+    return nmcli
+
+
+def _process_start_boottime():
+    """CLOCK_BOOTTIME (s) at which this process was exec'd, from /proc/self/stat."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 (starttime, clock ticks since boot); comm may contain
+            # spaces, so split after its closing parenthesis.
+            fields = f.read().rsplit(")", 1)[1].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+def _startup_mark(name):
+    """Record a cold-start milestone (first occurrence only). The profile so
+    far is logged when the board starts advertising and when the first
+    Device-Status snapshot is published."""
+    if name in _startup_marks:
+        return
+    _startup_marks[name] = time.clock_gettime(time.CLOCK_BOOTTIME)
+    if name not in ("advertising", "status_ready"):
+        return
+    base, profile = _startup_profile()
+    steps = ", ".join(f"{k} +{ms} ms" for k, ms in profile.items())
+    kind = "warm" if "warm_restored" in _startup_marks else "cold"
+    logger.info(f"{kind} start: exec at {base:.2f}s after boot; {steps}")
+
+
+def _startup_profile():
+    """(exec time after boot in s, {milestone: ms since exec})."""
+    exec_t = _process_start_boottime()
+    base = exec_t if exec_t is not None else _startup_marks["script"]
+    return base, {k: round((v - base) * 1000)
+                  for k, v in _startup_marks.items()}
+
 # Version of this onboarding server; exposed as DIS Software Revision (0x2A28).
 __version__ = "1.1.0"
 
@@ -51,6 +153,18 @@ DIS_SW_REV_UUID = "00002a28-0000-1000-8000-00805f9b34fb"
 # network-status characteristic ...-0002 (room for future characteristics).
 NET_STATUS_SERVICE_UUID = "e5f10001-9d3a-4b7c-8a21-6f2c9b4d7e10"
 NET_STATUS_CHAR_UUID = "e5f10002-9d3a-4b7c-8a21-6f2c9b4d7e10"
+# Same Device-Status document in a compact CBOR encoding (integer keys, enums);
+# see improv_status.encode_device_status_cbor. Read + notify, alongside the
+# JSON form.
+NET_STATUS_CBOR_CHAR_UUID = "e5f10003-9d3a-4b7c-8a21-6f2c9b4d7e10"
+# Block-level patches: notifies only the Device-Status blocks that changed since
+# the last notification (see _publish_net_status). The full snapshot on
+# ...-0002/-0003 stays the resync point.
+NET_STATUS_DELTA_CHAR_UUID = "e5f10004-9d3a-4b7c-8a21-6f2c9b4d7e10"
+# Provisioning trace summary (improv_trace.TraceRing.summary): where recent
+# onboarding attempts spent their time, per phase. Read + notify after each
+# attempt.
+TRACE_SUMMARY_CHAR_UUID = "e5f10005-9d3a-4b7c-8a21-6f2c9b4d7e10"
 
 trigger: Union[asyncio.Event, threading.Event]
 if sys.platform in ["darwin", "win32"]:
@@ -112,13 +226,30 @@ def build_gatt():
         DIS_SW_REV_UUID: _ro(),
     }
 
-    # Vendor Network Status service, read + notify, carrying a JSON snapshot.
+    # Vendor Network Status service, read + notify, carrying a JSON snapshot,
+    # the same document CBOR-encoded, block-level delta notifications and the
+    # provisioning trace summary.
     gatt[NET_STATUS_SERVICE_UUID] = {
         NET_STATUS_CHAR_UUID: {
             "Properties": (GATTCharacteristicProperties.read |
                            GATTCharacteristicProperties.notify),
             "Permissions": GATTAttributePermissions.readable,
         },
+        NET_STATUS_CBOR_CHAR_UUID: {
+            "Properties": (GATTCharacteristicProperties.read |
+                           GATTCharacteristicProperties.notify),
+            "Permissions": GATTAttributePermissions.readable,
+        },
+        NET_STATUS_DELTA_CHAR_UUID: {
+            "Properties": (GATTCharacteristicProperties.read |
+                           GATTCharacteristicProperties.notify),
+            "Permissions": GATTAttributePermissions.readable,
+        },
+        TRACE_SUMMARY_CHAR_UUID: {
+            "Properties": (GATTCharacteristicProperties.read |
+                           GATTCharacteristicProperties.notify),
+            "Permissions": GATTAttributePermissions.readable,
+        },
     }
     return gatt
 
@@ -131,36 +262,26 @@ def build_gatt():
 The device MUST advertise the Service UUID.
 """
 
-def get_board_id():
-    """Get unique board ID from SOC serial number."""
+def read_soc_identity():
+    """(board ID, full SoC serial) from a single read of the SoC serial number.
+
+    The board ID is the last four hex digits (used in the advertised name); the
+    full serial, hex-only and uppercased, is the DIS Serial Number.
+    """
     try:
         soc_serial_path = "/sys/devices/soc0/serial_number"
-        if os.path.exists(soc_serial_path):
-            with open(soc_serial_path, 'r') as f:
-                serial = f.read().strip()
-                serial_clean = re.sub(r'[^0-9a-fA-F]', '', serial)
-                if len(serial_clean) >= 4:
-                    board_id = serial_clean[-4:].upper()
-                    logger.info(f"Board ID from SOC serial: {board_id}")
-                    return board_id
+        with open(soc_serial_path, 'r') as f:
+            serial = re.sub(r'[^0-9a-fA-F]', '', f.read().strip()).upper()
+        if len(serial) >= 4:
+            logger.info(f"Board ID from SOC serial: {serial[-4:]}")
+            return serial[-4:], serial
+        logger.warning("SOC serial number too short, using default board ID")
+        return "0000", serial or "UNKNOWN"
+    except FileNotFoundError:
         logger.warning("SOC serial number not found, using default board ID")
     except Exception as e:
         logger.error(f"Error reading board ID: {e}")
-    return "0000"
-
-
-def get_soc_serial():
-    """Get the full SoC unique serial (hex, uppercased) for DIS Serial Number."""
-    try:
-        soc_serial_path = "/sys/devices/soc0/serial_number"
-        if os.path.exists(soc_serial_path):
-            with open(soc_serial_path, 'r') as f:
-                serial = re.sub(r'[^0-9a-fA-F]', '', f.read().strip()).upper()
-                if serial:
-                    return serial
-    except Exception as e:
-        logger.error(f"Error reading SoC serial: {e}")
-    return "UNKNOWN"
+    return "0000", "UNKNOWN"
 
 
 def get_board_model():
@@ -178,21 +299,12 @@ def get_board_model():
 
 
 def get_fw_revision():
-    """Firmware/OS revision parsed from /etc/os-release."""
-    try:
-        data = {}
-        with open("/etc/os-release") as f:
-            for line in f:
-                if "=" in line:
-                    k, v = line.rstrip("\n").split("=", 1)
-                    data[k] = v.strip().strip('"')
-        for key in ("IMAGE_VERSION", "BUILD_ID", "VERSION_ID", "VERSION"):
-            if data.get(key):
-                return data[key]
-        if data.get("PRETTY_NAME"):
-            return data["PRETTY_NAME"]
-    except Exception as e:
-        logger.debug(f"Error reading firmware revision: {e}")
+    """Firmware/OS revision from /etc/os-release (shared, cached parse)."""
+    data = improv_status.get_os_release(_status)
+    for key in ("IMAGE_VERSION", "BUILD_ID", "VERSION_ID", "VERSION",
+                "PRETTY_NAME"):
+        if data.get(key):
+            return data[key]
     return "unknown"
 
 
@@ -207,16 +319,32 @@ def get_hw_revision():
 SERVER_HOST = os.getenv(
     "IMPROV_SERVER_HOST", "active-esl-onboard.active-esl.workers.dev"
 )
-BOARD_ID = get_board_id()
+# The serial is the only identity needed before advertising (it names the
+# device); everything else in DIS is read after the advert is up.
+BOARD_ID, SOC_SERIAL = read_soc_identity()
 DEFAULT_SERVICE_NAME = f"eink-{BOARD_ID}"
 SERVICE_NAME = os.getenv("IMPROV_SERVICE_NAME", DEFAULT_SERVICE_NAME)
 CON_NAME = os.getenv("IMPROV_CONNECTION_NAME", "improv-eink")
+# NetworkManager keyfile directory (wifi_connect patches psk-flags=0 into the
+# profile there). Overridable so off-target runs never touch the host's NM.
+NM_CONNECTIONS_DIR = os.getenv("IMPROV_NM_CONNECTIONS_DIR",
+                               "/etc/NetworkManager/system-connections")
 INTERFACE = os.getenv("IMPROV_WIFI_INTERFACE", "wlan0")
+# Association bound for one attempt, in milliseconds; DHCP then has the
+# profile's ipv4.dhcp-timeout (seconds) on top.
 TIMEOUT = int(os.getenv("IMPROV_CONNECTION_TIMEOUT", "10000"))
-# How often the advertising watchdog re-checks that BlueZ is still advertising
-# and re-registers it if not. Kept short so a dropped advert self-heals within
-# seconds — onboarding must never depend on a manual service restart.
+DHCP_TIMEOUT_SECS = 60
+# `nmcli connection up --wait` takes seconds and covers both.
+NMCLI_UP_WAIT_SECS = (TIMEOUT + 999) // 1000 + DHCP_TIMEOUT_SECS
+# The advertising watchdog reacts to BlueZ's PropertiesChanged signals
+# (LEAdvertisingManager1.ActiveInstances, Device1.Connected), so a dropped
+# advert is re-registered as soon as BlueZ reports it. Polling is left as a
+# liveness probe - the one thing a signal cannot report is a bluetoothd that
+# stopped answering: every ADVERT_PROBE_SECS while the signals are live, every
+# ADVERT_WATCHDOG_SECS when they cannot be subscribed and right after a failed
+# probe, so a wedged stack is still detected within a few checks.
 ADVERT_WATCHDOG_SECS = int(os.getenv("IMPROV_ADVERT_WATCHDOG_SECS", "15"))
+ADVERT_PROBE_SECS = int(os.getenv("IMPROV_ADVERT_PROBE_SECS", "60"))
 # Hard timeout on each BlueZ D-Bus call the watchdog makes, so a wedged BLE
 # stack can never freeze the watchdog loop itself.
 ADVERT_DBUS_TIMEOUT = float(os.getenv("IMPROV_ADVERT_DBUS_TIMEOUT", "5"))
@@ -235,21 +363,73 @@ ADVERT_MAX_FAILURES = int(os.getenv("IMPROV_ADVERT_MAX_FAILURES", "3"))
 # short so onboarding recovers within ~a minute without a restart. A bounce is
 # a sub-second re-register gap and is skipped whenever a central is mid-session.
 ADVERT_BOUNCE_SECS = int(os.getenv("IMPROV_ADVERT_BOUNCE_SECS", "60"))
+# With the on-air check (IMPROV_ADVERT_VERIFY=1, the default) the watchdog reads
+# the controller's HCI traffic from the kernel's monitor channel, as btmon
+# does, and the bounce above only happens when the advertisement is really off
+# the air: not enabled on the controller for ADVERT_VERIFY_GRACE_SECS with no
+# central connected (BlueZ re-enables it within milliseconds of a disconnect).
+# Until the first advertising command has been seen, or if the monitor cannot
+# be opened, bounces stay blind. IMPROV_HCI_MONITOR_SOCKET reads a replayed
+# stream from a Unix socket instead (off-target tests).
+ADVERT_VERIFY = os.getenv("IMPROV_ADVERT_VERIFY", "1") == "1"
+ADVERT_VERIFY_GRACE_SECS = float(os.getenv("IMPROV_ADVERT_VERIFY_GRACE_SECS",
+                                           "5"))
+HCI_MONITOR_SOCKET = os.getenv("IMPROV_HCI_MONITOR_SOCKET", "")
+# Connectionless status (IMPROV_ADVERT_STATUS=1, the default): the Improv
+# service data in the advertisement carries a packed Device-Status summary -
+# provisioned, link state, RSSI bucket, firmware build; see
+# improv_status.pack_advert_summary - updated in place whenever it changes, so
+# the app and fleet scanners can triage boards without a GATT connection. It
+# is only added while the legacy advertisement stays within 31 bytes (flags and
+# the Improv UUID leave exactly the 10 it takes). Extended advertising and the
+# ScanResponse* properties are experimental in BlueZ (bluetoothd -E), which
+# this layer does not enable, so the legacy payload is what every phone sees.
+ADVERT_STATUS = os.getenv("IMPROV_ADVERT_STATUS", "1") == "1"
+# Device-Status refresh cadence, chosen per cycle by RefreshScheduler from the
+# BLE session state. NM signals (while the D-Bus monitor is live), inotify and a
+# new subscription trigger an immediate refresh regardless.
+#  - active (a central is subscribed, connected, or did GATT I/O within
+#    REFRESH_ACTIVE_HOLD_SECS): every NET_POLL_SECS, for live RSSI/time.
+#  - idle: nobody is looking, so back off exponentially from
+#    REFRESH_IDLE_MIN_SECS to REFRESH_IDLE_MAX_SECS.
+#  - provisioned (Improv PROVISIONED or Wi-Fi connected) and idle: the job is
+#    done; refresh only every REFRESH_PROVISIONED_SECS.
+#  - polling: whenever the NM monitor is not live (no dbus-fast, NM not up
+#    yet), nothing else reports a network change, so nmcli is polled every
+#    NET_POLL_SECS whatever the session state, and the monitor retries as often.
+NET_POLL_SECS = int(os.getenv("IMPROV_NET_POLL_SECS", "5"))
+REFRESH_ACTIVE_HOLD_SECS = int(os.getenv("IMPROV_REFRESH_ACTIVE_HOLD_SECS", "30"))
+REFRESH_IDLE_MIN_SECS = int(os.getenv("IMPROV_REFRESH_IDLE_MIN_SECS", "30"))
+REFRESH_IDLE_MAX_SECS = int(os.getenv("IMPROV_REFRESH_IDLE_MAX_SECS", "900"))
+REFRESH_PROVISIONED_SECS = int(os.getenv("IMPROV_REFRESH_PROVISIONED_SECS", "3600"))
+# Hard timeout on each NetworkManager D-Bus call made by the monitor.
+NM_DBUS_TIMEOUT = float(os.getenv("IMPROV_NM_DBUS_TIMEOUT", "5"))
+# Size at which the Device-Status JSON (and a delta) starts dropping redundant
+# fields (improv_status.shrink_to_att). Reads honour the ATT offset, so any
+# value is read whole with Read Blob at any MTU; the default is still the ATT
+# limit on an attribute value (512), since a central is not required to keep
+# reading past it. Raise it only for centrals known to.
+STATUS_VALUE_MAX = int(os.getenv("IMPROV_STATUS_VALUE_MAX",
+                                 str(improv_status.ATT_VALUE_MAX)))
 
 # Device Information Service values (auto-detected, overridable via environment
-# for multi-board reuse).
-SOC_SERIAL = get_soc_serial()
+# for multi-board reuse). Model/FW/HW revision are resolved by _set_dis_values()
+# once advertising is up; see _dis_value().
 MANUFACTURER = os.getenv("IMPROV_MANUFACTURER", "Dynamic Devices Ltd")
-MODEL = os.getenv("IMPROV_MODEL", get_board_model())
-FW_REV = os.getenv("IMPROV_FW_REV", get_fw_revision())
-HW_REV = os.getenv("IMPROV_HW_REV", get_hw_revision())
 
-try:
-    loop = asyncio.get_running_loop()
-except RuntimeError:
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-server = BlessServer(name=SERVICE_NAME, loop=loop)
+# Created by main(); module level so the handlers below can reach them.
+loop = None
+server = None
+
+# What a restart comes back with (improv_warm): the last published
+# Device-Status, the DIS values and the Improv outcome, saved to /run on every
+# change and restored by run() before the first advertisement. And the systemd
+# notify socket: READY=1 once advertising, WATCHDOG=1 while healthy.
+_warm = improv_warm.WarmState(__version__)
+_warm_restored = False
+_notifier = improv_warm.Notifier()
+_last_status_doc = None
+_dis_current: Dict[str, str] = {}
 
 # --- Network status (custom vendor characteristic) ---------------------------
 # Cached JSON snapshot served on BLE reads; recomputed off the BLE event loop so
@@ -266,360 +446,949 @@ _net_status_json_bytes = bytearray(
 _net_refresh_event = asyncio.Event()
 
 
-def get_ipv4(iface):
-    """Return the interface IPv4 via ioctl (no subprocess), or None."""
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            packed = struct.pack('256s', iface[:15].encode('utf-8'))
-            addr = fcntl.ioctl(s.fileno(), 0x8915, packed)[20:24]  # SIOCGIFADDR
-            return socket.inet_ntoa(addr)
-        finally:
-            s.close()
-    except Exception:
-        return None
+def compute_net_status():
+    """The `net` block (blocking; call off the BLE loop).
 
+    Served from the NetworkManager D-Bus monitor's cache while it is live (no
+    subprocess at all); otherwise improv_status polls nmcli.
+    """
+    monitor = _nm_monitor
+    if monitor is not None and monitor.live:
+        code, ip, ssid = monitor.snapshot
+        return improv_status.net_block(
+            INTERFACE, code, ip or improv_status.get_ipv4(INTERFACE),
+            lambda: ssid)
+    return improv_status.read_net_status(INTERFACE)
+
+
+# --- Event-driven NetworkManager state (D-Bus signals) ------------------------
+# One shared system-bus connection for our own subscribers (NetworkManager,
+# systemd). bless keeps its own connection for BlueZ.
+_system_bus = None
+
+
+async def get_system_bus():
+    global _system_bus
+    if _system_bus is None:
+        _system_bus = await asyncio.wait_for(
+            MessageBus(bus_type=BusType.SYSTEM).connect(),
+            timeout=NM_DBUS_TIMEOUT)
+    return _system_bus
+
+
+async def _dbus_call(bus, destination, path, interface, member, signature="",
+                     body=()):
+    """One bounded method call; an error reply raises RuntimeError."""
+    reply = await asyncio.wait_for(
+        bus.call(Message(destination=destination, path=path,
+                         interface=interface, member=member,
+                         signature=signature, body=list(body))),
+        timeout=NM_DBUS_TIMEOUT)
+    if reply.message_type == MessageType.ERROR:
+        raise RuntimeError(f"{interface}.{member} failed: "
+                           f"{reply.error_name} {reply.body}")
+    return reply.body
+
+
+NM_BUS_NAME = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_DEVICE_IFACE = "org.freedesktop.NetworkManager.Device"
+NM_WIRELESS_IFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+NM_ACTIVE_IFACE = "org.freedesktop.NetworkManager.Connection.Active"
+NM_IP4_IFACE = "org.freedesktop.NetworkManager.IP4Config"
+NM_AP_IFACE = "org.freedesktop.NetworkManager.AccessPoint"
+DBUS_PROPS_IFACE = "org.freedesktop.DBus.Properties"
+
+
+class NMStateMonitor:
+    """In-memory cache of NetworkManager's view of one interface, kept current
+    by D-Bus signals rather than by forking nmcli.
+
+    Subscribes (with per-object match rules, so unrelated NM chatter such as
+    access-point Strength updates never wakes us) to:
+
+      - the device's `StateChanged` and `PropertiesChanged` (State, Ip4Config,
+        ActiveConnection, and Device.Wireless ActiveAccessPoint),
+      - the current ActiveConnection's `PropertiesChanged` (State, Ip4Config),
+      - the current IP4Config's `PropertiesChanged` (AddressData),
+      - NameOwnerChanged for NetworkManager itself, so an NM restart re-resolves
+        the device instead of leaving a dead cache behind.
+
+    Bursts of signals during an activation are coalesced into a single re-read of
+    the handful of properties we need, after which `on_change` is called (on the
+    event loop) only if the cached snapshot actually changed. `snapshot` is
+    replaced atomically, so the executor thread running compute_net_status can
+    read it without locking.
+    """
 
-def get_ssid(iface):
-    """Best-effort current SSID via nmcli (called off the BLE read path)."""
-    # 1) Active AP from the scan list.
-    try:
-        out = subprocess.run(["nmcli", "-t", "-f", "ACTIVE,SSID", "dev", "wifi"],
-                             capture_output=True, timeout=4, text=True)
-        for line in out.stdout.splitlines():
-            if line.startswith("yes:"):
-                ssid = line.split(":", 1)[1].strip()
-                if ssid:
-                    return ssid
-    except Exception:
-        pass
-    # 2) Fall back to the SSID stored on the interface's active connection
-    #    (reliable right after provisioning, before the scan cache updates).
-    try:
-        conn = (nmcli.device.show(iface) or {}).get("GENERAL.CONNECTION")
-        if conn and conn not in ("--", ""):
-            out = subprocess.run(
-                ["nmcli", "-s", "-g", "802-11-wireless.ssid",
-                 "connection", "show", conn],
-                capture_output=True, timeout=4, text=True)
-            ssid = out.stdout.strip()
-            if ssid:
-                return ssid
-    except Exception:
-        pass
-    return None
+    # Coalesce the burst of signals NM emits while (de)activating.
+    DEBOUNCE_SECS = 0.2
+
+    def __init__(self, iface, on_change):
+        self.iface = iface
+        self.on_change = on_change
+        self.bus = None
+        self.live = False
+        # (NM device-state code, IPv4 or None, SSID or None)
+        self.snapshot = (0, None, None)
+        self._device_path = None
+        self._ap_path = None
+        self._ssid = None
+        # path -> match rule currently installed for that object
+        self._matches = {}
+        self._resync_task = None
+        # A signal arrived while resync() was already reading: it may have
+        # read the old value, so read again once it is done.
+        self._resync_again = False
+        self._handler_added = False
+
+    async def start(self, bus=None):
+        """Connect to the system bus, subscribe and seed the cache."""
+        self.bus = bus
+        await self.resync()
+
+    async def _connect(self):
+        if self.bus is None:
+            self.bus = await get_system_bus()
+        if not self._handler_added:
+            self.bus.add_message_handler(self._on_message)
+            self._handler_added = True
+        await self._add_match(
+            "name-owner",
+            "type='signal',sender='org.freedesktop.DBus',"
+            "interface='org.freedesktop.DBus',member='NameOwnerChanged',"
+            f"arg0='{NM_BUS_NAME}'")
+
+    async def _dbus(self, destination, path, interface, member,
+                    signature="", body=()):
+        return await _dbus_call(self.bus, destination, path, interface, member,
+                                signature, body)
+
+    async def _get(self, path, interface, prop):
+        body = await self._dbus(NM_BUS_NAME, path, DBUS_PROPS_IFACE, "Get",
+                                "ss", (interface, prop))
+        return body[0].value
+
+    async def _add_match(self, key, rule):
+        await self._dbus("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                         "org.freedesktop.DBus", "AddMatch", "s", (rule,))
+        self._matches[key] = rule
+
+    async def _watch(self, path, slot, interface=DBUS_PROPS_IFACE,
+                     member="PropertiesChanged"):
+        """Track `member` signals on `path`, replacing whatever `slot` held."""
+        old = self._matches.get(slot)
+        rule = None
+        if path and path != "/":
+            rule = (f"type='signal',sender='{NM_BUS_NAME}',path='{path}',"
+                    f"interface='{interface}',member='{member}'")
+        if old == rule:
+            return
+        if old is not None:
+            try:
+                await self._dbus("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                                 "org.freedesktop.DBus", "RemoveMatch", "s",
+                                 (old,))
+            except Exception as e:
+                logger.debug(f"NM monitor: RemoveMatch failed: {e!r}")
+            del self._matches[slot]
+        if rule is not None:
+            await self._add_match(slot, rule)
+
+    def _on_message(self, msg):
+        if msg.message_type != MessageType.SIGNAL:
+            return None
+        if msg.member == "NameOwnerChanged":
+            # NM restarted (or went away): object paths are no longer valid.
+            self._device_path = None
+            self.live = False
+        elif msg.path not in self._watched_paths():
+            return None
+        self._schedule_resync()
+        return None
 
+    def _watched_paths(self):
+        return {rule.split("path='", 1)[1].split("'", 1)[0]
+                for rule in self._matches.values() if "path='" in rule}
+
+    def _schedule_resync(self):
+        if self._resync_task is not None and not self._resync_task.done():
+            self._resync_again = True
+            return
+        self._resync_task = asyncio.ensure_future(self._debounced_resync())
+
+    async def _debounced_resync(self):
+        while True:
+            await asyncio.sleep(self.DEBOUNCE_SECS)
+            # Signals from the debounce window are covered by this read.
+            self._resync_again = False
+            try:
+                await self.resync()
+            except Exception as e:
+                logger.debug(f"NM monitor resync failed: {e!r}")
+            if not self._resync_again:
+                return
 
-def compute_net_status():
-    """Build the current network-status dict (blocking; call off the BLE loop)."""
-    status = {"v": 1, "state": "disconnected", "iface": INTERFACE}
-    # Derive link state from NetworkManager's numeric device-state code
-    # (100=connected, 40..99=connecting/configuring, else disconnected). String
-    # matching is unsafe here because "disconnected" contains "connected".
-    #
-    # NM is authoritative: a lingering interface IP must NOT upgrade a
-    # disconnected/failed device to "connected". If we cannot read NM's state we
-    # stay "disconnected" (conservative) rather than trusting a possibly-stale IP.
-    code = 0
-    try:
-        d = nmcli.device.show(INTERFACE)
-        m = re.match(r"\s*(\d+)", d.get("GENERAL.STATE") or "")
-        code = int(m.group(1)) if m else 0
-    except Exception as e:
-        logger.debug(f"nmcli device state read failed: {e}")
-        code = 0
-    ip = get_ipv4(INTERFACE)
-    if code >= 100:
-        status["state"] = "connected" if ip else "connecting"
-    elif code >= 40:
-        status["state"] = "connecting"
-    else:
-        status["state"] = "disconnected"
-    # Only surface IP/SSID/RSSI when actually connected; a stale IP on a
-    # down interface would otherwise be misreported as a live connection.
-    if status["state"] == "connected":
-        if ip:
-            status["ipv4"] = ip
-        ssid = get_ssid(INTERFACE)
-        if ssid:
-            status["ssid"] = ssid
+    async def resync(self):
+        """Re-read the few properties we cache; notify if anything changed."""
         try:
-            with open("/proc/net/wireless") as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith(INTERFACE + ":"):
-                        parts = line.split()
-                        if len(parts) > 3:
-                            rssi = int(float(parts[3].rstrip(".")))
-                            if -120 <= rssi <= 0:
-                                status["rssi"] = rssi
+            if "name-owner" not in self._matches:
+                await self._connect()
+            if self._device_path is None:
+                body = await self._dbus(NM_BUS_NAME, NM_PATH, NM_BUS_NAME,
+                                        "GetDeviceByIpIface", "s", (self.iface,))
+                self._device_path = body[0]
+                await self._watch(self._device_path, "device")
+                await self._watch(self._device_path, "device-state",
+                                  NM_DEVICE_IFACE, "StateChanged")
+            dev = self._device_path
+            props = (await self._dbus(NM_BUS_NAME, dev, DBUS_PROPS_IFACE,
+                                      "GetAll", "s", (NM_DEVICE_IFACE,)))[0]
+            code = int(props["State"].value)
+            ip4_path = props["Ip4Config"].value
+            active_path = props["ActiveConnection"].value
+            await self._watch(active_path, "active")
+            await self._watch(ip4_path, "ip4")
+
+            ipv4 = None
+            if ip4_path and ip4_path != "/":
+                for addr in await self._get(ip4_path, NM_IP4_IFACE, "AddressData"):
+                    if "address" in addr:
+                        ipv4 = addr["address"].value
+                        break
+
+            ap_path = await self._get(dev, NM_WIRELESS_IFACE, "ActiveAccessPoint")
+            if ap_path != self._ap_path:
+                self._ssid = None
+                if ap_path and ap_path != "/":
+                    raw = await self._get(ap_path, NM_AP_IFACE, "Ssid")
+                    self._ssid = bytes(raw).decode("utf-8", "replace") or None
+                self._ap_path = ap_path
         except Exception:
-            pass
-    return status
+            self.live = False
+            raise
 
+        snapshot = (code, ipv4, self._ssid)
+        changed = snapshot != self.snapshot or not self.live
+        self.snapshot = snapshot
+        self.live = True
+        if changed:
+            logger.debug("NM monitor: state=%s ipv4=%s ssid=%s",
+                         code, ipv4, self._ssid)
+            self.on_change()
 
-# --- Device-Status superset (BLE-BOARD-PROFILE.md §5 / §5.1) ------------------
-# The vendor characteristic now carries the full Device-Status document: the
-# mandatory `net` block plus optional `time` and `sec` blocks. The legacy flat
-# {state,ssid,ipv4,rssi,iface} keys are mirrored at the top level for one release
-# so older app builds keep working; the app prefers the nested `net` block.
-_SEC_STATUS = None
 
+# Created in run() once the BLE server is up; None => nmcli polling fallback.
+_nm_monitor: Optional[NMStateMonitor] = None
 
-def compute_time_status():
-    """Wall-clock/time-sync status (`time` block).
 
-    `synced` comes from systemd-timesyncd's stamp file (root-free, no
-    subprocess). The PCF2131 RTC is unreliable on this board, so we report
-    `ntp` when synced and `none` otherwise rather than trusting the RTC.
+# --- Wi-Fi scan cache -------------------------------------------------------------
+# The Improv "request scanned Wi-Fi networks" RPC is answered from
+# improv_scan.ScanCache, so the app can offer a list instead of a text field
+# and the answer does not wait for the radio. NMWifiScanner keeps the cache
+# current from NM's own scans: the device's AccessPointAdded/AccessPointRemoved
+# signals and LastScan changes trigger one re-read of the AP list. A scan is
+# requested when a BLE session starts (and on a stale GET_WIFI_NETWORKS);
+# without dbus-fast, `nmcli device wifi list` on the job queue fills the cache.
+#
+# The cache also lets provisioning fail fast: an SSID missing from a fresh scan
+# is out of range, so WIFI_SETTINGS for it fails at once instead of after the
+# full activation timeout. IMPROV_SCAN_FAIL_FAST=0 turns that off (hidden
+# networks never show up in a scan).
+SCAN_FAIL_FAST = os.getenv("IMPROV_SCAN_FAIL_FAST", "1") != "0"
+# How long a GET_WIFI_NETWORKS with nothing cached waits for a scan.
+SCAN_TIMEOUT_SECS = float(os.getenv("IMPROV_SCAN_TIMEOUT_SECS", "8"))
+# NM80211ApFlags PRIVACY; any WPA/RSN flag also means a key is needed.
+NM_AP_FLAGS_PRIVACY = 0x1
+
+
+class NMWifiScanner:
+    """Feeds a ScanCache from NetworkManager's access-point list over D-Bus.
+
+    Like NMStateMonitor it only listens to the device object (per-AP Strength
+    updates never wake it) and coalesces a burst of signals - a scan adds and
+    removes many APs at once - into one re-read.
     """
-    synced = os.path.exists("/run/systemd/timesync/synchronized")
-    now = time.time()
-    return {
-        "epoch": int(now),
-        "iso": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
-        "source": "ntp" if synced else "none",
-        "synced": synced,
-    }
 
+    DEBOUNCE_SECS = 0.2
+
+    def __init__(self, iface, cache):
+        self.iface = iface
+        self.cache = cache
+        self.bus = None
+        self._device = None
+        self._last_scan = None
+        self._scanned = asyncio.Event()
+        self._refresh_task = None
+        # As NMStateMonitor._resync_again: a signal during refresh() means
+        # read the list again once it is done.
+        self._refresh_again = False
+        self._rules = []
+
+    async def _dbus(self, path, interface, member, signature="", body=()):
+        return await _dbus_call(self.bus, NM_BUS_NAME, path, interface, member,
+                                signature, body)
+
+    async def start(self, bus=None):
+        self.bus = bus or await get_system_bus()
+        self._device = (await self._dbus(NM_PATH, NM_BUS_NAME,
+                                         "GetDeviceByIpIface", "s",
+                                         (self.iface,)))[0]
+        self._rules = [
+            f"type='signal',sender='{NM_BUS_NAME}',path='{self._device}',"
+            f"interface='{NM_WIRELESS_IFACE}'",
+            f"type='signal',sender='{NM_BUS_NAME}',path='{self._device}',"
+            f"interface='{DBUS_PROPS_IFACE}',member='PropertiesChanged',"
+            f"arg0='{NM_WIRELESS_IFACE}'",
+        ]
+        for rule in self._rules:
+            await _dbus_call(self.bus, "org.freedesktop.DBus",
+                             "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                             "AddMatch", "s", (rule,))
+        self.bus.add_message_handler(self._on_message)
+        # NM scans on its own; start from whatever it already has.
+        await self.refresh()
+
+    def _on_message(self, msg):
+        if msg.message_type != MessageType.SIGNAL or msg.path != self._device:
+            return None
+        if msg.interface == NM_WIRELESS_IFACE or (
+                msg.member == "PropertiesChanged" and msg.body and
+                msg.body[0] == NM_WIRELESS_IFACE and "LastScan" in msg.body[1]):
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.ensure_future(
+                    self._debounced_refresh())
+            else:
+                self._refresh_again = True
+        return None
 
-def _read_secure_boot():
-    """i.MX93 secure-boot posture. Returns 'open' | 'closed' | 'unknown'.
-
-    The authoritative source is the EdgeLock Enclave (ELE) "get info"
-    lifecycle field (OEM_OPEN vs OEM_CLOSED / FIELD_RETURN). This kernel,
-    however, exposes no ELE MU char device (`/dev/ele_mu` absent) and no
-    lifecycle nvmem cell — the lifecycle lives behind OP-TEE/secure world —
-    so it cannot be read from Linux userspace without a dedicated OP-TEE TA.
-    That ELE-attested query remains a tracked follow-up (roadmap P0-1/P2-1,
-    BLE-BOARD-PROFILE.md §10) and needs secure-world plumbing.
-
-    As the best available userspace signal we read U-Boot's `sec_boot`
-    environment flag, which the NXP boot script uses to gate authenticated
-    boot (`auth_os`): 'yes' => authenticated boot enforced ('closed'),
-    'no' => not enforced ('open'). This reflects the *bootloader
-    configuration* rather than an ELE-attested hardware lifecycle, and —
-    like the whole `sec` block — is self-reported and untrusted until backed
-    by attestation (P2-1). A fuse/OCOTP byte heuristic is deliberately
-    avoided: the ELE-OCOTP0 shadow has non-zero UID/config words, so
-    byte-level guessing would misreport a fused board.
-    """
-    val = ""
-    try:
-        # `-n` prints just the value; falls back to parsing `k=v` for older
-        # u-boot-fw-utils that lack `-n`.
-        out = subprocess.run(["fw_printenv", "-n", "sec_boot"],
-                             capture_output=True, timeout=4, text=True)
-        if out.returncode == 0:
-            val = out.stdout.strip().lower()
-        else:
-            out = subprocess.run(["fw_printenv", "sec_boot"],
-                                 capture_output=True, timeout=4, text=True)
-            if out.returncode == 0 and "=" in out.stdout:
-                val = out.stdout.strip().split("=", 1)[1].strip().lower()
-    except Exception as e:
-        logger.debug(f"secure_boot read failed: {e}")
-        return "unknown"
-    if val in ("yes", "1", "true"):
-        return "closed"
-    if val in ("no", "0", "false"):
-        return "open"
-    return "unknown"
+    async def _debounced_refresh(self):
+        while True:
+            await asyncio.sleep(self.DEBOUNCE_SECS)
+            self._refresh_again = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.debug(f"Wi-Fi scan refresh failed: {e!r}")
+            if not self._refresh_again:
+                return
+
+    async def refresh(self):
+        """Re-read NM's AP list into the cache."""
+        paths = (await self._dbus(self._device, NM_WIRELESS_IFACE,
+                                  "GetAllAccessPoints"))[0]
+        aps = []
+        for path in paths:
+            try:
+                props = (await self._dbus(path, DBUS_PROPS_IFACE, "GetAll",
+                                          "s", (NM_AP_IFACE,)))[0]
+            except RuntimeError:
+                continue  # gone since the list was read
+            aps.append(improv_scan.AccessPoint(
+                bytes(props["Ssid"].value), int(props["Strength"].value),
+                bool(props["Flags"].value & NM_AP_FLAGS_PRIVACY or
+                     props["WpaFlags"].value or props["RsnFlags"].value),
+                props["HwAddress"].value, int(props["Frequency"].value)))
+        # LastScan: CLOCK_BOOTTIME ms of the last finished scan, -1 if none.
+        last_scan = (await self._dbus(self._device, DBUS_PROPS_IFACE, "Get",
+                                      "ss", (NM_WIRELESS_IFACE,
+                                             "LastScan")))[0].value
+        age = 0.0
+        if last_scan >= 0:
+            age = time.clock_gettime(time.CLOCK_BOOTTIME) - last_scan / 1000.0
+        if self.cache.update(aps, age):
+            logger.debug("Wi-Fi scan cache: %d networks",
+                         len(self.cache.networks()))
+        if last_scan != self._last_scan:
+            self._last_scan = last_scan
+            self._scanned.set()
+
+    async def scan(self):
+        """Have NM scan and wait (bounded) for the results to be read in."""
+        self._scanned.clear()
+        try:
+            await self._dbus(self._device, NM_WIRELESS_IFACE, "RequestScan",
+                             "a{sv}", ({},))
+        except RuntimeError as e:
+            # Typically "scanning not allowed" right after NM's own scan;
+            # that scan's results are on their way anyway.
+            logger.debug(f"RequestScan: {e}")
+        try:
+            await asyncio.wait_for(self._scanned.wait(), SCAN_TIMEOUT_SECS)
+        except asyncio.TimeoutError:
+            logger.info(f"Wi-Fi scan: no results after {SCAN_TIMEOUT_SECS:g}s")
 
 
-def _read_storage_encrypted():
-    """True if any dm-crypt mapped device exists (root-free via sysfs)."""
-    import glob
-    try:
-        for p in glob.glob("/sys/block/dm-*/dm/uuid"):
-            try:
-                with open(p) as f:
-                    if f.read().startswith("CRYPT-"):
-                        return True
-            except Exception:
-                pass
-    except Exception:
-        pass
-    return False
-
-
-def compute_sec_status():
-    """Self-reported security posture (`sec` block, §10). Cached: these values
-    are effectively static for the process lifetime."""
-    global _SEC_STATUS
-    if _SEC_STATUS is None:
-        _SEC_STATUS = {
-            "secure_boot": _read_secure_boot(),
-            # i.MX93 on-die EdgeLock Enclave (OP-TEE /dev/tee0 present).
-            "secure_element": "ele",
-            "storage_encrypted": _read_storage_encrypted(),
-            # Improv link is Just Works / unbonded today (roadmap P1-1).
-            "bonded": False,
-            # No remote attestation yet (roadmap P2-1) — sec is untrusted.
-            "attested": False,
-        }
-    return dict(_SEC_STATUS)
+def _nmcli_scan(rescan):
+    """The cache's nmcli fallback (job queue): `nmcli device wifi list`."""
+    aps = [improv_scan.AccessPoint(
+               ap.ssid.encode("utf-8"), ap.signal,
+               ap.security not in ("", "--"), ap.bssid, ap.freq)
+           for ap in _nmcli().device.wifi(INTERFACE, rescan)]
+    _scan_cache.update(aps)
+    return len(aps)
 
 
-def _read_os_release():
-    """Parse /etc/os-release into a dict (root-free, no subprocess)."""
-    d = {}
-    try:
-        with open("/etc/os-release") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                k, v = line.split("=", 1)
-                d[k] = v.strip().strip('"')
-    except Exception as e:
-        logger.debug(f"os-release read failed: {e}")
-    return d
-
-
-def compute_ota_status():
-    """Foundries enrollment / OTA posture (`ota` block, §5/§10).
-
-    Local, self-reported signals about whether this board is enrolled to a
-    Foundries factory and running the OTA client — surfaced over Improv BLE so
-    the app can show, during onboarding, whether the board still needs Foundries
-    enrolment (see the app/cloud onboard/offboard feature). Not cached: the
-    values flip as the board is registered / the daemon starts.
-
-      - `registered`: /var/sota/sota.toml exists — the config lmp-device-register
-        writes and the gate aktualizr-lite.service requires
-        (ConditionPathExists). Absent => board is not enrolled to any factory.
-      - `factory`/`tag`/`hwid`/`target`/`os_version`: baked into /etc/os-release
-        at image build time.
-      - `daemon`: aktualizr-lite.service is active (the OTA poller is running).
-      - `up_to_date`: left null on the board on purpose — the authoritative
-        "is this on the latest factory target" answer comes from the
-        cloud->Foundries API, not from a device that may be OFFLINE to the
-        device-gateway. Like the rest of the diagnostics, this block is
-        self-reported and untrusted until backed by attestation (roadmap P2-1).
-    """
-    osr = _read_os_release()
-    registered = os.path.exists("/var/sota/sota.toml")
-    daemon = False
+_scan_cache = improv_scan.ScanCache()
+# Created in run(); None => the nmcli fallback.
+_wifi_scanner: Optional[NMWifiScanner] = None
+_scan_ready = False  # set once run() has picked the scan source
+_scan_task: Optional[asyncio.Task] = None
+_networks_task: Optional[asyncio.Task] = None
+
+
+async def _scan(reason):
+    t0 = time.monotonic()
     try:
-        out = subprocess.run(["systemctl", "is-active", "aktualizr-lite"],
-                             capture_output=True, timeout=4, text=True)
-        daemon = out.stdout.strip() == "active"
+        if _wifi_scanner is not None:
+            await _wifi_scanner.scan()
+        else:
+            await run_blocking(_nmcli_scan, True, priority=improv_jobs.STATUS,
+                               key="wifi_scan")
     except Exception as e:
-        logger.debug(f"aktualizr-lite is-active failed: {e}")
-    target = osr.get("IMAGE_VERSION") or None
-    if target is not None:
+        logger.warning(f"Wi-Fi scan failed: {e!r}")
+        return
+    logger.info(f"Wi-Fi scan ({reason}): {len(_scan_cache.networks())} "
+                f"networks in {(time.monotonic() - t0) * 1000:.0f} ms")
+
+
+def _request_scan(reason, force=False):
+    """Start a background scan unless the cache is fresh (and not `force`) or
+    one is running; returns the running scan task, if any (loop thread)."""
+    global _scan_task
+    if not _scan_ready:
+        return None
+    if _scan_task is not None and not _scan_task.done():
+        return _scan_task
+    if _scan_cache.fresh() and not force:
+        return None
+    _scan_task = loop.create_task(_scan(reason))
+    return _scan_task
+
+
+def _wifi_networks_responses():
+    """GET_WIFI_NETWORKS as the Improv BLE spec frames it: one RPC result per
+    network, then an empty result to end the list."""
+    out = []
+    for fields in _scan_cache.rpc_results():
+        out.extend(improv_server.build_rpc_response(
+            ImprovCommand.GET_WIFI_NETWORKS, fields))
+    out.extend(improv_server.build_rpc_response(
+        ImprovCommand.GET_WIFI_NETWORKS, []))
+    return out
+
+
+async def _answer_wifi_networks(scan):
+    if scan is not None:
+        await scan
+    _notify_improv(ImprovUUID.RPC_RESULT_UUID.value, _wifi_networks_responses())
+
+
+def _get_wifi_networks():
+    """Answer GET_WIFI_NETWORKS from the cache; a stale cache is served as is
+    and refreshed in the background, an empty one waits for the first scan."""
+    global _networks_task
+    scan = _request_scan("get_wifi_networks")
+    if _scan_cache.age() is not None:
+        scan = None
+    _networks_task = loop.create_task(_answer_wifi_networks(scan))
+
+
+async def _start_wifi_scanner():
+    """Create the D-Bus scan feed; the nmcli fallback serves if it fails."""
+    global _wifi_scanner, _scan_ready
+    if _load_dbus_fast():
+        scanner = NMWifiScanner(INTERFACE, _scan_cache)
         try:
-            target = int(target)
-        except (TypeError, ValueError):
-            pass
+            await scanner.start()
+            _wifi_scanner = scanner
+            logger.info(f"Wi-Fi scan cache: {len(_scan_cache.networks())} "
+                        f"networks from NetworkManager")
+        except Exception as e:
+            logger.warning(f"NetworkManager scan results unavailable ({e!r}); "
+                           "scanning with nmcli")
+    _scan_ready = True
+    if _scheduler.active():
+        # A central turned up during startup.
+        _request_scan("ble session")
+
+
+# --- Wi-Fi provisioning over NetworkManager D-Bus ------------------------------
+# wifi_connect (below) drives NM through nmcli: delete, add, a keyfile rewrite
+# for psk-flags=0, reload, up and device show - five forks, each behind sudo,
+# and two file rewrites per attempt. NMProvisioner does the same in-process:
+# the complete profile, psk-flags=0 included, goes to NM in one
+# AddAndActivateConnection2 (Update2 + ActivateConnection when our profile
+# already exists), and the IPv4 address is read from the ActiveConnection as
+# soon as its StateChanged/PropertiesChanged signals say it is activated.
+# wifi_connect remains the fallback when dbus-fast or NM's D-Bus API is not
+# available; IMPROV_PROVISION_VIA_DBUS=0 forces it.
+PROVISION_VIA_DBUS = os.getenv("IMPROV_PROVISION_VIA_DBUS", "1") != "0"
+# Association + DHCP bound for one attempt (the profile's ipv4.dhcp-timeout is
+# 60 s too).
+NM_ACTIVATION_TIMEOUT_SECS = float(
+    os.getenv("IMPROV_NM_ACTIVATION_TIMEOUT_SECS", "60"))
+# Stable UUID for our profile, so re-provisioning finds it in one call.
+CON_UUID = str(uuid.uuid5(uuid.NAMESPACE_URL, f"improv:{CON_NAME}"))
+NM_SETTINGS_PATH = NM_PATH + "/Settings"
+NM_SETTINGS_IFACE = "org.freedesktop.NetworkManager.Settings"
+NM_CONNECTION_IFACE = "org.freedesktop.NetworkManager.Settings.Connection"
+NM_SETTINGS_UPDATE2_FLAG_TO_DISK = 0x1
+# NMActiveConnectionState
+NM_ACTIVE_ACTIVATED = 2
+NM_ACTIVE_DEACTIVATING = 3
+NM_DEVICE_FAILED = 120
+
+
+def _wifi_profile(ssid: bytes, psk: str) -> dict:
+    """The settings wifi_connect passes to `nmcli connection add`, as the
+    a{sa{sv}} NM takes over D-Bus."""
     return {
-        "registered": registered,
-        "factory": osr.get("LMP_FACTORY") or None,
-        "tag": osr.get("LMP_FACTORY_TAG") or None,
-        "hwid": osr.get("LMP_MACHINE") or None,
-        "target": target,
-        "os_version": osr.get("VERSION_ID") or osr.get("VERSION") or None,
-        "daemon": daemon,
-        "up_to_date": None,
+        "connection": {
+            "id": Variant("s", CON_NAME),
+            "uuid": Variant("s", CON_UUID),
+            "type": Variant("s", "802-11-wireless"),
+            "interface-name": Variant("s", INTERFACE),
+            "autoconnect": Variant("b", True),
+            "autoconnect-priority": Variant("i", 20),
+            "autoconnect-retries": Variant("i", -1),
+            "auth-retries": Variant("i", -1),
+            "permissions": Variant("as", []),  # system-wide
+        },
+        "802-11-wireless": {
+            "ssid": Variant("ay", bytes(ssid)),
+            "mode": Variant("s", "infrastructure"),
+        },
+        "802-11-wireless-security": {
+            "key-mgmt": Variant("s", "wpa-psk"),
+            "psk": Variant("s", psk),
+            "psk-flags": Variant("u", 0),  # stored by NM, no secret agent
+        },
+        "ipv4": {
+            "method": Variant("s", "auto"),
+            "dhcp-timeout": Variant("i", DHCP_TIMEOUT_SECS),
+            # Not ACTIVATED on IPv6 alone: the redirect URL needs the IPv4.
+            "may-fail": Variant("b", False),
+        },
     }
 
 
-def build_device_status(net):
-    """Compose the Device-Status JSON superset (§5) from the flat network dict.
+def _credentials_digest(ssid: bytes, psk: str) -> bytes:
+    """Fingerprint of an SSID/PSK pair, to tell whether a WIFI_SETTINGS request
+    repeats the stored profile. Compared in memory only: the PSK is read back
+    from NM each time rather than its hash being stored anywhere."""
+    return hashlib.sha256(bytes(ssid) + b"\0" + psk.encode("utf-8")).digest()
 
-    Emits the nested `net` block plus `time`/`sec`/`ota`. The legacy top-level
-    flat mirror (`state`/`ssid`/`ipv4`/`rssi`/`iface`) is intentionally
-    *not* emitted any more: with `ota` included the compact JSON is ~580 bytes
-    with the mirror and only ~490 without, and BlueZ/bless caps a single
-    characteristic value at 512 bytes (truncating mid-JSON otherwise). The app
-    has preferred the nested `net` block since the Device-Status superset
-    (meta-dynamicdevices #41) and still falls back to flat for older firmware.
-    """
-    doc = {"v": 1, "net": {
-        "bearer": "wifi",
-        "state": net.get("state"),
-        "ssid": net.get("ssid"),
-        "ipv4": net.get("ipv4"),
-        "rssi": net.get("rssi"),
-        "iface": net.get("iface"),
-    }}
-    doc["time"] = compute_time_status()
-    doc["sec"] = compute_sec_status()
-    doc["ota"] = compute_ota_status()
-    return doc
 
+def _same_credentials(stored_ssid, stored_psk, ssid, psk) -> bool:
+    if stored_ssid is None or stored_psk is None:
+        return False
+    return hmac.compare_digest(_credentials_digest(stored_ssid, stored_psk),
+                               _credentials_digest(ssid, psk))
 
-def compute_device_status():
-    """Blocking; call off the BLE loop. Full Device-Status superset."""
-    return build_device_status(compute_net_status())
 
+class NMProvisioner:
+    """Creates or updates the Improv Wi-Fi profile and activates it with one
+    NetworkManager D-Bus call, then waits for IPv4 on the ActiveConnection's
+    signals instead of a blocking `nmcli connection up`.
+
+    Re-sending the credentials of the stored profile (an app retrying after a
+    lost BLE link, say) skips the rewrite: if the profile is active with an
+    address that address is returned at once, else it is only re-activated."""
 
-# BlueZ/bless characteristic-value ceiling. Truncation mid-JSON is worse than
-# omitting a redundant field, so `_publish_net_status` shrinks before send.
-_ATT_VALUE_MAX = 512
+    def __init__(self, iface):
+        self.iface = iface
+        self.bus = None
 
+    async def _dbus(self, path, interface, member, signature="", body=()):
+        return await _dbus_call(self.bus, NM_BUS_NAME, path, interface, member,
+                                signature, body)
+
+    async def _find_profile(self):
+        """Object path of our profile, or None. Same-name profiles left by the
+        nmcli path (random UUIDs) are deleted: they would compete with ours
+        for autoconnect."""
+        try:
+            return (await self._dbus(NM_SETTINGS_PATH, NM_SETTINGS_IFACE,
+                                     "GetConnectionByUuid", "s",
+                                     (CON_UUID,)))[0]
+        except RuntimeError:
+            pass
+        for path in (await self._dbus(NM_SETTINGS_PATH, NM_SETTINGS_IFACE,
+                                      "ListConnections"))[0]:
+            settings = (await self._dbus(path, NM_CONNECTION_IFACE,
+                                         "GetSettings"))[0]
+            con_id = settings.get("connection", {}).get("id")
+            if con_id is not None and con_id.value == CON_NAME:
+                logger.info(f"removing stale profile {CON_NAME} at {path}")
+                await self._dbus(path, NM_CONNECTION_IFACE, "Delete")
+        return None
 
-def _shrink_to_att(doc):
-    """Return a compact JSON bytes that fits in one ATT value, or the best-effort
-    original. Progressive omits (never invent values): time.iso → ota.os_version
-    → ota.hwid. Logs if even the slim form exceeds the ceiling.
+    async def _stored_credentials(self, path):
+        """(SSID, PSK) of the profile at `path`, or (None, None). GetSecrets
+        only answers root (or the secret agent's owner)."""
+        try:
+            settings = (await self._dbus(path, NM_CONNECTION_IFACE,
+                                         "GetSettings"))[0]
+            secrets = (await self._dbus(path, NM_CONNECTION_IFACE,
+                                        "GetSecrets", "s",
+                                        ("802-11-wireless-security",)))[0]
+        except RuntimeError as e:
+            logger.debug(f"{CON_NAME}: stored credentials unreadable: {e}")
+            return None, None
+        ssid = settings.get("802-11-wireless", {}).get("ssid")
+        psk = secrets.get("802-11-wireless-security", {}).get("psk")
+        return (bytes(ssid.value) if ssid is not None else None,
+                psk.value if psk is not None else None)
+
+    async def _active_ipv4(self, device, profile):
+        """IPv4 address of the device if `profile` is its activated
+        connection, else None."""
+        active = (await self._dbus(device, DBUS_PROPS_IFACE, "Get", "ss",
+                                   (NM_DEVICE_IFACE,
+                                    "ActiveConnection")))[0].value
+        if not active or active == "/":
+            return None
+        try:
+            props = (await self._dbus(active, DBUS_PROPS_IFACE, "GetAll",
+                                      "s", (NM_ACTIVE_IFACE,)))[0]
+        except RuntimeError:
+            return None  # deactivated in between
+        if props["Connection"].value != profile or \
+                int(props["State"].value) != NM_ACTIVE_ACTIVATED:
+            return None
+        return await self._ipv4(props["Ip4Config"].value)
+
+    async def _ipv4(self, ip4_path):
+        if not ip4_path or ip4_path == "/":
+            return None
+        for addr in (await self._dbus(ip4_path, DBUS_PROPS_IFACE, "Get",
+                                      "ss", (NM_IP4_IFACE,
+                                             "AddressData")))[0].value:
+            if "address" in addr:
+                return addr["address"].value
+        return None
+
+    async def connect(self, ssid: bytes, psk: str,
+                      trace: improv_trace.ProvisionTrace) -> Optional[str]:
+        """Activate `ssid`/`psk` on the interface; returns the IPv4 address,
+        or None if NM did not get there. Raises only if the request could not
+        be handed to NM at all (the caller then falls back to nmcli).
+
+        `trace` gets a span for the lookup and the NM call, then one per
+        device state the activation passes through (from the device's
+        StateChanged signals)."""
+        self.bus = await get_system_bus()
+        with trace.span("lookup"):
+            device = (await self._dbus(NM_PATH, NM_BUS_NAME,
+                                       "GetDeviceByIpIface", "s",
+                                       (self.iface,)))[0]
+            existing = await self._find_profile()
+            unchanged = existing is not None and _same_credentials(
+                *await self._stored_credentials(existing), ssid, psk)
+        if unchanged:
+            with trace.span("reuse"):
+                ip_addr = await self._active_ipv4(device, existing)
+            if ip_addr is not None:
+                logger.info(f"{CON_NAME}: credentials unchanged and already "
+                            f"connected ({ip_addr})")
+                return ip_addr
+            logger.info(f"{CON_NAME}: credentials unchanged; re-activating")
+        profile = _wifi_profile(ssid, psk)
+
+        # Subscribe before activating: NM may signal before the reply arrives.
+        wake = asyncio.Event()
+
+        def on_message(msg):
+            if msg.message_type != MessageType.SIGNAL:
+                return None
+            if msg.interface == NM_DEVICE_IFACE and msg.path == device:
+                new, _old, reason = msg.body
+                phase = improv_trace.NM_DEVICE_PHASES.get(new)
+                if phase is not None:
+                    trace.begin(phase)
+                elif new == NM_DEVICE_FAILED:
+                    trace.end("fail")
+                    trace.error = f"device-failed:{reason}"
+                else:
+                    trace.end()
+            elif msg.interface == NM_ACTIVE_IFACE or (
+                    msg.member == "PropertiesChanged" and msg.body and
+                    msg.body[0] in (NM_ACTIVE_IFACE, NM_IP4_IFACE)):
+                # An IP4Config's AddressData too: a profile stored before
+                # ipv4.may-fail=no can be ACTIVATED before DHCPv4 is done.
+                wake.set()
+            return None
+
+        rules = [
+            f"type='signal',sender='{NM_BUS_NAME}',"
+            f"interface='{NM_ACTIVE_IFACE}',member='StateChanged'",
+            f"type='signal',sender='{NM_BUS_NAME}',"
+            f"interface='{DBUS_PROPS_IFACE}',member='PropertiesChanged',"
+            f"arg0='{NM_ACTIVE_IFACE}'",
+            f"type='signal',sender='{NM_BUS_NAME}',"
+            f"interface='{DBUS_PROPS_IFACE}',member='PropertiesChanged',"
+            f"arg0='{NM_IP4_IFACE}'",
+            f"type='signal',sender='{NM_BUS_NAME}',path='{device}',"
+            f"interface='{NM_DEVICE_IFACE}',member='StateChanged'",
+        ]
+        for rule in rules:
+            await _dbus_call(self.bus, "org.freedesktop.DBus",
+                             "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                             "AddMatch", "s", (rule,))
+        self.bus.add_message_handler(on_message)
+        try:
+            # Ended by the first device state signal (or below on error).
+            trace.begin("submit")
+            if existing is not None:
+                if not unchanged:
+                    await self._dbus(existing, NM_CONNECTION_IFACE, "Update2",
+                                     "a{sa{sv}}ua{sv}",
+                                     (profile,
+                                      NM_SETTINGS_UPDATE2_FLAG_TO_DISK, {}))
+                active = (await self._dbus(
+                    NM_PATH, NM_BUS_NAME, "ActivateConnection", "ooo",
+                    (existing, device, "/")))[0]
+            else:
+                _path, active, _result = await self._dbus(
+                    NM_PATH, NM_BUS_NAME, "AddAndActivateConnection2",
+                    "a{sa{sv}}ooa{sv}",
+                    (profile, device, "/",
+                     {"persist": Variant("s", "disk")}))
+            try:
+                return await self._wait_ipv4(active, wake, trace)
+            except Exception as e:
+                logger.warning(f"activation of {CON_NAME} failed: {e!r}")
+                trace.error = trace.error or "dbus"
+                return None
+        except BaseException:
+            trace.end("fail")
+            raise
+        finally:
+            self.bus.remove_message_handler(on_message)
+            for rule in rules:
+                try:
+                    await _dbus_call(self.bus, "org.freedesktop.DBus",
+                                     "/org/freedesktop/DBus",
+                                     "org.freedesktop.DBus", "RemoveMatch",
+                                     "s", (rule,))
+                except Exception as e:
+                    logger.debug(f"RemoveMatch failed: {e!r}")
+
+    async def _wait_ipv4(self, active, wake, trace):
+        """Re-read the ActiveConnection on each of its signals until it is
+        activated with an address, goes down, or the attempt times out."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + NM_ACTIVATION_TIMEOUT_SECS
+        while True:
+            wake.clear()
+            try:
+                props = (await self._dbus(active, DBUS_PROPS_IFACE, "GetAll",
+                                          "s", (NM_ACTIVE_IFACE,)))[0]
+            except RuntimeError:
+                # NM drops the object once the activation has failed.
+                logger.info(f"{CON_NAME}: activation ended without IPv4")
+                trace.error = trace.error or "deactivated"
+                return None
+            state = int(props["State"].value)
+            if state >= NM_ACTIVE_DEACTIVATING:
+                logger.info(f"{CON_NAME}: activation failed (state {state})")
+                trace.error = trace.error or "deactivated"
+                return None
+            if state == NM_ACTIVE_ACTIVATED:
+                ip_addr = await self._ipv4(props["Ip4Config"].value)
+                if ip_addr is not None:
+                    return ip_addr
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.info(f"{CON_NAME}: no IPv4 after "
+                            f"{NM_ACTIVATION_TIMEOUT_SECS:g}s")
+                trace.end("timeout")
+                trace.error = "timeout"
+                return None
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+_nm_provisioner = NMProvisioner(INTERFACE)
+
+
+# --- Device-Status superset (BLE-BOARD-PROFILE.md §5 / §5.1) ------------------
+# The vendor characteristic carries the full Device-Status document: the
+# mandatory `net` block plus `time`, `sec` and `ota`. Each block is an
+# improv_status provider with its own cadence and cache policy; the board
+# profile picks them. The slow-moving blocks are cached and invalidated by
+# inotify on the files they are derived from and by systemd unit signals, so a
+# steady-state refresh costs no file reads or forks for them at all.
+BOARD_PROFILE = improv_status.board_profile(
+    os.getenv("IMPROV_BOARD_PROFILE", "imx93-jaguar-eink"))
+
+
+class SystemdUnitWatcher:
+    """Tracks one unit's ActiveState via systemd's PropertiesChanged signals,
+    replacing a `systemctl is-active` fork per Device-Status refresh."""
+
+    SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+    SYSTEMD_PATH = "/org/freedesktop/systemd1"
+    UNIT_IFACE = "org.freedesktop.systemd1.Unit"
+
+    def __init__(self, unit, on_change):
+        self.unit = unit
+        self.on_change = on_change
+        self.live = False
+        self.active_state = None
+        self._path = None
+
+    async def _dbus(self, bus, destination, path, interface, member,
+                    signature="", body=()):
+        return await _dbus_call(bus, destination, path, interface, member,
+                                signature, body)
+
+    async def start(self, bus):
+        # Unit PropertiesChanged are only broadcast while a client is subscribed.
+        await self._dbus(bus, self.SYSTEMD_BUS_NAME, self.SYSTEMD_PATH,
+                         self.SYSTEMD_BUS_NAME + ".Manager", "Subscribe")
+        self._path = (await self._dbus(
+            bus, self.SYSTEMD_BUS_NAME, self.SYSTEMD_PATH,
+            self.SYSTEMD_BUS_NAME + ".Manager", "LoadUnit", "s",
+            (self.unit,)))[0]
+        bus.add_message_handler(self._on_message)
+        await self._dbus(
+            bus, "org.freedesktop.DBus", "/org/freedesktop/DBus",
+            "org.freedesktop.DBus", "AddMatch", "s",
+            (f"type='signal',sender='{self.SYSTEMD_BUS_NAME}',"
+             f"path='{self._path}',interface='{DBUS_PROPS_IFACE}',"
+             "member='PropertiesChanged'",))
+        state = (await self._dbus(
+            bus, self.SYSTEMD_BUS_NAME, self._path, DBUS_PROPS_IFACE, "Get",
+            "ss", (self.UNIT_IFACE, "ActiveState")))[0]
+        self.active_state = state.value
+        self.live = True
+
+    def _on_message(self, msg):
+        if (msg.message_type != MessageType.SIGNAL or msg.path != self._path
+                or msg.member != "PropertiesChanged"):
+            return None
+        iface, changed = msg.body[0], msg.body[1]
+        if iface == self.UNIT_IFACE and "ActiveState" in changed:
+            state = changed["ActiveState"].value
+            if state != self.active_state:
+                self.active_state = state
+                self.on_change()
+        return None
+
+
+# Populated in run(); None => `ota` falls back to `systemctl is-active` and
+# the unwatched TTL.
+_ota_unit_watcher: Optional[SystemdUnitWatcher] = None
+
+
+def _ota_daemon_state():
+    unit = _ota_unit_watcher
+    return unit.active_state if unit is not None and unit.live else None
+
+
+# Any invalidation (inotify, unit signal) republishes promptly.
+_status = improv_status.StatusRegistry(
+    on_change=lambda _blocks: _net_refresh_event.set())
+improv_status.register_profile(_status, BOARD_PROFILE, INTERFACE,
+                               _ota_daemon_state)
+# `net` is served from the NetworkManager D-Bus monitor while it is live.
+_status.register(improv_status.StatusProvider(
+    "net", compute_net_status, cadence=0,
+    placeholder=improv_status.net_block(INTERFACE, 0, None, None)))
+
+
+def compute_device_status():
+    """Blocking; call off the BLE loop. Full Device-Status superset.
+
+    The blocks are collected concurrently under IMPROV_STATUS_DEADLINE_SECS;
+    one that misses it (a slow fw_printenv after boot, nmcli stuck on a scan)
+    is published stale or left out, and the registry's on_change republishes
+    once it lands.
     """
-    data = json.dumps(doc, separators=(",", ":")).encode("utf-8")
-    if len(data) <= _ATT_VALUE_MAX:
-        return data
-    # 1. Drop time.iso (epoch is enough for the app).
-    if "time" in doc and isinstance(doc["time"], dict) and "iso" in doc["time"]:
-        slim = dict(doc)
-        slim["time"] = {k: v for k, v in doc["time"].items() if k != "iso"}
-        data = json.dumps(slim, separators=(",", ":")).encode("utf-8")
-        if len(data) <= _ATT_VALUE_MAX:
-            logger.info("Device-Status shrunk: dropped time.iso (%d bytes)", len(data))
-            return data
-        doc = slim
-    # 2. Drop ota.os_version / ota.hwid (derivable from factory image / machine).
-    if "ota" in doc and isinstance(doc["ota"], dict):
-        slim = dict(doc)
-        ota = {k: v for k, v in doc["ota"].items() if k not in ("os_version", "hwid")}
-        slim["ota"] = ota
-        data = json.dumps(slim, separators=(",", ":")).encode("utf-8")
-        if len(data) <= _ATT_VALUE_MAX:
-            logger.info("Device-Status shrunk: dropped ota.os_version/hwid (%d bytes)",
-                        len(data))
-            return data
-        doc = slim
-    logger.warning("Device-Status JSON still %d bytes > ATT max %d; truncating",
-                   len(data), _ATT_VALUE_MAX)
-    return data[:_ATT_VALUE_MAX]
+    return _status.collect()
+
+
+# Compact CBOR form of the same document (improv_status.encode_device_status_cbor).
+_net_status_cbor_bytes = bytearray(improv_status.encode_device_status_cbor(
+    {"net": {"bearer": "wifi", "state": "disconnected", "iface": INTERFACE}}))
+
+
+def _set_and_notify(char_uuid, data, notify):
+    _snapshots.set(char_uuid, data)
+    ch = server.get_characteristic(char_uuid)
+    if ch is not None:
+        ch.value = bytearray(data)
+        if notify:
+            _update_value(NET_STATUS_SERVICE_UUID, char_uuid)
+
+
+# --- Block-level change tracking / delta notifications -----------------------
+# The blocks last notified and their generation (improv_status.StatusDeltas),
+# and the delta characteristic's value.
+_status_deltas = improv_status.StatusDeltas()
+_net_status_delta_bytes = bytearray(b"{}")
 
 
 def _publish_net_status(status_dict, notify=True):
-    """Update the cached JSON + characteristic value; notify on change."""
-    global _net_status_json_bytes
-    data = _shrink_to_att(status_dict)
-    changed = bytes(data) != bytes(_net_status_json_bytes)
+    """Update the cached JSON/CBOR + characteristic values; notify on change.
+
+    Values are always refreshed so reads see the current document, but
+    notifications go out only when at least one block really changed (time-only
+    drift excluded). The delta characteristic then carries just those blocks.
+    """
+    global _net_status_json_bytes, _net_status_cbor_bytes, _last_status_doc
+    global _net_status_delta_bytes
+    _last_status_doc = status_dict
+    data = improv_status.shrink_to_att(status_dict, STATUS_VALUE_MAX)
     _net_status_json_bytes = bytearray(data)
+    cbor = improv_status.encode_device_status_cbor(status_dict)
+    _net_status_cbor_bytes = bytearray(cbor)
+    changed = _status_deltas.update(status_dict)
+    if changed:
+        _net_status_delta_bytes = bytearray(
+            _status_deltas.delta(status_dict, changed, STATUS_VALUE_MAX))
+    notify = notify and bool(changed)
+    if changed:
+        _refresh_advert_summary()
+        _save_warm_state()
     try:
-        ch = server.get_characteristic(NET_STATUS_CHAR_UUID)
-        if ch is not None:
-            ch.value = bytearray(data)
-            if notify and changed:
-                server.update_value(NET_STATUS_SERVICE_UUID, NET_STATUS_CHAR_UUID)
+        _set_and_notify(NET_STATUS_CHAR_UUID, data, notify)
+        _set_and_notify(NET_STATUS_CBOR_CHAR_UUID, cbor, notify)
+        _set_and_notify(NET_STATUS_DELTA_CHAR_UUID, _net_status_delta_bytes,
+                        notify)
     except Exception as e:
-        logger.debug(f"net status publish failed: {e}")
-    return changed
+        logger.debug("net status publish failed: %s", e)
+    return bool(changed)
+
+
+def _dis_value(env, detect):
+    """`env` if set in the environment, else detect() (only called if needed)."""
+    val = os.environ.get(env)
+    return val if val is not None else detect()
 
 
-def _set_dis_values():
-    """Populate the static Device Information Service characteristic values."""
-    values = {
+def get_dis_values():
+    """Static Device Information Service values (blocking: file reads).
+
+    Resolved after advertising has started: the device tree and os-release
+    reads behind these are not needed to become discoverable.
+    """
+    return {
         DIS_MANUFACTURER_UUID: MANUFACTURER,
-        DIS_MODEL_UUID: MODEL,
+        DIS_MODEL_UUID: _dis_value("IMPROV_MODEL", get_board_model),
         DIS_SERIAL_UUID: SOC_SERIAL,
-        DIS_FW_REV_UUID: FW_REV,
-        DIS_HW_REV_UUID: HW_REV,
+        DIS_FW_REV_UUID: _dis_value("IMPROV_FW_REV", get_fw_revision),
+        DIS_HW_REV_UUID: _dis_value("IMPROV_HW_REV", get_hw_revision),
         DIS_SW_REV_UUID: __version__,
     }
+
+
+def _set_dis_values(values):
+    """Populate the Device Information Service characteristics (loop thread)."""
     for uuid_, val in values.items():
         try:
             ch = server.get_characteristic(uuid_)
@@ -627,31 +1396,235 @@ def _set_dis_values():
                 ch.value = bytearray((val or "").encode("utf-8"))
         except Exception as e:
             logger.debug(f"set DIS {uuid_} failed: {e}")
+    _dis_current.update(values)
+    _save_warm_state()
+
+
+# --- Warm restarts -------------------------------------------------------------
+
+def _save_warm_state():
+    """Save what a restart should come back with (loop thread; a small tmpfs
+    file, rewritten only when it changed)."""
+    rpc = improv_server.rpc_response
+    improv = {"state": improv_server.state.value}
+    if improv_server.state == ImprovState.PROVISIONED and rpc:
+        improv["rpc"] = [bytes(r).hex()
+                         for r in (rpc if isinstance(rpc, list) else [rpc])]
+    state = {"improv": improv}
+    if _last_status_doc is not None:
+        state["status"] = _last_status_doc
+    if _dis_current:
+        state["dis"] = dict(_dis_current)
+    _warm.save(state)
+
+
+def _restore_warm_state():
+    """Serve the previous process's state from the first advertisement on
+    (loop thread, before advertising). Live values replace it as they come:
+    the DIS re-read and the first Device-Status collection still run."""
+    global _warm_restored
+    state = _warm.load()
+    if not state:
+        return False
+    improv = state.get("improv") or {}
+    if improv.get("state") == ImprovState.PROVISIONED.value:
+        improv_server.state = ImprovState.PROVISIONED
+        if improv.get("rpc"):
+            improv_server.rpc_response = [bytearray.fromhex(r)
+                                          for r in improv["rpc"]]
+    if isinstance(state.get("dis"), dict):
+        _set_dis_values(state["dis"])
+    if isinstance(state.get("status"), dict):
+        _publish_net_status(state["status"], notify=False)
+    _warm_restored = True
+    _startup_mark("warm_restored")
+    logger.info(f"warm start: state saved {_warm.age:.1f} s ago restored "
+                f"(Improv {improv_server.state.name}, "
+                f"{'with' if 'status' in state else 'no'} Device-Status)")
+    return True
+
+
+async def _systemd_keepalive(tasks):
+    """WATCHDOG=1 at half of WatchdogSec= while the loop runs and none of
+    `tasks` has died. A stalled loop or a dead task stops the keep-alives, and
+    systemd restarts the service without waiting for anything else to notice."""
+    interval = _notifier.watchdog_interval()
+    if interval is None:
+        return
+    reported = False
+    while True:
+        dead = [t.get_name() for t in tasks if t.done()]
+        if not dead:
+            _notifier.watchdog()
+        elif not reported:
+            logger.error(f"{', '.join(dead)} stopped; withholding the systemd "
+                         f"watchdog keep-alive")
+            _notifier.status(f"{', '.join(dead)} stopped")
+            reported = True
+        await asyncio.sleep(interval)
+
+
+class RefreshScheduler:
+    """Picks the Device-Status refresh interval from BLE session state and
+    accounts for the wake-ups it causes (see the REFRESH_* settings).
+
+    Runs on the loop thread: GATT handlers and the bless StartNotify/StopNotify
+    hooks report activity; net_status_loop asks for the next interval.
+    """
+
+    def __init__(self):
+        self.connected = False  # from the advertising watchdog's probe
+        self.last_activity = float("-inf")
+        self.idle_interval = REFRESH_IDLE_MIN_SECS
+        self.mode = None
+        self.started = time.monotonic()
+        self.wakeups = {"timer": 0, "event": 0}
+
+    def subscribed(self):
+        app = getattr(server, "app", None)
+        return bool(getattr(app, "subscribed_characteristics", None))
+
+    def active(self):
+        return (self.connected or self.subscribed() or
+                time.monotonic() - self.last_activity < REFRESH_ACTIVE_HOLD_SECS)
+
+    def note_activity(self):
+        """GATT I/O from a central: hold the fast cadence; wake up if idle."""
+        was_active = self.active()
+        self.last_activity = time.monotonic()
+        if not was_active:
+            self._wake()
+            _request_scan("ble session")
+
+    def note_session(self, connected=None):
+        """Subscription or connection change (loop thread)."""
+        if connected is not None:
+            if connected == self.connected:
+                return
+            self.connected = connected
+        if self.connected or self.subscribed():
+            # A central is here: have the network list ready before it asks.
+            _request_scan("ble session")
+        self._wake()
+
+    def _wake(self):
+        self.idle_interval = REFRESH_IDLE_MIN_SECS
+        _net_refresh_event.set()
+
+    def next_interval(self, status):
+        if self.active():
+            mode, interval = "active", NET_POLL_SECS
+            self.idle_interval = REFRESH_IDLE_MIN_SECS
+        elif _nm_monitor is None or not _nm_monitor.live:
+            mode, interval = "polling", NET_POLL_SECS
+        elif (improv_server.state == ImprovState.PROVISIONED or
+              ((status or {}).get("net") or {}).get("state") == "connected"):
+            mode, interval = "provisioned", REFRESH_PROVISIONED_SECS
+        else:
+            mode, interval = "idle", self.idle_interval
+            self.idle_interval = min(self.idle_interval * 2, REFRESH_IDLE_MAX_SECS)
+        if mode != self.mode:
+            logger.info("status refresh: %s (every %ss)", mode,
+                        interval if mode != "idle"
+                        else f"{REFRESH_IDLE_MIN_SECS}-{REFRESH_IDLE_MAX_SECS}")
+            self.mode = mode
+        return interval
+
+    def stats(self):
+        """Wake-ups and process CPU per hour since start, for the metrics."""
+        hours = max(time.monotonic() - self.started, 1.0) / 3600.0
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "mode": self.mode,
+            "refresh_wakeups": dict(self.wakeups),
+            "refresh_wakeups_per_hour": round(sum(self.wakeups.values()) / hours, 1),
+            # Voluntary context switches across all threads: every blocking
+            # wait that ended, i.e. the process's wake-ups as the kernel sees them.
+            "process_wakeups_per_hour": round(ru.ru_nvcsw / hours, 1),
+            "cpu_s_per_hour": round((ru.ru_utime + ru.ru_stime) / hours, 3),
+        }
+
+
+_scheduler = RefreshScheduler()
+
+
+def _on_notify_change(_):
+    """bless app StartNotify/StopNotify hook. Called before bless updates
+    subscribed_characteristics, so re-evaluate on the next loop iteration."""
+    loop.call_soon(_scheduler.note_session)
 
 
 async def net_status_loop(loop):
-    """Periodically refresh network status off the BLE event loop.
+    """Refresh Device-Status off the BLE event loop at the scheduler's cadence.
 
-    The blocking nmcli work runs in an executor so the asyncio/BLE loop stays
+    The blocking work runs on the job queue so the asyncio/BLE loop stays
     responsive; publishing (which touches the BlueZ characteristic) happens back
-    on the loop thread. Wakes early when `_net_refresh_event` is set.
+    on the loop thread. Wakes early when `_net_refresh_event` is set — by the
+    NetworkManager monitor on every real state change, by the file/unit
+    watchers, and by the scheduler when a central shows up.
     """
     while True:
+        status = None
         try:
-            status = await loop.run_in_executor(None, compute_device_status)
+            status = await run_blocking(compute_device_status,
+                                        priority=improv_jobs.STATUS,
+                                        key="device_status")
             _publish_net_status(status)
+            _startup_mark("status_ready")
         except asyncio.CancelledError:
             raise
         except Exception as e:
-            logger.debug(f"net status loop error: {e}")
+            logger.debug("net status loop error: %s", e)
+        monitor = _nm_monitor
+        if monitor is not None and not monitor.live:
+            # NM was unreachable (not started yet, restarting): retry quietly
+            # and poll nmcli meanwhile.
+            monitor._schedule_resync()
         try:
-            await asyncio.wait_for(_net_refresh_event.wait(), timeout=5)
+            await asyncio.wait_for(_net_refresh_event.wait(),
+                                   timeout=_scheduler.next_interval(status))
+            _scheduler.wakeups["event"] += 1
         except asyncio.TimeoutError:
-            pass
+            _scheduler.wakeups["timer"] += 1
         finally:
             _net_refresh_event.clear()
 
 
+async def _start_status_watchers(loop):
+    """Arm the Device-Status cache invalidators. Best-effort: anything that
+    cannot be watched just keeps the short unwatched TTL."""
+    global _ota_unit_watcher
+    _status.start_watching(loop)
+    if "ota" not in BOARD_PROFILE["blocks"] or not _load_dbus_fast():
+        return
+    unit_name = BOARD_PROFILE["ota_unit"]
+    unit = SystemdUnitWatcher(unit_name, lambda: _status.invalidate("ota"))
+    try:
+        await unit.start(await get_system_bus())
+        _ota_unit_watcher = unit
+        # The cached block may predate the watcher; re-read once.
+        _status.invalidate("ota")
+    except Exception as e:
+        logger.warning(f"cannot watch {unit_name} over D-Bus ({e!r}); "
+                       "falling back to systemctl")
+
+
+async def _start_nm_monitor():
+    """Create the NetworkManager D-Bus monitor; leave polling on if it fails."""
+    global _nm_monitor
+    if not _load_dbus_fast():
+        logger.info("dbus-fast not available; polling nmcli for network status")
+        return
+    _nm_monitor = NMStateMonitor(INTERFACE, _net_refresh_event.set)
+    try:
+        await _nm_monitor.start()
+        logger.info("NetworkManager D-Bus monitor live; network status is "
+                    "event-driven")
+    except Exception as e:
+        logger.warning(f"NetworkManager D-Bus monitor unavailable ({e!r}); "
+                       "polling nmcli until it recovers")
+
+
 def _drop_stale_adverts():
     """Unexport and forget any advertisement objects bless is still tracking.
 
@@ -704,6 +1677,241 @@ async def _reassert_advert(had_registration: bool):
         _drop_stale_adverts()
     await asyncio.wait_for(
         app.start_advertising(adapter), timeout=ADVERT_DBUS_TIMEOUT)
+    _refresh_advert_summary()
+
+
+# --- Advertised status summary -------------------------------------------------
+# Legacy advertising data is 31 bytes; the kernel puts the flags (3) first and
+# the local name in the scan response.
+LEGACY_ADV_DATA_MAX = 31
+# Improv service data last put in the advertisement (for the metrics).
+_advert_summary = None
+_advert_summary_too_big = False
+
+
+def _ad_uuid_len(u):
+    """Bytes a UUID takes in an AD structure: 2 in the Bluetooth base range."""
+    u = str(u).lower()
+    return 2 if (u.startswith("0000")
+                 and u.endswith("-0000-1000-8000-00805f9b34fb")) else 16
+
+
+def _advert_data_len(adv, service_data):
+    """Legacy advertising data bytes of bless advertisement `adv` with
+    `service_data` ({uuid: Variant("ay")})."""
+    n = 3  # flags
+    by_size = {}
+    for u in getattr(adv, "_service_uuids", None) or ():
+        size = _ad_uuid_len(u)
+        by_size[size] = by_size.get(size, 0) + size
+    n += sum(2 + size for size in by_size.values())
+    for data in (getattr(adv, "_manufacturer_data", None) or {}).values():
+        n += 4 + len(data.value)
+    for u, data in service_data.items():
+        n += 2 + _ad_uuid_len(u) + len(data.value)
+    return n
+
+
+def _bless_variant(adv):
+    """Variant class of the D-Bus library bless exports `adv` with (dbus-next
+    or dbus-fast, depending on the bless release)."""
+    for cls in type(adv).__mro__:
+        if cls.__name__ == "ServiceInterface":
+            return sys.modules[cls.__module__.split(".")[0]].Variant
+    return Variant
+
+
+def _refresh_advert_summary():
+    """Put the current summary in bless's advertisement(s) if it changed.
+
+    BlueZ re-reads ServiceData on the PropertiesChanged signal and updates the
+    advertising data in place: no re-registration, no gap on air. Called on the
+    loop thread after every (re)start of the advertisement, Improv state
+    notification and Device-Status change.
+    """
+    global _advert_summary, _advert_summary_too_big
+    if not ADVERT_STATUS:
+        return
+    adverts = getattr(getattr(server, "app", None), "advertisements", None)
+    if not adverts:
+        return
+    net = _status_deltas.notified.get("net") or {}
+    packed = improv_status.pack_advert_summary(
+        improv_server.state.value,
+        improv_server.handle_read(ImprovUUID.CAPABILITIES_UUID.value)[0],
+        _status_deltas.notified,
+        improv_server.state == ImprovState.PROVISIONED
+        or net.get("state") == "connected")
+    uuid_ = improv_status.IMPROV_SERVICE_DATA_UUID
+    for adv in adverts:
+        current = adv._service_data.get(uuid_)
+        if current is not None and bytes(current.value) == packed:
+            continue
+        service_data = dict(adv._service_data)
+        service_data[uuid_] = _bless_variant(adv)("ay", packed)
+        size = _advert_data_len(adv, service_data)
+        if size > LEGACY_ADV_DATA_MAX:
+            if not _advert_summary_too_big:
+                logger.warning(f"advertised status summary left out: the "
+                               f"advertisement would be {size} bytes "
+                               f"(max {LEGACY_ADV_DATA_MAX})")
+                _advert_summary_too_big = True
+            continue
+        adv._service_data = service_data
+        try:
+            adv.emit_properties_changed({"ServiceData": service_data})
+        except Exception as e:
+            logger.debug(f"advert summary update failed: {e!r}")
+            continue
+        _advert_stats["summary_updates"] += 1
+        _advert_summary = packed
+
+
+# Exit status of the deliberate exit below (EX_TEMPFAIL), so the journal and
+# `systemctl status` tell it apart from a crash (1).
+EXIT_RESTART = 75
+
+
+def _exit_for_restart():
+    """Exit hard so systemd restarts us, flushing queued log records first."""
+    _notifier.stopping("BLE stack unresponsive; exiting for a restart")
+    if improv_logging is not None:
+        improv_logging.stop()
+    os._exit(EXIT_RESTART)
+
+
+BLUEZ_BUS_NAME = "org.bluez"
+BLUEZ_ADVERT_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+BLUEZ_DEVICE_IFACE = "org.bluez.Device1"
+
+# Advertising watchdog wakeups by cause, BlueZ state queries (probes and
+# confirmations of a drop), re-assertions, bounces skipped because the
+# advertisement was seen on air, bounces because it was not, and in-place
+# updates of the advertised status summary, for the metrics endpoint.
+_advert_stats = {"wakeups": {"signal": 0, "timer": 0, "hci": 0}, "queries": 0,
+                 "query_failures": 0, "reasserts": 0, "verified": 0,
+                 "off_air": 0, "summary_updates": 0}
+
+
+class BlueZAdvertSignals:
+    """Advertising and connection state of one adapter, kept from BlueZ's
+    PropertiesChanged signals so the watchdog does not have to ask.
+
+    `active_instances` follows LEAdvertisingManager1.ActiveInstances and
+    `devices` the Device1 objects under the adapter with Connected=true;
+    `changed` is set on every update and `disconnected` when a central left.
+    A liveness probe overwrites `active_instances` with what it read, which
+    also covers a signal lost while the match was being (re-)added.
+    """
+
+    def __init__(self, adapter_path):
+        self.adapter_path = adapter_path
+        self.bus = None
+        self.active_instances = None
+        self.devices = set()
+        self.changed = asyncio.Event()
+        self.disconnected = False
+
+    async def _dbus(self, path, interface, member, signature="", body=()):
+        return await _dbus_call(self.bus, BLUEZ_BUS_NAME, path, interface,
+                                member, signature, body)
+
+    async def start(self, bus=None):
+        self.bus = bus or await get_system_bus()
+        rules = [
+            f"type='signal',sender='{BLUEZ_BUS_NAME}',path='{self.adapter_path}',"
+            f"interface='{DBUS_PROPS_IFACE}',member='PropertiesChanged',"
+            f"arg0='{BLUEZ_ADVERT_MANAGER_IFACE}'",
+            f"type='signal',sender='{BLUEZ_BUS_NAME}',"
+            f"path_namespace='{self.adapter_path}',"
+            f"interface='{DBUS_PROPS_IFACE}',member='PropertiesChanged',"
+            f"arg0='{BLUEZ_DEVICE_IFACE}'",
+        ]
+        for rule in rules:
+            await _dbus_call(self.bus, "org.freedesktop.DBus",
+                             "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                             "AddMatch", "s", (rule,))
+        self.bus.add_message_handler(self._on_message)
+        # Seed after the matches are in, so no change falls in between.
+        self.active_instances = int((await self._dbus(
+            self.adapter_path, DBUS_PROPS_IFACE, "Get", "ss",
+            (BLUEZ_ADVERT_MANAGER_IFACE, "ActiveInstances")))[0].value)
+        try:
+            objects = (await self._dbus(
+                "/", "org.freedesktop.DBus.ObjectManager",
+                "GetManagedObjects"))[0]
+        except RuntimeError as e:
+            logger.debug(f"BlueZ device list unavailable: {e}")
+            objects = {}
+        prefix = self.adapter_path + "/"
+        for path, ifaces in objects.items():
+            dev = ifaces.get(BLUEZ_DEVICE_IFACE)
+            if path.startswith(prefix) and dev and \
+                    dev.get("Connected") is not None and dev["Connected"].value:
+                self.devices.add(path)
+
+    def _on_message(self, msg):
+        if msg.message_type != MessageType.SIGNAL or \
+                msg.member != "PropertiesChanged" or \
+                msg.interface != DBUS_PROPS_IFACE or not msg.body:
+            return None
+        iface, changed = msg.body[0], msg.body[1]
+        if iface == BLUEZ_ADVERT_MANAGER_IFACE and \
+                msg.path == self.adapter_path and "ActiveInstances" in changed:
+            self.active_instances = int(changed["ActiveInstances"].value)
+            self.changed.set()
+        elif iface == BLUEZ_DEVICE_IFACE and "Connected" in changed and \
+                msg.path.startswith(self.adapter_path + "/"):
+            if changed["Connected"].value:
+                self.devices.add(msg.path)
+            elif msg.path in self.devices:
+                self.devices.discard(msg.path)
+                self.disconnected = True
+            self.changed.set()
+        return None
+
+    def take_disconnect(self):
+        """Whether a central disconnected since the last call."""
+        left, self.disconnected = self.disconnected, False
+        return left
+
+
+async def _start_advert_signals():
+    """Subscribe to the adapter's BlueZ signals; None keeps the watchdog on
+    polling."""
+    if not _load_dbus_fast():
+        return None
+    signals = BlueZAdvertSignals(server.adapter.path)
+    try:
+        await signals.start()
+    except Exception as e:
+        logger.warning(f"BlueZ advertising signals unavailable ({e!r}); "
+                       f"polling every {ADVERT_WATCHDOG_SECS}s")
+        return None
+    return signals
+
+
+def _start_advert_verifier(on_change):
+    """Open the HCI monitor for the on-air check; None keeps bounces blind."""
+    if not ADVERT_VERIFY:
+        return None
+    path = server.adapter.path
+    state = improv_hci.AdvertState(
+        [improv_hci.uuid_marker(ImprovUUID.SERVICE_UUID.value),
+         SERVICE_NAME.encode()],
+        index=int(path.rsplit("hci", 1)[1]) if "hci" in path else 0)
+    if HCI_MONITOR_SOCKET:
+        monitor = improv_hci.AdvertMonitor(
+            state, lambda: improv_hci.open_replay(HCI_MONITOR_SOCKET))
+    else:
+        monitor = improv_hci.AdvertMonitor(state)
+    try:
+        monitor.start(asyncio.get_running_loop(), on_change)
+    except Exception as e:
+        logger.warning(f"HCI monitor unavailable ({e!r}); advertisement "
+                       f"bounces stay periodic")
+        return None
+    return monitor
 
 
 async def advertising_watchdog():
@@ -716,52 +1924,109 @@ async def advertising_watchdog():
        (ActiveInstances==0). bless registers it exactly once (in
        ``server.start()``), so without this it stays gone until a manual restart.
        Seen after ~an hour of uptime, adapter resets, and post-provision
-       NetworkManager churn.
+       NetworkManager churn. The ActiveInstances signal wakes us at once, so the
+       advert is re-registered within a D-Bus round trip of the drop.
 
     2. On-air stall ("ghost advertising") — BlueZ still reports
        ActiveInstances>=1 but nothing is radiating, so ``is_advertising()`` looks
        healthy and case 1 never fires. Reproduced after a failed/aborted BLE
        connect and around a fresh boot, with Wi-Fi OFF (so not coexistence): the
        board silently becomes un-onboardable until a manual restart. Because
-       ActiveInstances cannot tell us whether the advert is truly on-air, we
-       cannot *detect* this directly — instead we periodically BOUNCE (re-assert)
-       the advertisement every ``ADVERT_BOUNCE_SECS`` so any stall self-heals
-       within about a minute.
-
-    Both re-assertions are skipped while a central is mid-session (a subscribed
-    characteristic) so we never disrupt an in-progress onboarding.
+       ActiveInstances cannot tell us whether the advert is truly on-air, the
+       controller's own HCI traffic (the monitor channel) is checked instead:
+       the advertisement is BOUNCED (re-asserted) once our advertising set has
+       been off the controller for ``ADVERT_VERIFY_GRACE_SECS``, and a due
+       bounce is skipped while it is enabled. Without the monitor, or before
+       it has seen an advertising command, bounces are blind: as soon as a
+       central disconnects, and every ``ADVERT_BOUNCE_SECS`` after that, so
+       any stall self-heals within about a minute.
+
+    Both re-assertions are skipped while a central is mid-session (connected,
+    or a subscribed characteristic) so we never disrupt an in-progress
+    onboarding. Without the BlueZ signals the state is polled every
+    ``ADVERT_WATCHDOG_SECS`` instead.
     """
-    logger.info(
-        f"advertising watchdog started (check every {ADVERT_WATCHDOG_SECS}s, "
-        f"bounce every {ADVERT_BOUNCE_SECS}s)")
+    signals = await _start_advert_signals()
+    wake = signals.changed if signals is not None else asyncio.Event()
+    hci_changed = False
+
+    def on_hci_change():
+        nonlocal hci_changed
+        hci_changed = True
+        wake.set()
+
+    verifier = _start_advert_verifier(on_hci_change)
+    bounce = (f"bounce when off air for {ADVERT_VERIFY_GRACE_SECS:g}s"
+              if verifier is not None else
+              f"bounce every {ADVERT_BOUNCE_SECS}s")
+    if signals is not None:
+        logger.info(
+            f"advertising watchdog started (BlueZ signals, probe every "
+            f"{ADVERT_PROBE_SECS}s, {bounce})")
+    else:
+        logger.info(
+            f"advertising watchdog started (check every {ADVERT_WATCHDOG_SECS}s, "
+            f"{bounce})")
     failures = 0
-    last_assert = time.monotonic()
+    off_air_bounces = 0
+    last_assert = last_probe = time.monotonic()
     while True:
-        await asyncio.sleep(ADVERT_WATCHDOG_SECS)
-
-        # 1) Query current state, but never let a wedged BLE stack freeze the
-        #    loop: bound every D-Bus call with a timeout.
+        period = (ADVERT_WATCHDOG_SECS if signals is None or failures
+                  else ADVERT_PROBE_SECS)
+        due = min(last_probe + period, last_assert + ADVERT_BOUNCE_SECS)
+        if verifier is not None and verifier.on_air() is False:
+            due = min(due, max(verifier.state.off_since, last_assert) +
+                      ADVERT_VERIFY_GRACE_SECS)
+        woke = "timer"
         try:
-            connected = await asyncio.wait_for(
-                server.is_connected(), timeout=ADVERT_DBUS_TIMEOUT)
-            advertising = await asyncio.wait_for(
-                server.is_advertising(), timeout=ADVERT_DBUS_TIMEOUT)
-        except asyncio.CancelledError:
-            raise
-        except Exception as e:
-            failures += 1
-            logger.error(
-                f"advertising watchdog: cannot query BLE state ({e!r}); "
-                f"failures={failures}/{ADVERT_MAX_FAILURES}")
-            if failures >= ADVERT_MAX_FAILURES:
-                logger.error("advertising watchdog: BLE stack unresponsive; "
-                             "exiting so systemd restarts the service")
-                os._exit(1)
-            continue
+            await asyncio.wait_for(wake.wait(),
+                                   timeout=max(0.0, due - time.monotonic()))
+            woke = "hci" if hci_changed else "signal"
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+        hci_changed = False
+        _advert_stats["wakeups"][woke] += 1
+        now = time.monotonic()
+
+        # 1) Query current state when the probe is due, or to confirm a drop a
+        #    signal reported (it may be a stale step of our own bounce), but
+        #    never let a wedged BLE stack freeze the loop: bound every D-Bus
+        #    call with a timeout.
+        if signals is None or not signals.active_instances or \
+                now >= last_probe + period:
+            _advert_stats["queries"] += 1
+            last_probe = now
+            try:
+                connected = await asyncio.wait_for(
+                    server.is_connected(), timeout=ADVERT_DBUS_TIMEOUT)
+                advertising = await asyncio.wait_for(
+                    server.is_advertising(), timeout=ADVERT_DBUS_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                _advert_stats["query_failures"] += 1
+                logger.error(
+                    f"advertising watchdog: cannot query BLE state ({e!r}); "
+                    f"failures={failures}/{ADVERT_MAX_FAILURES}")
+                if failures >= ADVERT_MAX_FAILURES:
+                    logger.error("advertising watchdog: BLE stack unresponsive; "
+                                 "exiting so systemd restarts the service")
+                    _exit_for_restart()
+                continue
+            if signals is not None:
+                signals.active_instances = int(advertising)
+        else:
+            # is_connected() is bless's local subscription set, no D-Bus.
+            connected = await server.is_connected()
+            advertising = True
+        if signals is not None:
+            connected = connected or bool(signals.devices)
 
-        logger.debug(
-            f"advertising watchdog: connected={connected} "
-            f"advertising={advertising}")
+        logger.debug("advertising watchdog: connected=%s advertising=%s",
+                     connected, advertising)
+        _scheduler.note_session(connected)
 
         # 2) A central is mid-session — never disturb an in-progress onboarding.
         #    Reset the bounce clock so we don't bounce the instant it leaves.
@@ -771,7 +2036,25 @@ async def advertising_watchdog():
             continue
 
         now = time.monotonic()
-        due_for_bounce = (now - last_assert) >= ADVERT_BOUNCE_SECS
+        # A central that just left may have been an aborted connect, the usual
+        # lead-in to an on-air stall: bounce now rather than a minute later.
+        left = signals is not None and signals.take_disconnect()
+        blind = left or (now - last_assert) >= ADVERT_BOUNCE_SECS
+        # With the HCI monitor, only an advertisement the controller has not
+        # been sending for the grace period is bounced (the grace counts from
+        # the last bounce or session, as a connection stops advertising).
+        on_air = verifier.on_air() if verifier is not None else None
+        off_air = on_air is False and (
+            now - max(verifier.state.off_since, last_assert)
+            >= ADVERT_VERIFY_GRACE_SECS)
+        if on_air:
+            off_air_bounces = 0
+        if on_air and blind:
+            logger.debug("advertising watchdog: advertisement on air; "
+                         "bounce skipped")
+            _advert_stats["verified"] += 1
+            last_assert = now
+        due_for_bounce = off_air or (on_air is None and blind)
 
         # 3) Healthy registration and not yet due a bounce — leave it alone.
         if advertising and not due_for_bounce:
@@ -781,15 +2064,39 @@ async def advertising_watchdog():
             continue
 
         # 4) Re-assert the advertisement: either it is fully down
-        #    (ActiveInstances==0), or it is due a periodic bounce to clear a
-        #    possible on-air stall that BlueZ still reports as active.
-        reason = ("advertisement is down (ActiveInstances==0)"
-                  if not advertising else
-                  "periodic bounce (clears on-air stalls BlueZ reports as active)")
-        logger.warning(f"re-asserting BLE advertisement: {reason}")
+        #    (ActiveInstances==0), or it is due a bounce to clear a possible
+        #    on-air stall that BlueZ still reports as active.
+        if not advertising:
+            reason = "advertisement is down (ActiveInstances==0)"
+        elif off_air:
+            _advert_stats["off_air"] += 1
+            off_air_bounces += 1
+            reason = ("advertisement not on air for "
+                      f"{now - verifier.state.off_since:.1f}s (HCI monitor)")
+            if off_air_bounces > ADVERT_MAX_FAILURES:
+                # Bounces that never show up on the controller: more likely
+                # HCI traffic this parser misreads than a stall, so stop
+                # trusting it rather than bouncing every grace period.
+                logger.error("advertising watchdog: advertisement never seen "
+                             "on air after re-asserting; HCI on-air check off")
+                verifier.close()
+                verifier = None
+                off_air_bounces = 0
+                continue
+        elif left:
+            reason = "central disconnected (clears on-air stalls after aborted connects)"
+        else:
+            reason = "periodic bounce (clears on-air stalls BlueZ reports as active)"
+        # The periodic bounce is routine; only a dropped or stalled advert is a
+        # warning.
+        (logger.warning if not advertising or off_air else logger.info)(
+            "re-asserting BLE advertisement: %s", reason)
         try:
             await _reassert_advert(had_registration=advertising)
             last_assert = time.monotonic()
+            _advert_stats["reasserts"] += 1
+            if signals is not None:
+                signals.active_instances = max(signals.active_instances or 0, 1)
             logger.info("BLE advertisement re-asserted by watchdog")
             failures = 0
         except asyncio.CancelledError:
@@ -802,19 +2109,51 @@ async def advertising_watchdog():
             if failures >= ADVERT_MAX_FAILURES:
                 logger.error("advertising watchdog: cannot restore advertising; "
                              "exiting so systemd restarts the service")
-                os._exit(1)
-
-
-def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
+                _exit_for_restart()
+        if signals is not None:
+            # A central that left during the bounce was covered by it.
+            signals.take_disconnect()
+
+
+def wifi_connect(ssid: str, passwd: str,
+                 trace: Optional[improv_trace.ProvisionTrace] = None
+                 ) -> Optional[list[str]]:
+    if trace is None:
+        trace = improv_trace.ProvisionTrace("nmcli")
+    nmcli = _nmcli()
     logger.warning(
         f"Creating Improv WiFi connection for '{ssid.decode('utf-8')}' with password: '{passwd.decode('utf-8')}'")
 
+    # Same SSID and PSK as the stored profile: keep it rather than deleting and
+    # re-adding it, and if it is up with an address keep the association too.
+    trace.begin("match")
+    try:
+        stored = nmcli.connection.show(f"{CON_NAME}", show_secrets=True)
+    except Exception:
+        stored = {}  # no such profile
+    trace.end()
+    stored_ssid = stored.get("802-11-wireless.ssid")
+    if _same_credentials(
+            stored_ssid.encode("utf-8") if stored_ssid is not None else None,
+            stored.get("802-11-wireless-security.psk"),
+            ssid, passwd.decode("utf-8")):
+        with trace.span("device_show"):
+            dev_details = nmcli.device.show(f"{INTERFACE}")
+        if dev_details.get("GENERAL.CONNECTION") == CON_NAME and \
+                dev_details.get("IP4.ADDRESS[1]"):
+            logger.info(f"{CON_NAME}: credentials unchanged and already connected")
+            return _nmcli_up(nmcli, trace, dev_details)
+        logger.info(f"{CON_NAME}: credentials unchanged; re-activating")
+        return _nmcli_up(nmcli, trace)
+
     try:
-      nmcli.connection.delete(f"{CON_NAME}")
+      with trace.span("delete"):
+        nmcli.connection.delete(f"{CON_NAME}")
     except:
       print(f'No connection {CON_NAME} to remove')
 
     try:
+      trace.begin("add")
       nmcli.connection.add('wifi', {
           'ssid': ssid.decode('utf-8'),
           'wifi-sec.key-mgmt': 'wpa-psk',
@@ -825,15 +2164,20 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
           'connection.autoconnect-retries': '-1',
           'connection.auth-retries': '-1',
           'connection.permissions': '',  # Allow system-wide use
-          'ipv4.dhcp-timeout': '60'
+          'ipv4.dhcp-timeout': str(DHCP_TIMEOUT_SECS),
+          'ipv4.may-fail': 'no'
       }, f"{INTERFACE}", f"{CON_NAME}", True)
+      trace.end()
       logger.info(f"Successfully created WiFi connection {CON_NAME}")
     except Exception as e:
+      trace.end("fail")
+      trace.error = "nmcli-add"
       logger.error(f"Failed to create WiFi connection {CON_NAME}: {e}", exc_info=True)
       print(f'Could not add new connection {CON_NAME}: {e}')
       return None
 
-    connection_file = f"/etc/NetworkManager/system-connections/{CON_NAME}.nmconnection"
+    connection_file = os.path.join(NM_CONNECTIONS_DIR, f"{CON_NAME}.nmconnection")
+    trace.begin("keyfile")
     try:
         if os.path.exists(connection_file):
             with open(connection_file, 'r') as f:
@@ -863,11 +2207,12 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
         logger.warning(f"Unexpected error adding psk-flags=0 to file: {e}", exc_info=True)
 
     try:
-        subprocess.run(['nmcli', 'connection', 'reload'], check=True, capture_output=True, timeout=5)
+        with trace.span("reload"):
+            subprocess.run(['nmcli', 'connection', 'reload'], check=True, capture_output=True, timeout=5)
     except Exception:
         pass
 
-    connection_file = f"/etc/NetworkManager/system-connections/{CON_NAME}.nmconnection"
+    connection_file = os.path.join(NM_CONNECTIONS_DIR, f"{CON_NAME}.nmconnection")
     try:
         if os.path.exists(connection_file):
             with open(connection_file, 'r') as f:
@@ -877,32 +2222,82 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
     except Exception as e:
         logger.debug(f"Could not verify connection file: {e}")
 
-    try:
-      nmcli.connection.up(f"{CON_NAME}", TIMEOUT)
-    except:
-      print(f'Error bringing connection {CON_NAME} up')
-      return None
+    return _nmcli_up(nmcli, trace)
+
+
+def _nmcli_up(nmcli, trace, dev_details=None):
+    """Bring our profile up, unless `dev_details` (nmcli device show) already
+    has it up, and return the redirect URLs for its address, or None."""
+    if dev_details is None:
+      try:
+        # Association, handshake and DHCP in one blocking call: nmcli does not report the
+        # phases separately (the D-Bus path does).
+        with trace.span("up"):
+          nmcli.connection.up(f"{CON_NAME}", NMCLI_UP_WAIT_SECS)
+      except:
+        trace.error = "nmcli-up"
+        print(f'Error bringing connection {CON_NAME} up')
+        return None
 
-    dev_details = nmcli.device.show(f"{INTERFACE}")
+      with trace.span("device_show"):
+        dev_details = nmcli.device.show(f"{INTERFACE}")
     if 'IP4.ADDRESS[1]' in dev_details.keys():
       dev_addr = dev_details['IP4.ADDRESS[1]']
       ip_addr = dev_addr.split('/')[0]
     else:
+      trace.error = "no-ipv4"
       print('Error connecting')
       return None
 
     # Ask the status loop to refresh immediately so the connected state/SSID/IP
-    # notify promptly. We deliberately do NOT call compute_net_status() here:
-    # this runs on the BLE event loop, and nmcli subprocesses would stall Improv
-    # read/write handling right after provisioning.
+    # notify promptly. This runs on a job-queue worker thread and asyncio
+    # events are not thread-safe, so hand the set() to the loop thread.
     try:
-        _net_refresh_event.set()
+        loop.call_soon_threadsafe(_net_refresh_event.set)
     except Exception as e:
         logger.debug(f"net status refresh request failed: {e}")
 
+    return _redirect_urls(ip_addr)
+
+
+def _redirect_urls(ip_addr):
+    """Improv WIFI_SETTINGS result: the claim URL for this address."""
     token = uuid.uuid4()
-    server = f"https://{SERVER_HOST}?ip_address={ip_addr}&token={token}"
-    return [server]
+    return [f"https://{SERVER_HOST}?ip_address={ip_addr}&token={token}"]
+
+
+async def _connect_wifi(ssid, passwd, trace):
+    """Provision over NM's D-Bus API (NMProvisioner); nmcli (wifi_connect, on
+    the job queue) if that API cannot be reached."""
+    if SCAN_FAIL_FAST and _scan_cache.visible(ssid) is False:
+        # Would only fail after the whole activation timeout.
+        logger.info(f"'{ssid.decode('utf-8', 'replace')}' is not in the Wi-Fi "
+                    f"scan of {_scan_cache.age():.0f}s ago; not trying it")
+        trace.begin("scan_check")
+        trace.end("fail")
+        trace.error = "ssid-not-in-scan"
+        # It may have just come up: have the next attempt see it.
+        _request_scan("ssid not in scan", force=True)
+        return None
+    if PROVISION_VIA_DBUS and _load_dbus_fast():
+        logger.info(f"provisioning '{ssid.decode('utf-8', 'replace')}' "
+                    "via NetworkManager D-Bus")
+        try:
+            ip_addr = await _nm_provisioner.connect(
+                ssid, passwd.decode("utf-8"), trace)
+        except Exception as e:
+            logger.warning(f"NetworkManager D-Bus provisioning unavailable "
+                           f"({e!r}); using nmcli")
+            trace.path = "nmcli"
+        else:
+            if ip_addr is None:
+                return None
+            # Refresh Device-Status now so connected/SSID/IP notify promptly.
+            _net_refresh_event.set()
+            return _redirect_urls(ip_addr)
+    trace.path = "nmcli"
+    return await run_blocking(wifi_connect, ssid, passwd, trace,
+                              priority=improv_jobs.PROVISION)
 
 # Improv chunks its RPC response into <= max_response_bytes packets. The library
 # default (100) is *below* our Wi-Fi-success redirect URL length (~117 B: the
@@ -915,31 +2310,683 @@ def wifi_connect(ssid: str, passwd: str) -> Optional[list[str]]:
 improv_server = ImprovProtocol(wifi_connect_callback=wifi_connect,
                                max_response_bytes=200)
 
+# --- GATT latency / throughput metrics ----------------------------------------
+# Per-characteristic counters and latency histograms for reads, writes and
+# notifications (update_value), plus executor depth, so a slow onboarding can be
+# pinned on our handlers, the loop or blocking work queued behind the executor.
+# Served on a local Unix socket: a bare line (or an HTTP GET) returns JSON;
+# "metrics" / "GET /metrics" returns Prometheus text format, e.g.
+#   curl -s --unix-socket /run/improv/metrics.sock http://improv/metrics
+# Empty IMPROV_METRICS_SOCKET disables the endpoint (counting stays on; it is a
+# few microseconds per operation).
+METRICS_SOCKET = os.getenv("IMPROV_METRICS_SOCKET", "/run/improv/metrics.sock")
+# Histogram upper bounds in seconds (Prometheus `le`); +Inf is implicit.
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+_CHAR_NAMES = {u.value: u.name.lower().replace("_uuid", "") for u in ImprovUUID}
+_CHAR_NAMES.update({
+    DIS_MANUFACTURER_UUID: "dis_manufacturer",
+    DIS_MODEL_UUID: "dis_model",
+    DIS_SERIAL_UUID: "dis_serial",
+    DIS_FW_REV_UUID: "dis_fw_rev",
+    DIS_HW_REV_UUID: "dis_hw_rev",
+    DIS_SW_REV_UUID: "dis_sw_rev",
+    NET_STATUS_CHAR_UUID: "status_json",
+    NET_STATUS_CBOR_CHAR_UUID: "status_cbor",
+    NET_STATUS_DELTA_CHAR_UUID: "status_delta",
+    TRACE_SUMMARY_CHAR_UUID: "provision_trace",
+})
+
+
+def _char_name(char_uuid):
+    key = str(char_uuid).lower()
+    return _CHAR_NAMES.get(key, key)
+
+
+class Histogram:
+    """Latency histogram over METRICS_BUCKETS, with failure and byte counts."""
+
+    __slots__ = ("buckets", "count", "sum", "max", "errors", "bytes")
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.bytes = 0
+
+    def observe(self, secs, ok=True, nbytes=0):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, secs)] += 1
+        self.count += 1
+        self.sum += secs
+        self.max = max(self.max, secs)
+        self.errors += not ok
+        self.bytes += nbytes
+
+    def as_dict(self):
+        return {"count": self.count, "errors": self.errors, "bytes": self.bytes,
+                "sum_ms": round(self.sum * 1000, 3),
+                "max_ms": round(self.max * 1000, 3),
+                "buckets": self.buckets}
+
+
+class GattMetrics:
+    """Thread-safe registry: GATT handlers run on the loop, jobs on worker
+    threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.ops = {}  # (op, char name) -> Histogram; op: read/write/notify
+        self.jobs = {}  # job name -> Histogram (run time)
+        self.job_wait = {c: Histogram() for c in improv_jobs.CLASS_NAMES}
+        self.running = 0
+        self.executor = None  # improv_jobs.JobQueue, for queue depth
+        self.loop_lag = Histogram()  # event-loop probe latency
+        self.stalls = {}  # blocking call site -> stall count
+
+    def observe(self, op, char_uuid, secs, ok=True, nbytes=0):
+        key = (op, _char_name(char_uuid))
+        with self._lock:
+            h = self.ops.get(key)
+            if h is None:
+                h = self.ops[key] = Histogram()
+            h.observe(secs, ok, nbytes)
+
+    def job_started(self, cls, wait_secs):
+        with self._lock:
+            self.running += 1
+            self.job_wait[cls].observe(wait_secs)
+
+    def job_done(self, cls, name, secs, ok):
+        with self._lock:
+            self.running -= 1
+            h = self.jobs.get(name)
+            if h is None:
+                h = self.jobs[name] = Histogram()
+            h.observe(secs, ok)
+
+    def observe_loop_lag(self, secs):
+        with self._lock:
+            self.loop_lag.observe(secs)
+
+    def stall(self, site):
+        with self._lock:
+            self.stalls[site] = self.stalls.get(site, 0) + 1
+
+    def queue_depth(self):
+        """Queued (not yet running) jobs per class."""
+        ex = self.executor
+        if ex is None:
+            return dict.fromkeys(improv_jobs.CLASS_NAMES, 0)
+        return ex.depth()
+
+    def snapshot(self):
+        with self._lock:
+            chars = {}
+            for (op, name), h in self.ops.items():
+                chars.setdefault(name, {})[op] = h.as_dict()
+            jobs = {name: h.as_dict() for name, h in self.jobs.items()}
+            wait = {c: h.as_dict() for c, h in self.job_wait.items()}
+            running = self.running
+            loop_lag = self.loop_lag.as_dict()
+            stalls = dict(self.stalls)
+        _boot, startup = _startup_profile()
+        return {
+            "v": 1,
+            "uptime_s": round(time.monotonic() - self.started, 1),
+            "buckets_s": list(METRICS_BUCKETS),
+            "chars": chars,
+            "executor": {"queued": self.queue_depth(), "running": running,
+                         "wait": wait, "jobs": jobs,
+                         **(self.executor.stats if self.executor else {})},
+            "loop": {"lag": loop_lag, "stalls": stalls},
+            "scheduler": _scheduler.stats(),
+            "advert": {**_advert_stats,
+                       "wakeups": dict(_advert_stats["wakeups"]),
+                       "summary": (_advert_summary.hex()
+                                   if _advert_summary is not None else None)},
+            "long_reads": dict(_snapshots.stats),
+            "warm": {"restored": _warm_restored,
+                     "age_s": (round(_warm.age, 1)
+                               if _warm.age is not None else None),
+                     "saves": _warm.saves},
+            "sd_notify": dict(_notifier.sent),
+            "status_blocks": {k: dict(v) for k, v in _status.stats.items()},
+            "startup_ms": startup,
+        }
+
+    def prometheus(self):
+        def hist(out, metric, labels, h):
+            cum = 0
+            for le, n in zip(METRICS_BUCKETS + ("+Inf",), h.buckets):
+                cum += n
+                out.append(f'{metric}_bucket{{{labels}le="{le}"}} {cum}')
+            out.append(f"{metric}_sum{{{labels.rstrip(',')}}} {h.sum:.6f}")
+            out.append(f"{metric}_count{{{labels.rstrip(',')}}} {h.count}")
+
+        out = []
+        with self._lock:
+            ops = sorted(self.ops.items())
+            jobs = sorted(self.jobs.items())
+            out.append("# HELP improv_gatt_op_seconds GATT handler / "
+                       "update_value latency per characteristic.")
+            out.append("# TYPE improv_gatt_op_seconds histogram")
+            for (op, name), h in ops:
+                hist(out, "improv_gatt_op_seconds", f'op="{op}",char="{name}",', h)
+            out.append("# TYPE improv_gatt_op_bytes_total counter")
+            for (op, name), h in ops:
+                out.append(f'improv_gatt_op_bytes_total{{op="{op}",char="{name}"}} '
+                           f"{h.bytes}")
+            out.append("# TYPE improv_gatt_op_errors_total counter")
+            for (op, name), h in ops:
+                out.append(f'improv_gatt_op_errors_total{{op="{op}",char="{name}"}} '
+                           f"{h.errors}")
+            out.append("# TYPE improv_gatt_update_value_total counter")
+            for (op, name), h in ops:
+                if op != "notify":
+                    continue
+                out.append(f'improv_gatt_update_value_total{{char="{name}",'
+                           f'result="ok"}} {h.count - h.errors}')
+                out.append(f'improv_gatt_update_value_total{{char="{name}",'
+                           f'result="fail"}} {h.errors}')
+            out.append("# TYPE improv_executor_job_seconds histogram")
+            for name, h in jobs:
+                hist(out, "improv_executor_job_seconds", f'job="{name}",', h)
+            out.append("# HELP improv_executor_wait_seconds Time a job spent "
+                       "queued, per priority class.")
+            out.append("# TYPE improv_executor_wait_seconds histogram")
+            for cls, h in self.job_wait.items():
+                hist(out, "improv_executor_wait_seconds", f'class="{cls}",', h)
+            out.append("# TYPE improv_executor_running gauge")
+            out.append(f"improv_executor_running {self.running}")
+            out.append("# HELP improv_loop_lag_seconds Event-loop responsiveness "
+                       "probe latency.")
+            out.append("# TYPE improv_loop_lag_seconds histogram")
+            hist(out, "improv_loop_lag_seconds", "", self.loop_lag)
+            out.append("# TYPE improv_loop_stalls_total counter")
+            for site, n in sorted(self.stalls.items()):
+                site = site.replace("\\", "\\\\").replace('"', '\\"')
+                out.append(f'improv_loop_stalls_total{{site="{site}"}} {n}')
+        out.append("# TYPE improv_executor_queue_depth gauge")
+        for cls, n in self.queue_depth().items():
+            out.append(f'improv_executor_queue_depth{{class="{cls}"}} {n}')
+        if self.executor is not None:
+            for key in ("coalesced", "timeouts", "killed"):
+                out.append(f"# TYPE improv_executor_{key}_total counter")
+                out.append(f"improv_executor_{key}_total "
+                           f"{self.executor.stats[key]}")
+        sched = _scheduler.stats()
+        out.append("# TYPE improv_refresh_wakeups_total counter")
+        for reason, n in sorted(sched["refresh_wakeups"].items()):
+            out.append(f'improv_refresh_wakeups_total{{reason="{reason}"}} {n}')
+        out.append("# TYPE improv_advert_watchdog_wakeups_total counter")
+        for reason, n in sorted(_advert_stats["wakeups"].items()):
+            out.append(f'improv_advert_watchdog_wakeups_total{{reason="{reason}"}} {n}')
+        for key in ("queries", "query_failures", "reasserts", "verified",
+                    "off_air", "summary_updates"):
+            out.append(f"# TYPE improv_advert_{key}_total counter")
+            out.append(f"improv_advert_{key}_total {_advert_stats[key]}")
+        for key, n in sorted(_snapshots.stats.items()):
+            out.append(f"# TYPE improv_long_read_{key}_total counter")
+            out.append(f"improv_long_read_{key}_total {n}")
+        out.append("# TYPE improv_process_wakeups_per_hour gauge")
+        out.append(f"improv_process_wakeups_per_hour {sched['process_wakeups_per_hour']}")
+        out.append("# TYPE improv_cpu_seconds_per_hour gauge")
+        out.append(f"improv_cpu_seconds_per_hour {sched['cpu_s_per_hour']}")
+        out.append("# TYPE improv_uptime_seconds gauge")
+        out.append(f"improv_uptime_seconds {time.monotonic() - self.started:.1f}")
+        return "\n".join(out) + "\n"
+
+
+_metrics = GattMetrics()
+
+
+# --- Event-loop stall detector -------------------------------------------------
+# Everything BLE runs on one asyncio loop, so any blocking call on it (a stray
+# subprocess, a slow file read) freezes GATT reads, notifications and the
+# advertising watchdog. A watchdog thread posts a probe to the loop every
+# LOOP_STALL_MS; if the probe has not run within LOOP_STALL_MS the loop is
+# stalled, and the loop thread's stack is captured there and then (so it names
+# the blocking call, unlike asyncio debug mode which only reports after the
+# fact, and at a cost too high for production). The stall is logged with that
+# stack once the loop recovers, and counted per call site in the metrics. Probe
+# latency feeds the loop-lag histogram. 0 disables.
+LOOP_STALL_MS = int(os.getenv("IMPROV_LOOP_STALL_MS", "250"))
+# Probe period outside BLE sessions (see RefreshScheduler.active). Stalls that
+# start between probes are still caught if they outlast the gap; the full rate
+# only matters while a central is waiting on us.
+LOOP_STALL_IDLE_SECS = float(os.getenv("IMPROV_LOOP_STALL_IDLE_SECS", "10"))
+# Frames of the captured stack that are logged (innermost last).
+LOOP_STALL_STACK_DEPTH = 12
+
+
+class LoopStallDetector:
+    """Watchdog thread that names whatever blocks the event loop.
+
+    A probe posted to the loop that has not run after `threshold_secs` is a
+    stall: the loop thread's stack is captured at that moment, and once the
+    probe runs the stall is logged (with its full duration, from posting) and
+    counted against the call site. Shorter delays only feed the loop-lag
+    histogram. During BLE sessions a probe is posted every `threshold_secs`;
+    outside them only every LOOP_STALL_IDLE_SECS, so there a stall is seen
+    only if it is still going on when the next probe is posted, and one that
+    starts and ends between two probes is missed.
+    """
+
+    def __init__(self, loop, threshold_secs):
+        self.loop = loop
+        self.threshold = threshold_secs
+        self.loop_thread = threading.get_ident()  # construct on the loop thread
+        self._ran = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="improv-stall",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe(self):
+        self._ran.set()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return "?", ""
+        stack = traceback.extract_stack(frame)
+        # Name the innermost frame of this script if there is one (the caller
+        # that blocked), else the innermost frame overall.
+        site = stack[-1]
+        for fs in reversed(stack):
+            if fs.filename == __file__:
+                site = fs
+                break
+        name = f"{site.name} ({os.path.basename(site.filename)}:{site.lineno})"
+        return name, "".join(traceback.format_list(
+            stack[-LOOP_STALL_STACK_DEPTH:]))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._ran.clear()
+            posted = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(self._probe)
+            except RuntimeError:
+                return  # loop closed
+            if not self._ran.wait(self.threshold):
+                site, stack = self._capture()
+                while not self._ran.wait(1.0):
+                    if self._stop.is_set() or self.loop.is_closed():
+                        return
+                stalled = time.monotonic() - posted
+                _metrics.stall(site)
+                logger.warning(f"event loop stalled {stalled * 1000:.0f} ms in "
+                               f"{site}; loop thread stack:\n{stack.rstrip()}")
+            lag = time.monotonic() - posted
+            _metrics.observe_loop_lag(lag)
+            period = (self.threshold if _scheduler.active()
+                      else max(LOOP_STALL_IDLE_SECS, self.threshold))
+            self._stop.wait(max(period - lag, 0.0))
+
+
+_stall_detector: Optional[LoopStallDetector] = None
+
+
+def _start_stall_detector(loop):
+    global _stall_detector
+    if LOOP_STALL_MS <= 0:
+        return
+    _stall_detector = LoopStallDetector(loop, LOOP_STALL_MS / 1000.0)
+    _stall_detector.start()
+
+
+# Per-class run-time limits for blocking jobs. A job over its limit fails with
+# TimeoutError and the processes it forked (a wedged nmcli) are killed, which
+# frees the worker. Provisioning covers delete/add/up of the connection, the
+# `up` waiting up to NMCLI_UP_WAIT_SECS for association and DHCP, plus
+# PROVISION_MARGIN_SECS for the nmcli calls around it; a status collection is
+# itself deadline-bounded, so its limit only catches a wedged worker.
+PROVISION_MARGIN_SECS = 30
+JOB_TIMEOUTS = {
+    improv_jobs.PROVISION: float(os.getenv(
+        "IMPROV_JOB_TIMEOUT_PROVISION_SECS",
+        str(NMCLI_UP_WAIT_SECS + PROVISION_MARGIN_SECS))),
+    improv_jobs.STATUS: float(os.getenv("IMPROV_JOB_TIMEOUT_STATUS_SECS", "15")),
+    improv_jobs.DIAGNOSTICS: float(os.getenv("IMPROV_JOB_TIMEOUT_DIAGNOSTICS_SECS", "10")),
+}
+
+_jobs = improv_jobs.JobQueue(on_start=_metrics.job_started,
+                             on_done=_metrics.job_done)
+_metrics.executor = _jobs
+
+
+async def run_blocking(fn, *args, priority=improv_jobs.STATUS, key=None):
+    """Run blocking `fn(*args)` on the job queue at `priority`, counted in the
+    metrics. Jobs with the same `key` that are still queued share one run."""
+    return await _jobs.run(fn, *args, priority=priority, key=key,
+                           timeout=JOB_TIMEOUTS[priority])
+
+
+def _update_value(service_uuid, char_uuid):
+    """server.update_value (i.e. a notification), timed and counted."""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        ok = bool(server.update_value(service_uuid, char_uuid))
+        return ok
+    finally:
+        ch = server.get_characteristic(char_uuid)
+        nbytes = len(ch.value) if ch is not None and ch.value is not None else 0
+        _metrics.observe("notify", char_uuid, time.perf_counter() - t0, ok,
+                         nbytes)
+
+
+async def _metrics_client(reader, writer):
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout=2)
+        words = line.decode("latin-1").split()
+        http = len(words) >= 2 and words[0] == "GET"
+        target = (words[1] if http else " ".join(words)).strip("/")
+        if http:
+            # Discard the request headers.
+            while (await asyncio.wait_for(reader.readline(), timeout=2)).strip():
+                pass
+        if target in ("metrics", "prometheus"):
+            body = _metrics.prometheus().encode()
+            ctype = "text/plain; version=0.0.4"
+        else:
+            body = (json.dumps(_metrics.snapshot(), separators=(",", ":")) +
+                    "\n").encode()
+            ctype = "application/json"
+        if http:
+            writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: {ctype}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode())
+        writer.write(body)
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"metrics client failed: {e!r}")
+    finally:
+        writer.close()
+
+
+async def _serve_metrics():
+    """Start the metrics endpoint; None if disabled or it cannot be bound."""
+    if not METRICS_SOCKET:
+        return None
+    try:
+        os.makedirs(os.path.dirname(METRICS_SOCKET), exist_ok=True)
+        try:
+            os.unlink(METRICS_SOCKET)  # stale socket from a previous run
+        except FileNotFoundError:
+            pass
+        srv = await asyncio.start_unix_server(_metrics_client, path=METRICS_SOCKET)
+        os.chmod(METRICS_SOCKET, 0o660)
+        logger.info(f"metrics endpoint on {METRICS_SOCKET}")
+        return srv
+    except Exception as e:
+        logger.warning(f"metrics endpoint unavailable ({e!r})")
+        return None
+
+
 def read_request(characteristic: BlessGATTCharacteristic, **kwargs) -> bytearray:
+    t0 = time.perf_counter()
+    value = None
+    _scheduler.note_activity()
+    try:
+        value = _read_request(characteristic, **kwargs)
+        return value
+    finally:
+        _metrics.observe(
+            "read", characteristic.uuid, time.perf_counter() - t0,
+            value is not None,
+            len(value) if isinstance(value, (bytes, bytearray)) else 0)
+
+
+# What each long-read characteristic last published (see _set_and_notify),
+# versioned, so a Read followed by Read Blob requests returns one version whole
+# even if Device-Status changes in between. Reads of everything else are
+# sliced from the live value.
+_snapshots = improv_longread.SnapshotStore()
+_read_hook = None
+
+
+def _read_value(characteristic, offset, device):
+    """ReadValue with its options (improv_longread.ReadValueHook): the value
+    from `offset`, from the snapshot pinned for `device` when there is one."""
+    t0 = time.perf_counter()
+    value = None
+    _scheduler.note_activity()
+    try:
+        uuid_ = str(characteristic.uuid).lower()
+        if uuid_ in _snapshots:
+            value = _snapshots.read(uuid_, offset, device)
+        else:
+            value = bytes(_read_request(characteristic) or b"")
+            if offset > len(value):
+                raise improv_longread.InvalidOffset(
+                    f"offset {offset} past the end of {len(value)} bytes")
+            value = value[offset:]
+        return value
+    finally:
+        _metrics.observe(
+            "read_blob" if offset else "read", characteristic.uuid,
+            time.perf_counter() - t0, value is not None,
+            len(value) if value is not None else 0)
+
+
+def _install_read_hook(gatt):
+    """Serve every characteristic's ReadValue through _read_value. bless's own
+    read path (read_request) drops the offset; it stays for other backends."""
+    global _read_hook
+    _read_hook = improv_longread.ReadValueHook(_read_value)
+    for chars in gatt.values():
+        for char_uuid in chars:
+            ch = server.get_characteristic(char_uuid)
+            path = getattr(ch, "path", None)
+            if path:
+                _read_hook.add(path, ch)
+    _read_hook.install(server.bus)
+
+
+def _read_request(characteristic, **kwargs):
     try:
         improv_char = ImprovUUID(characteristic.uuid)
-        logger.info(f"Reading {improv_char} : {characteristic}")
+        logger.debug("Reading %s : %s", improv_char, characteristic)
     except Exception:
-        logger.info(f"Reading {characteristic.uuid}")
+        logger.debug("Reading %s", characteristic.uuid)
     if str(characteristic.uuid).lower() == NET_STATUS_CHAR_UUID:
         return bytearray(_net_status_json_bytes)
+    if str(characteristic.uuid).lower() == NET_STATUS_CBOR_CHAR_UUID:
+        return bytearray(_net_status_cbor_bytes)
+    if str(characteristic.uuid).lower() == NET_STATUS_DELTA_CHAR_UUID:
+        return bytearray(_net_status_delta_bytes)
+    if str(characteristic.uuid).lower() == TRACE_SUMMARY_CHAR_UUID:
+        return bytearray(_trace_summary_bytes)
     if characteristic.service_uuid == ImprovUUID.SERVICE_UUID.value:
         return improv_server.handle_read(characteristic.uuid)
     return characteristic.value
 
 
+def _notify_improv(target_uuid, values):
+    """Set an Improv characteristic to each value in turn and notify it."""
+    if isinstance(values, (bytes, bytearray)):
+        values = [values]
+    for value in values:
+        logger.debug("Setting %s to %s", target_uuid, value)
+        server.get_characteristic(target_uuid).value = value
+        success = _update_value(ImprovUUID.SERVICE_UUID.value, target_uuid)
+        if not success:
+            logger.warning(f"Updating characteristic return status={success}")
+    if target_uuid == ImprovUUID.STATUS_UUID.value:
+        _refresh_advert_summary()
+        _save_warm_state()
+
+
+# --- Asynchronous provisioning -------------------------------------------------
+# wifi_connect blocks for seconds (nmcli delete/add/reload, then `connection up`
+# waiting up to NMCLI_UP_WAIT_SECS for association + DHCP). pyImprov would call
+# it inline from handle_write, i.e. on the event loop that also serves BlueZ,
+# stalling GATT reads, notifications and the advertising watchdog for the whole
+# attempt. So WIFI_SETTINGS is intercepted here and the attempt runs as a task -
+# D-Bus calls awaited on the loop (NMProvisioner), or wifi_connect on the job
+# queue - while the loop keeps serving; Improv STATUS is notified as it moves
+# PROVISIONING -> PROVISIONED (or back to AUTHORIZED + ERROR on failure).
+_provision_task: Optional[asyncio.Task] = None
+# Event-loop responsiveness budget while a provision is in flight. The lag probe
+# below measures it on every attempt so a regression shows up in the journal.
+PROVISION_LAG_BUDGET_MS = 50
+PROVISION_LAG_PROBE_SECS = 0.02
+
+
+def _notify_improv_state():
+    _notify_improv(ImprovUUID.STATUS_UUID.value,
+                   bytearray(improv_server.state.value.to_bytes(1, "little")))
+
+
+def _notify_improv_error(error):
+    improv_server.last_error = error
+    _notify_improv(ImprovUUID.ERROR_UUID.value,
+                   bytearray(error.value.to_bytes(1, "little")))
+
+
+async def _measure_loop_lag(stop: asyncio.Event):
+    """Return the worst event-loop scheduling lag (ms) seen until `stop` is set."""
+    worst = 0.0
+    while not stop.is_set():
+        t0 = time.monotonic()
+        await asyncio.sleep(PROVISION_LAG_PROBE_SECS)
+        worst = max(worst, time.monotonic() - t0 - PROVISION_LAG_PROBE_SECS)
+    return worst * 1000.0
+
+
+async def _provision(ssid, passwd):
+    """Connect to the network off the BLE loop's critical path and publish
+    the Improv outcome."""
+    stop = asyncio.Event()
+    probe = asyncio.ensure_future(_measure_loop_lag(stop))
+    t0 = time.monotonic()
+    trace = improv_trace.ProvisionTrace("dbus")
+    try:
+        urls = await _connect_wifi(ssid, passwd, trace)
+    except Exception as e:
+        logger.error(f"provisioning failed: {e!r}", exc_info=True)
+        trace.error = trace.error or (
+            "timeout" if isinstance(e, TimeoutError) else "error")
+        urls = None
+    finally:
+        stop.set()
+        lag_ms = await probe
+    elapsed = time.monotonic() - t0
+    record = trace.finish(urls is not None, trace.error or "failed")
+
+    if urls is not None:
+        improv_server.state = ImprovState.PROVISIONED
+        improv_server.rpc_response = improv_server.build_rpc_response(
+            ImprovCommand.WIFI_SETTINGS, urls)
+        _notify_improv(ImprovUUID.RPC_RESULT_UUID.value, improv_server.rpc_response)
+        _notify_improv_state()
+    else:
+        improv_server.state = ImprovState.AUTHORIZED
+        _notify_improv_error(ImprovError.UNABLE_TO_CONNECT)
+        _notify_improv_state()
+
+    log = logger.info if lag_ms <= PROVISION_LAG_BUDGET_MS else logger.warning
+    log(f"provisioning {'succeeded' if urls is not None else 'failed'} in "
+        f"{elapsed:.1f}s; max event-loop lag {lag_ms:.1f} ms "
+        f"(budget {PROVISION_LAG_BUDGET_MS} ms)")
+    logger.info(f"provisioning phases ({trace.path}): {trace.describe()}")
+    # Outside _provision_task: a client retrying as soon as it has the outcome
+    # must not be refused as "in progress" while the ring file is written.
+    task = loop.create_task(_record_trace(record))
+    _trace_tasks.add(task)
+    task.add_done_callback(_trace_tasks.discard)
+
+
+# --- Provisioning traces -------------------------------------------------------
+# Each attempt's phase spans (improv_trace) go to a small on-disk ring and are
+# summarised on a read-only characteristic: per-phase p50/max/failures over the
+# ring plus the last attempt, under 512 bytes. The ring is loaded in run(),
+# after advertising starts.
+_trace_ring: Optional[improv_trace.TraceRing] = None
+_trace_summary_bytes = bytearray(b'{"v":1,"n":0}')
+_trace_tasks = set()  # pending _record_trace tasks (strong references)
+_trace_lock = asyncio.Lock()  # one rewrite of the ring file at a time
+
+
+def _set_trace_summary(notify):
+    global _trace_summary_bytes
+    _trace_summary_bytes = bytearray(_trace_ring.summary())
+    _set_and_notify(TRACE_SUMMARY_CHAR_UUID, _trace_summary_bytes, notify)
+
+
+async def _record_trace(record):
+    if _trace_ring is None:
+        return
+    async with _trace_lock:
+        try:
+            await run_blocking(_trace_ring.add, record,
+                               priority=improv_jobs.DIAGNOSTICS)
+        except Exception as e:
+            logger.debug(f"provisioning trace not saved: {e!r}")
+        _set_trace_summary(notify=True)
+
+
+def _start_provisioning(value):
+    """Validate a WIFI_SETTINGS RPC and start it as a background job."""
+    global _provision_task
+    improv_server.last_error = ImprovError.NONE
+    parsed = improv_server.parse_improv_data(value)
+    if parsed[0] == ImprovCommand.BAD_CHECKSUM or len(parsed) < 3:
+        _notify_improv_error(ImprovError.INVALID_RPC)
+        return
+    if improv_server.state.value < ImprovState.AUTHORIZED.value:
+        _notify_improv_error(ImprovError.NOT_AUTHORIZED)
+        return
+    if _provision_task is not None and not _provision_task.done():
+        # Clients retry writes; one attempt at a time against NetworkManager.
+        logger.warning("provisioning already in progress; ignoring WIFI_SETTINGS")
+        return
+    improv_server.state = ImprovState.PROVISIONING
+    _notify_improv_state()
+    _provision_task = loop.create_task(_provision(parsed[1], parsed[2]))
+
+
 def write_request(characteristic: BlessGATTCharacteristic, value: bytearray, **kwargs):
+    t0 = time.perf_counter()
+    ok = False
+    _scheduler.note_activity()
+    try:
+        _write_request(characteristic, value, **kwargs)
+        ok = True
+    finally:
+        _metrics.observe("write", characteristic.uuid, time.perf_counter() - t0,
+                         ok, len(value or b""))
+
+
+def _write_request(characteristic, value, **kwargs):
     if characteristic.service_uuid == ImprovUUID.SERVICE_UUID.value:
+        if (characteristic.uuid == ImprovUUID.RPC_COMMAND_UUID.value and value
+                and value[0] == ImprovCommand.WIFI_SETTINGS.value):
+            _start_provisioning(value)
+            return
+        if (characteristic.uuid == ImprovUUID.RPC_COMMAND_UUID.value and value
+                and value[0] == ImprovCommand.GET_WIFI_NETWORKS.value):
+            _get_wifi_networks()
+            return
         (target_uuid, target_values) = improv_server.handle_write(characteristic.uuid, value)
         if target_uuid != None and target_values != None:
-            for value in target_values:
-                logger.debug(f"Setting {ImprovUUID(target_uuid)} to {value}")
-                server.get_characteristic(target_uuid).value = value
-                success = server.update_value(ImprovUUID.SERVICE_UUID.value, target_uuid)
-                if not success:
-                    logger.warning(f"Updating characteristic return status={success}")
+            _notify_improv(target_uuid, target_values)
 
 async def run(loop):
+    global _trace_ring
+    # Watch the loop from the start so slow startup steps are caught too.
+    _start_stall_detector(loop)
     server.read_request_func = read_request
     server.write_request_func = write_request
 
@@ -950,27 +2997,70 @@ async def run(loop):
         if not powered:
             logger.info("bluetooth device is not powered, powering now!")
             await interface.set_powered(True)
-
-    await server.add_gatt(build_gatt())
-    await server.start()
+        # bless leaves these as no-ops; use them to refresh promptly when a
+        # central subscribes and to drop back to the idle cadence after.
+        server.app.StartNotify = _on_notify_change
+        server.app.StopNotify = _on_notify_change
+
+    gatt = build_gatt()
+    await server.add_gatt(gatt)
+    # Before advertising, so the first advertisement and the first reads
+    # already carry the last process's state.
+    _restore_warm_state()
+    if isinstance(server, BlessServerBlueZDBus):
+        _install_read_hook(gatt)
+        # BlessServer.start(), split so GATT registration and the first
+        # advertisement are profiled separately.
+        server.bus.export(server.app.path, server.app)
+        await server.app.register(server.adapter)
+        _startup_mark("gatt_registered")
+        await server.app.start_advertising(server.adapter)
+        _refresh_advert_summary()
+    else:
+        await server.start()
+    _startup_mark("advertising")
     logger.info("Server started")
-
-    # Populate the static Device Information Service values.
-    _set_dis_values()
-    # Start the background tasks FIRST — especially the advertising watchdog,
-    # which must run even if the initial network probe below is slow/blocks.
-    # (Creating them before the initial seed guarantees the event loop keeps the
-    # watchdog alive regardless of how long the seed's executor call takes.)
-    net_task = loop.create_task(net_status_loop(loop))
+    _notifier.ready(f"advertising as {SERVICE_NAME}"
+                    + (" (warm start)" if _warm_restored else ""))
+
+    # Everything below is deferred until the board is discoverable: none of it
+    # is needed to advertise, and reads that arrive meanwhile are served the
+    # placeholder snapshot.
+    # Start the advertising watchdog FIRST so it runs even if anything below is
+    # slow or blocks.
     # Self-healing advertising: onboarding must never rely on a manual restart.
-    advert_task = loop.create_task(advertising_watchdog())
-    # Seed network status once (off the BLE loop so nmcli doesn't stall startup);
-    # net_status_loop also refreshes it periodically / on demand.
+    advert_task = loop.create_task(advertising_watchdog(),
+                                   name="advertising watchdog")
+    vital = [advert_task]
+    keepalive_task = loop.create_task(_systemd_keepalive(vital))
+    # Populate the static Device Information Service values (file reads run
+    # off the loop).
     try:
-        status = await loop.run_in_executor(None, compute_device_status)
-        _publish_net_status(status, notify=False)
+        _set_dis_values(await run_blocking(
+            get_dis_values, priority=improv_jobs.DIAGNOSTICS))
     except Exception as e:
-        logger.debug(f"initial net status failed: {e}")
+        logger.warning(f"Device Information Service values unavailable: {e!r}")
+    # Provisioning traces from earlier runs (a small file read, off the loop).
+    try:
+        _trace_ring = await run_blocking(improv_trace.TraceRing,
+                                         priority=improv_jobs.DIAGNOSTICS)
+        _set_trace_summary(notify=False)
+    except Exception as e:
+        logger.warning(f"provisioning traces unavailable: {e!r}")
+    # Subscribe to NetworkManager over D-Bus so Device-Status follows real state
+    # changes instead of forking nmcli every few seconds. Best-effort (every call
+    # is bounded): if NM or dbus-fast is unavailable, net_status_loop keeps
+    # polling nmcli.
+    await _start_nm_monitor()
+    # Seed the Wi-Fi scan cache from NM's AP list and follow its scans.
+    await _start_wifi_scanner()
+    await _start_status_watchers(loop)
+    metrics_server = await _serve_metrics()
+    # The first net_status_loop pass seeds Device-Status (off the BLE loop), now
+    # from the monitor's snapshot rather than a burst of nmcli forks, and within
+    # the collection deadline even if a provider is slow.
+    net_task = loop.create_task(net_status_loop(loop), name="status loop")
+    vital.append(net_task)
 
     try:
         trigger.clear()
@@ -986,19 +3076,39 @@ async def run(loop):
         # (stop/start advertising) — if we let server.stop() run concurrently the
         # two would race over the same BlueZ/D-Bus advertisement resources and
         # produce a messy teardown. Awaiting the cancellation serialises it.
+        _notifier.stopping("shutting down")
         net_task.cancel()
         advert_task.cancel()
-        for t in (net_task, advert_task):
+        keepalive_task.cancel()
+        for t in (net_task, advert_task, keepalive_task):
             try:
                 await t
             except asyncio.CancelledError:
                 pass
             except Exception as e:
                 logger.debug(f"background task raised during shutdown: {e!r}")
+        if metrics_server is not None:
+            metrics_server.close()
+        if _stall_detector is not None:
+            _stall_detector.stop()
     await server.stop()
 
-try:
-    loop.run_until_complete(run(loop))
-except KeyboardInterrupt:
-    logger.debug("Shutting Down")
-    trigger.set()
+
+def main():
+    global loop, server
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    server = BlessServer(name=SERVICE_NAME, loop=loop)
+    _startup_mark("server_created")
+    try:
+        loop.run_until_complete(run(loop))
+    except KeyboardInterrupt:
+        logger.debug("Shutting Down")
+        trigger.set()
+
+
+if __name__ == "__main__":
+    main()
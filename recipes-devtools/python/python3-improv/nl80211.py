@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Minimal in-process nl80211 (generic netlink) client for the Improv onboarding
+# servers. Replaces forking `nmcli -t -f ACTIVE,SSID dev wifi` (which can walk
+# the scan cache) and parsing /proc/net/wireless with a single netlink round
+# trip on a persistent socket: NL80211_CMD_GET_INTERFACE (SSID) and
+# NL80211_CMD_GET_STATION (BSSID, signal, bitrate) are batched into one send.
+#
+# Standard library only. The socket is injectable so the protocol handling can
+# be exercised off-target with a fake (see scripts/target/nl80211-bench.py).
+#
+
+import socket
+import struct
+import threading
+
+NETLINK_GENERIC = 16
+
+# linux/netlink.h
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x02
+NLMSG_DONE = 0x03
+
+# linux/genetlink.h
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+# linux/nl80211.h
+NL80211_CMD_GET_INTERFACE = 5
+NL80211_CMD_GET_STATION = 17
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_MAC = 6
+NL80211_ATTR_STA_INFO = 21
+NL80211_ATTR_SSID = 52
+NL80211_STA_INFO_SIGNAL = 7
+NL80211_STA_INFO_TX_BITRATE = 8
+NL80211_RATE_INFO_BITRATE = 1
+NL80211_RATE_INFO_BITRATE32 = 5
+
+NLMSGHDR = struct.Struct("=IHHII")  # len, type, flags, seq, pid
+GENLMSGHDR = struct.Struct("=BBH")  # cmd, version, reserved
+NLATTR = struct.Struct("=HH")  # len, type
+NLA_TYPE_MASK = 0x3FFF  # strip NLA_F_NESTED / NLA_F_NET_BYTEORDER
+
+
+class NetlinkError(OSError):
+    pass
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def pack_attr(attr_type, payload):
+    """One netlink attribute, padded to 4 bytes."""
+    attr = NLATTR.pack(NLATTR.size + len(payload), attr_type) + payload
+    return attr + b"\0" * (_align(len(attr)) - len(attr))
+
+
+def parse_attrs(data):
+    """Netlink attributes -> {type: payload bytes} (last one wins)."""
+    attrs = {}
+    off = 0
+    while off + NLATTR.size <= len(data):
+        length, attr_type = NLATTR.unpack_from(data, off)
+        if length < NLATTR.size:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[off + NLATTR.size:off + length]
+        off += _align(length)
+    return attrs
+
+
+def pack_genl(msg_type, flags, seq, cmd, attrs=b"", version=1):
+    body = GENLMSGHDR.pack(cmd, version, 0) + attrs
+    return NLMSGHDR.pack(NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body
+
+
+def iter_messages(data):
+    """Split a netlink datagram into (type, flags, seq, payload) tuples."""
+    off = 0
+    while off + NLMSGHDR.size <= len(data):
+        length, msg_type, flags, seq, _pid = NLMSGHDR.unpack_from(data, off)
+        if length < NLMSGHDR.size:
+            break
+        yield msg_type, flags, seq, data[off + NLMSGHDR.size:off + length]
+        off += _align(length)
+
+
+class Nl80211:
+    """Persistent nl80211 client. Thread-safe; one request in flight at a time.
+
+    `sock_factory` returns a connected/bound netlink socket-like object with
+    send/recv/close; it defaults to a real NETLINK_GENERIC socket.
+    """
+
+    RECV_TIMEOUT = 1.0
+
+    def __init__(self, sock_factory=None):
+        self._sock_factory = sock_factory or self._open_socket
+        self._sock = None
+        self._family = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _open_socket(cls):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        sock.bind((0, 0))
+        sock.settimeout(cls.RECV_TIMEOUT)
+        return sock
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+            self._sock = None
+            self._family = None
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF or 1
+        return self._seq
+
+    def _exchange(self, requests):
+        """Send `requests` [(seq, bytes)] in one datagram and collect the reply
+        payloads per seq until each has completed (ACK or DONE)."""
+        if self._sock is None:
+            self._sock = self._sock_factory()
+        pending = {seq for seq, _msg in requests}
+        replies = {seq: [] for seq in pending}
+        self._sock.send(b"".join(msg for _seq, msg in requests))
+        while pending:
+            for msg_type, _flags, seq, payload in iter_messages(self._sock.recv(65536)):
+                if seq not in replies:
+                    continue  # stale reply from an earlier, timed-out request
+                if msg_type == NLMSG_DONE:
+                    pending.discard(seq)
+                elif msg_type == NLMSG_ERROR:
+                    err = -struct.unpack_from("=i", payload)[0]
+                    pending.discard(seq)
+                    if err:
+                        raise NetlinkError(err, f"netlink error {err} (seq {seq})")
+                else:
+                    replies[seq].append(payload[GENLMSGHDR.size:])
+        return replies
+
+    def _resolve_family(self):
+        seq = self._next_seq()
+        msg = pack_genl(GENL_ID_CTRL, NLM_F_REQUEST | NLM_F_ACK, seq,
+                        CTRL_CMD_GETFAMILY,
+                        pack_attr(CTRL_ATTR_FAMILY_NAME, b"nl80211\0"))
+        for payload in self._exchange([(seq, msg)])[seq]:
+            attrs = parse_attrs(payload)
+            if CTRL_ATTR_FAMILY_ID in attrs:
+                return struct.unpack("=H", attrs[CTRL_ATTR_FAMILY_ID][:2])[0]
+        raise NetlinkError(0, "nl80211 family not found")
+
+    def link_info(self, ifname):
+        """Current link of `ifname` as a dict, or None if not associated.
+
+        Keys: ssid (str or None), bssid ("aa:bb:..") and, when the driver
+        reports them, signal (dBm) and tx_bitrate (Mbit/s).
+        """
+        ifindex = socket.if_nametoindex(ifname)
+        with self._lock:
+            try:
+                if self._family is None:
+                    self._family = self._resolve_family()
+                ifattr = pack_attr(NL80211_ATTR_IFINDEX, struct.pack("=I", ifindex))
+                seq_if, seq_sta = self._next_seq(), self._next_seq()
+                replies = self._exchange([
+                    (seq_if, pack_genl(
+                        self._family, NLM_F_REQUEST | NLM_F_ACK, seq_if,
+                        NL80211_CMD_GET_INTERFACE, ifattr)),
+                    (seq_sta, pack_genl(
+                        self._family, NLM_F_REQUEST | NLM_F_DUMP, seq_sta,
+                        NL80211_CMD_GET_STATION, ifattr)),
+                ])
+            except Exception:
+                # Drop the socket so a desynchronised stream never leaks into
+                # the next call; it is re-opened lazily.
+                if self._sock is not None:
+                    self._sock.close()
+                self._sock = None
+                self._family = None
+                raise
+
+        ssid = None
+        for payload in replies[seq_if]:
+            raw = parse_attrs(payload).get(NL80211_ATTR_SSID)
+            if raw:
+                ssid = raw.decode("utf-8", "replace")
+        stations = [parse_attrs(p) for p in replies[seq_sta]]
+        if not stations:
+            return None
+        # A managed (station-mode) interface has exactly one peer: its AP.
+        sta = stations[0]
+        info = {"ssid": ssid, "bssid": None}
+        if NL80211_ATTR_MAC in sta:
+            info["bssid"] = ":".join(f"{b:02x}" for b in sta[NL80211_ATTR_MAC][:6])
+        sinfo = parse_attrs(sta.get(NL80211_ATTR_STA_INFO, b""))
+        if NL80211_STA_INFO_SIGNAL in sinfo:
+            info["signal"] = struct.unpack("=b", sinfo[NL80211_STA_INFO_SIGNAL][:1])[0]
+        rate = parse_attrs(sinfo.get(NL80211_STA_INFO_TX_BITRATE, b""))
+        if NL80211_RATE_INFO_BITRATE32 in rate:
+            info["tx_bitrate"] = struct.unpack("=I", rate[NL80211_RATE_INFO_BITRATE32][:4])[0] / 10
+        elif NL80211_RATE_INFO_BITRATE in rate:
+            info["tx_bitrate"] = struct.unpack("=H", rate[NL80211_RATE_INFO_BITRATE][:2])[0] / 10
+        return info
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Replays an HCI monitor capture through the Improv server's on-air check.
+
+Feeds a btsnoop file in the monitor format (`btmon -w capture.snoop` on the
+board, or `improv-e2e.py --hci-capture`) to improv_hci.AdvertState, the parser
+the e-ink server's advertising watchdog uses, and prints when the Improv
+advertisement went on and off the air and for how long it was off. A ghost
+advertising report from the field can be checked against what the watchdog
+would have decided.
+
+    btmon -w /tmp/adv.snoop                   # on the board, while it happens
+    ./scripts/target/hci-replay.py /tmp/adv.snoop --name eink-1a2b
+    ./scripts/target/hci-replay.py /tmp/adv.snoop --grace 5
+
+The advertisement is recognised by the Improv service UUID or --name in its
+advertising or scan response data. Off-air spells longer than --grace (the
+server's IMPROV_ADVERT_VERIFY_GRACE_SECS) are the ones the watchdog bounces;
+note that a connected central also takes the advertisement off the air.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.join(HERE, "..", "..", "recipes-devtools", "python", "python3-improv"),
+    "/usr/share/improv",
+]
+import improv_hci  # noqa: E402
+
+IMPROV_SERVICE_UUID = "00467768-6228-2272-4663-277478268000"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="btsnoop monitor capture")
+    parser.add_argument("--name", help="device name (e.g. eink-1a2b)")
+    parser.add_argument("--index", type=int, default=0,
+                        help="controller index (hciN)")
+    parser.add_argument("--grace", type=float, default=5.0,
+                        help="off-air seconds before the watchdog bounces")
+    args = parser.parse_args()
+
+    markers = [improv_hci.uuid_marker(IMPROV_SERVICE_UUID)]
+    if args.name:
+        markers.append(args.name.encode())
+    state = improv_hci.AdvertState(markers, index=args.index)
+    packets = improv_hci.read_btsnoop(args.capture)
+    if not packets:
+        sys.exit(f"{args.capture}: no packets")
+
+    def stamp(t):
+        return datetime.datetime.fromtimestamp(t).strftime("%H:%M:%S.%f")[:-3]
+
+    spells = []  # [start, end] off the air
+    for t, packet in packets:
+        if not state.feed(packet, now=t):
+            continue
+        on_air = state.on_air()
+        print(f"{stamp(t)}  {'on air' if on_air else 'OFF AIR'}")
+        if on_air is False:
+            spells.append([t, None])
+        elif spells and spells[-1][1] is None:
+            spells[-1][1] = t
+    end = packets[-1][0]
+    if spells and spells[-1][1] is None:
+        spells[-1][1] = end
+        print(f"{stamp(end)}  (end of capture, still off air)")
+
+    bounced = [s for s in spells if s[1] - s[0] >= args.grace]
+    print(f"\n{len(packets)} packets, {state.packets} from hci{args.index}, "
+          f"{end - packets[0][0]:.1f} s")
+    if state.on_air() is None:
+        print("no advertising command seen: the watchdog would bounce blindly")
+        return
+    print(f"off air {len(spells)}x, {sum(e - s for s, e in spells):.1f} s in "
+          f"total; {len(bounced)} spell(s) over {args.grace:g} s would be "
+          f"bounced")
+    for start, stop in bounced:
+        print(f"  {stamp(start)}  {stop - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
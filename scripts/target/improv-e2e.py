@@ -0,0 +1,804 @@
+#!/usr/bin/env python3
+"""
+End-to-end Improv onboarding run with no Bluetooth or Wi-Fi hardware.
+
+Starts the real onboarding server (default: the imx93-jaguar-eink one) on a
+private D-Bus daemon with the stand-ins from improv_fakes.py: a fake BlueZ
+adapter plus a central talking GATT to the server and the adapter's HCI
+monitor stream, a scripted NetworkManager, a systemd Manager and notify
+socket, and nmcli/fw_printenv/systemctl stubs on PATH. Then it runs:
+
+  startup     spawn -> GATT application registered -> first advertisement
+  scan        Improv GET_WIFI_NETWORKS: scan on connect, ranked/deduplicated
+              list from the cache, a new AP listed from NM's signal, and an
+              out-of-range SSID failing without an activation attempt
+  provision   Improv WIFI_SETTINGS over GATT -> PROVISIONING -> redirect URL
+              (RPC result) -> Device-Status notifies connected with the IP;
+              repeated -n times (provision-to-IP latency)
+  reprovision the same credentials again, connected and after a link loss:
+              the profile must be reused, not rewritten
+  adv-status  the status summary in the advertisement (Improv service data)
+              says provisioned and connected, then follows a link loss in
+              place, without re-registering
+  long-read   Device-Status read at the default ATT MTU (Read + Read Blob);
+              a long read spanning a Device-Status change returns the version
+              it started on
+  wrong-psk   provisioning with a bad PSK ends in UNABLE_TO_CONNECT
+  advert-drop BlueZ forgets the advertisement; the advertising watchdog
+              must re-register it (recovery latency)
+  on-air      no bounce while the HCI monitor shows the advertisement on
+              air; a "ghost" advertisement (stopped by the controller, still
+              counted by BlueZ) must be re-asserted after the grace period
+  stuck-nmcli NetworkManager leaves the bus and the polled `nmcli device
+              show` hangs: the status job's timeout must kill it
+  wedge       BlueZ stops answering; the watchdog must exit so systemd
+              restarts the service
+  restart     the service restarted against a recovered BlueZ: READY=1 and
+              the first advertisement carry the state saved by the previous
+              process (warm start), then WATCHDOG=1 keep-alives
+
+    ./scripts/target/improv-e2e.py
+    ./scripts/target/improv-e2e.py -n 20 --assoc-ms 800 --dhcp-ms 1500
+    ./scripts/target/improv-e2e.py --json e2e.json
+    ./scripts/target/improv-e2e.py --hci-capture e2e.snoop   # see hci-replay.py
+
+Exits non-zero if any scenario fails. Needs dbus-daemon plus the server's own
+Python dependencies (bless, dbus-fast, pyImprov, nmcli).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPROV_DIR = os.path.join(HERE, "..", "..", "recipes-devtools", "python",
+                          "python3-improv")
+sys.path[:0] = [HERE, IMPROV_DIR]
+import improv_fakes  # noqa: E402
+import improv_hci  # noqa: E402
+import improv_status  # noqa: E402
+
+# Improv BLE service (https://www.improv-wifi.com/ble/).
+IMPROV_STATUS = "00467768-6228-2272-4663-277478268001"
+IMPROV_ERROR = "00467768-6228-2272-4663-277478268002"
+IMPROV_RPC_COMMAND = "00467768-6228-2272-4663-277478268003"
+IMPROV_RPC_RESULT = "00467768-6228-2272-4663-277478268004"
+STATE_AUTHORIZED = 0x02
+STATE_PROVISIONING = 0x03
+STATE_PROVISIONED = 0x04
+ERROR_UNABLE_TO_CONNECT = 0x03
+CMD_WIFI_SETTINGS = 0x01
+CMD_GET_WIFI_NETWORKS = 0x04
+# Dynamic Devices Device-Status characteristic (JSON).
+NET_STATUS_CHAR = "e5f10002-9d3a-4b7c-8a21-6f2c9b4d7e10"
+# Provisioning trace summary (JSON).
+PROVISION_TRACE_CHAR = "e5f10005-9d3a-4b7c-8a21-6f2c9b4d7e10"
+
+SSID = "FakeNet"
+PSK = "correct horse"
+ADDRESS = "10.42.0.23"
+# Short, so a blind bounce would show up within the on-air scenario.
+ADVERT_BOUNCE_SECS = 2
+# The server's exit status when it exits for systemd to restart it.
+EXIT_RESTART = 75
+# What the fake NetworkManager can see besides SSID: a second, weaker BSS of
+# SSID, a stronger secured network, an open one and a hidden one.
+NETWORKS = {
+    SSID: {"psk": PSK, "strength": 72, "bss": [41]},
+    "Neighbour": {"psk": "not ours", "strength": 85},
+    "CafeOpen": {"strength": 30},
+    "": {"psk": "hidden", "strength": 90},
+}
+# Improv GET_WIFI_NETWORKS results for NETWORKS: ranked, one per SSID, no
+# hidden networks; RSSI in dBm from NM's 0-100 strength.
+EXPECTED_NETWORKS = [["Neighbour", "-49", "YES"], [SSID, "-57", "YES"],
+                     ["CafeOpen", "-82", "NO"]]
+
+
+def wifi_settings(ssid, psk):
+    data = (bytes([len(ssid)]) + ssid.encode() +
+            bytes([len(psk)]) + psk.encode())
+    packet = bytes([CMD_WIFI_SETTINGS, len(data)]) + data
+    return packet + bytes([sum(packet) & 0xFF])
+
+
+def rpc_fields(value):
+    """Strings of one Improv RPC result packet."""
+    data, fields = value[2:2 + value[1]], []
+    while data:
+        fields.append(data[1:1 + data[0]].decode("utf-8", "replace"))
+        data = data[1 + data[0]:]
+    return fields
+
+
+def status_json(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+
+def net_state(value):
+    return (status_json(value).get("net") or {}).get("state")
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+class Rig:
+    """Private bus, fakes and the server process under test."""
+
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.bus = improv_fakes.PrivateBus(workdir)
+        self.proc = None
+        self.clients = []
+        self.hci = None
+        self.spawned = None
+        self.env = None
+        self.notify = None
+        self.log_path = os.path.join(workdir, "server.log")
+        self.exec_log = os.path.join(workdir, "exec.log")
+
+    async def start(self):
+        self.bus.start()
+        bluez_bus = await self.bus.connect()
+        nm_bus = await self.bus.connect()
+        self.clients = [bluez_bus, nm_bus]
+        self.hci = await improv_fakes.FakeHciMonitor(
+            os.path.join(self.workdir, "hci-monitor.sock")).start()
+        self.bluez = await improv_fakes.FakeBlueZ(bluez_bus, self.hci).start()
+        self.nm = await improv_fakes.FakeNetworkManager(
+            nm_bus, networks=json.loads(json.dumps(NETWORKS)),
+            # NM's last scan is older than the server's TTL: connecting must
+            # trigger a fresh one.
+            last_scan_age=120, address=ADDRESS, assoc_secs=self.args.assoc_ms / 1000.0,
+            dhcp_secs=self.args.dhcp_ms / 1000.0,
+            connections_dir=os.path.join(self.workdir, "system-connections"),
+        ).start()
+        self.systemd = await improv_fakes.FakeSystemd(nm_bus).start()
+        self.notify = await improv_fakes.FakeNotifySocket(
+            os.path.join(self.workdir, "notify.sock")).start()
+        bindir = improv_fakes.write_stubs(os.path.join(self.workdir, "bin"))
+        self.env = dict(
+            os.environ,
+            DBUS_SYSTEM_BUS_ADDRESS=self.bus.address,
+            PATH=bindir + os.pathsep + os.environ.get("PATH", ""),
+            PYTHONPATH=os.pathsep.join(
+                p for p in (IMPROV_DIR, os.environ.get("PYTHONPATH")) if p),
+            PYTHONUNBUFFERED="1",
+            IMPROV_FAKE_EXEC_LOG=self.exec_log,
+            IMPROV_FAKE_NMCLI_HANG=os.path.join(self.workdir, "nmcli-hang"),
+            IMPROV_METRICS_SOCKET=os.path.join(self.workdir, "metrics.sock"),
+            IMPROV_TRACE_DIR=os.path.join(self.workdir, "traces"),
+            IMPROV_NM_CONNECTIONS_DIR=os.path.join(self.workdir,
+                                                   "system-connections"),
+            IMPROV_LOG_LEVEL=self.args.log_level,
+            IMPROV_ADVERT_WATCHDOG_SECS="1",
+            IMPROV_ADVERT_PROBE_SECS="5",
+            IMPROV_ADVERT_DBUS_TIMEOUT="1",
+            IMPROV_ADVERT_MAX_FAILURES="3",
+            IMPROV_ADVERT_BOUNCE_SECS=str(ADVERT_BOUNCE_SECS),
+            IMPROV_ADVERT_VERIFY_GRACE_SECS="0.5",
+            IMPROV_HCI_MONITOR_SOCKET=self.hci.path,
+            # As improv.service runs it: Type=notify, WatchdogSec=2 (short,
+            # so the restart scenario sees keep-alives), and the warm state.
+            NOTIFY_SOCKET=self.notify.path,
+            WATCHDOG_USEC="2000000",
+            IMPROV_WARM_STATE=os.path.join(self.workdir, "warm-state.json"),
+        )
+        self.spawn()
+
+    def spawn(self):
+        """Start the server (again, as systemd would after it exits)."""
+        self.spawned = time.monotonic()
+        self.proc = subprocess.Popen(
+            [sys.executable, self.args.server], env=self.env,
+            stdout=open(self.log_path, "a"), stderr=subprocess.STDOUT)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        for client in self.clients:
+            client.disconnect()
+        if self.hci is not None:
+            self.hci.stop()
+        if self.notify is not None:
+            self.notify.stop()
+        self.bus.stop()
+
+    def log_tail(self, lines=30):
+        try:
+            with open(self.log_path) as f:
+                return "".join(f.readlines()[-lines:])
+        except OSError:
+            return ""
+
+    async def metrics(self):
+        """The server's JSON metrics snapshot. The endpoint comes up after
+        READY=1 (once advertising), so a fresh process gets a few seconds."""
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    os.path.join(self.workdir, "metrics.sock"))
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        try:
+            writer.write(b"json\n")
+            return json.loads(await asyncio.wait_for(reader.read(), 5))
+        finally:
+            writer.close()
+
+    async def until(self, event, what, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            if self.proc.poll() is not None:
+                raise ScenarioFailed(f"server exited ({self.proc.returncode}) "
+                                     f"before {what}")
+            raise ScenarioFailed(f"no {what} within {timeout}s")
+        return time.monotonic()
+
+
+async def scenario_startup(rig):
+    t_app = await rig.until(rig.bluez.app_registered, "GATT registration", 30)
+    t_adv = await rig.until(rig.bluez.advert_registered, "advertisement", 30)
+    t_ready = await rig.until(rig.notify.ready, "READY=1", 10)
+    advert = next(iter(rig.bluez.adverts.values()))
+    rig.central = await rig.bluez.central().connect()
+    for uuid in (IMPROV_STATUS, IMPROV_ERROR, IMPROV_RPC_RESULT,
+                 NET_STATUS_CHAR):
+        await rig.central.subscribe(uuid)
+    state = (await rig.central.read(IMPROV_STATUS))[0]
+    if state != STATE_AUTHORIZED:
+        raise ScenarioFailed(f"Improv state {state:#x}, expected AUTHORIZED")
+    return {
+        "gatt_registered_ms": round((t_app - rig.spawned) * 1000),
+        "first_advert_ms": round((t_adv - rig.spawned) * 1000),
+        "ready_ms": round((t_ready - rig.spawned) * 1000),
+        "local_name": advert.get("LocalName"),
+    }, (f"advertising as {advert.get('LocalName')!r} "
+        f"{(t_adv - rig.spawned) * 1000:.0f} ms after spawn, READY=1 after "
+        f"{(t_ready - rig.spawned) * 1000:.0f} ms")
+
+
+async def _get_wifi_networks(rig):
+    central = rig.central
+    t0 = time.monotonic()
+    packet = bytes([CMD_GET_WIFI_NETWORKS, 0])
+    await central.write(IMPROV_RPC_COMMAND, packet + bytes([sum(packet)]))
+    t_end, _ = await central.wait_notification(
+        IMPROV_RPC_RESULT, lambda v: v[:2] == packet, t0, 30)
+    networks = [rpc_fields(v)
+                for t, v in central.notifications[IMPROV_RPC_RESULT.lower()]
+                if t >= t0 and v[0] == CMD_GET_WIFI_NETWORKS and v[1]]
+    return (t_end - t0) * 1000, networks
+
+
+async def scenario_scan(rig):
+    # The central connected in `startup` with NM's last scan stale, so the
+    # server must have asked for a new one.
+    try:
+        await asyncio.wait_for(_until(lambda: rig.nm.scans > 0), 10)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed("no Wi-Fi scan requested on BLE connect")
+    await asyncio.sleep(0.5)  # its results read back in
+    ms, networks = await _get_wifi_networks(rig)
+    if networks != EXPECTED_NETWORKS:
+        raise ScenarioFailed(f"GET_WIFI_NETWORKS returned {networks!r}")
+    # A network coming into range shows up from NM's AccessPointAdded alone.
+    scans = rig.nm.scans
+    t0 = time.monotonic()
+    rig.nm.add_network("LateNet", "late", strength=60)
+    while True:
+        _ms, later = await _get_wifi_networks(rig)
+        if any(n[0] == "LateNet" for n in later):
+            break
+        if time.monotonic() - t0 > 10:
+            raise ScenarioFailed(f"LateNet never listed: {later!r}")
+        await asyncio.sleep(0.05)
+    t_seen = (time.monotonic() - t0) * 1000
+    if rig.nm.scans != scans:
+        raise ScenarioFailed("an AP appearing made the server scan")
+    rig.nm.remove_network("LateNet")
+    # Out of range per the fresh scan: fail without touching NM.
+    writes = rig.nm.profile_writes
+    central = rig.central
+    t0 = time.monotonic()
+    await central.write(IMPROV_RPC_COMMAND, wifi_settings("FarAwayNet", PSK))
+    t_err, _ = await central.wait_notification(
+        IMPROV_ERROR, lambda v: v[:1] == bytes([ERROR_UNABLE_TO_CONNECT]), t0, 60)
+    await central.wait_notification(
+        IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_AUTHORIZED]), t0, 10)
+    fail_ms = (t_err - t0) * 1000
+    if rig.nm.profile_writes != writes:
+        raise ScenarioFailed("out-of-range SSID was handed to NetworkManager")
+    metrics = {
+        "get_wifi_networks_ms": round(ms, 1),
+        "networks": len(networks),
+        "new_ap_listed_ms": round(t_seen),
+        "unknown_ssid_failed_ms": round(fail_ms, 1),
+    }
+    return metrics, (
+        f"{len(networks)} networks in {ms:.0f} ms, new AP listed after "
+        f"{t_seen:.0f} ms, unknown SSID failed after {fail_ms:.0f} ms")
+
+
+async def _until(predicate, period=0.05):
+    while not predicate():
+        await asyncio.sleep(period)
+
+
+async def _provision_once(rig, psk):
+    central = rig.central
+    t0 = time.monotonic()
+    await central.write(IMPROV_RPC_COMMAND, wifi_settings(SSID, psk))
+    t_prov, _ = await central.wait_notification(
+        IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_PROVISIONING]), t0, 10)
+    return t0, t_prov
+
+
+def _nmcli_forks(rig):
+    try:
+        with open(rig.exec_log) as f:
+            return sum(1 for line in f if line.startswith("nmcli "))
+    except OSError:
+        return 0
+
+
+async def scenario_provision(rig):
+    central = rig.central
+    to_url, to_ip, ack = [], [], []
+    forks0 = _nmcli_forks(rig)
+    for _ in range(rig.args.iterations):
+        if rig.nm.device_details("wlan0")["GENERAL.STATE"].startswith("100"):
+            # Start each round from a disconnected device.
+            t_down = time.monotonic()
+            rig.nm.delete_connection(os.environ.get(
+                "IMPROV_CONNECTION_NAME", "improv-eink"))
+            await central.wait_notification(
+                NET_STATUS_CHAR, lambda v: net_state(v) == "disconnected",
+                t_down, 30)
+        t0, t_prov = await _provision_once(rig, PSK)
+        t_url, result = await central.wait_notification(
+            IMPROV_RPC_RESULT, lambda v: b"ip_address=" in v, t0, 60)
+        if f"ip_address={ADDRESS}".encode() not in result:
+            raise ScenarioFailed(f"redirect URL without the IP: {result!r}")
+        await central.wait_notification(
+            IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_PROVISIONED]), t0, 10)
+        t_ip, _ = await central.wait_notification(
+            NET_STATUS_CHAR,
+            lambda v: (status_json(v).get("net") or {}).get("ipv4") == ADDRESS,
+            t0, 60)
+        ack.append((t_prov - t0) * 1000)
+        to_url.append((t_url - t0) * 1000)
+        to_ip.append((t_ip - t0) * 1000)
+    nm_ms = statistics.median(a[3] for a in rig.nm.activations) * 1000
+    forks = (_nmcli_forks(rig) - forks0) / len(to_url)
+    # The server records the attempt after answering it.
+    deadline = time.monotonic() + 5
+    while True:
+        trace = json.loads(bytes(await central.read(PROVISION_TRACE_CHAR)))
+        if trace.get("ok", 0) >= len(to_url) or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.1)
+    if trace.get("ok", 0) < len(to_url):
+        raise ScenarioFailed(f"provisioning trace summary is missing "
+                             f"attempts: {trace!r}")
+    phases = {name: p[0] for name, p in trace["ph"].items()}
+    slowest = max(phases, key=phases.get)
+    metrics = {
+        "iterations": len(to_url),
+        "provisioning_ack_ms_p50": round(statistics.median(ack), 1),
+        "provision_to_url_ms_p50": round(statistics.median(to_url), 1),
+        "provision_to_url_ms_max": round(max(to_url), 1),
+        "provision_to_ip_status_ms_p50": round(statistics.median(to_ip), 1),
+        "provision_to_ip_status_ms_max": round(max(to_ip), 1),
+        "nm_activation_ms_p50": round(nm_ms, 1),
+        "nmcli_forks_per_provision": round(forks, 1),
+        "trace_phase_ms_p50": phases,
+    }
+    return metrics, (
+        f"x{len(to_url)}: URL p50 {metrics['provision_to_url_ms_p50']:.0f} ms, "
+        f"IP in Device-Status p50 "
+        f"{metrics['provision_to_ip_status_ms_p50']:.0f} ms "
+        f"(NM itself {nm_ms:.0f} ms), {forks:.1f} nmcli forks each, "
+        f"slowest phase {slowest} {phases[slowest]} ms")
+
+
+async def scenario_reprovision(rig):
+    # The same credentials again, first while connected (answered from the
+    # live connection), then with the link lost (the stored profile is only
+    # re-activated). Neither may rewrite the profile.
+    central = rig.central
+    ms, forks = {}, {}
+    for case in ("connected", "reactivate"):
+        if case == "reactivate":
+            t_down = time.monotonic()
+            rig.nm.drop_link()
+            await central.wait_notification(
+                NET_STATUS_CHAR, lambda v: net_state(v) == "disconnected",
+                t_down, 30)
+        writes = rig.nm.profile_writes
+        activations = len(rig.nm.activations)
+        forks0 = _nmcli_forks(rig)
+        t0, _ = await _provision_once(rig, PSK)
+        t_url, result = await central.wait_notification(
+            IMPROV_RPC_RESULT, lambda v: b"ip_address=" in v, t0, 60)
+        if f"ip_address={ADDRESS}".encode() not in result:
+            raise ScenarioFailed(f"redirect URL without the IP: {result!r}")
+        await central.wait_notification(
+            IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_PROVISIONED]), t0, 10)
+        if case == "reactivate":
+            # (While connected Device-Status has nothing new to notify.)
+            await central.wait_notification(
+                NET_STATUS_CHAR,
+                lambda v: (status_json(v).get("net") or {}).get("ipv4") == ADDRESS,
+                t0, 60)
+        if rig.nm.profile_writes != writes:
+            raise ScenarioFailed(f"{case}: unchanged credentials rewrote the "
+                                 f"profile")
+        activated = len(rig.nm.activations) - activations
+        if activated != (case == "reactivate"):
+            raise ScenarioFailed(f"{case}: {activated} activation(s)")
+        ms[case] = (t_url - t0) * 1000
+        forks[case] = _nmcli_forks(rig) - forks0
+    metrics = {
+        "same_credentials_connected_ms": round(ms["connected"], 1),
+        "same_credentials_reactivate_ms": round(ms["reactivate"], 1),
+        "same_credentials_nmcli_forks": forks,
+    }
+    return metrics, (
+        f"same credentials: URL after {ms['connected']:.0f} ms while "
+        f"connected, {ms['reactivate']:.0f} ms re-activating "
+        f"({forks['connected']}/{forks['reactivate']} nmcli forks)")
+
+
+def advert_summary(rig):
+    """The status summary in the advertisement's Improv service data."""
+    for props in rig.bluez.adverts.values():
+        data = props.get("ServiceData", {}).get(
+            improv_status.IMPROV_SERVICE_DATA_UUID)
+        if data is not None:
+            return improv_status.unpack_advert_summary(
+                getattr(data, "value", data))
+    return None
+
+
+async def scenario_advert_status(rig):
+    # Provisioned and online: the advertisement says so without a connection
+    # (once the updates following the last provisioning have reached BlueZ).
+    def online(summary):
+        return (summary is not None and summary["state"] == STATE_PROVISIONED
+                and summary["provisioned"] and summary["link"] == "connected")
+    try:
+        await asyncio.wait_for(_until(lambda: online(advert_summary(rig))), 5)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed(f"advertised summary {advert_summary(rig)!r}, "
+                             f"expected provisioned and connected")
+    # The link drops: the summary follows in place, without re-registering.
+    n_log = len(rig.bluez.advert_log)
+    t0 = time.monotonic()
+    rig.nm.drop_link()
+    try:
+        await asyncio.wait_for(_until(
+            lambda: (advert_summary(rig) or {}).get("link") == "disconnected"),
+            30)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed(f"advertised summary still {advert_summary(rig)!r}"
+                             f" 30s after the link dropped")
+    ms = (time.monotonic() - t0) * 1000
+    after = advert_summary(rig)
+    if not after["provisioned"]:
+        raise ScenarioFailed(f"lost the provisioned flag: {after!r}")
+    registers = sum(1 for _t, what in rig.bluez.advert_log[n_log:]
+                    if what == "register")
+    if registers:
+        raise ScenarioFailed(f"summary update re-registered the advertisement "
+                             f"{registers} time(s)")
+    return {"link_down_ms": round(ms), "summary": after}, (
+        f"connected -> disconnected in the advertisement after {ms:.0f} ms, "
+        f"in place (firmware build {after['build'] or 'unknown'})")
+
+
+async def _read_rest(central, uuid, value):
+    """Finish a long read begun with `value` (Read Blob until short)."""
+    chunk = value
+    while len(chunk) == central.mtu - 1 and len(value) <= 0xFFFF:
+        chunk = await central.read_blob(uuid, len(value))
+        value += chunk
+    return value
+
+
+async def scenario_long_read(rig):
+    # At the default ATT MTU the Device-Status JSON takes a Read and a run of
+    # Read Blob requests; the server must honour each offset.
+    central = rig.central
+    central.mtu = 23
+    try:
+        n0 = central.requests
+        t0 = time.monotonic()
+        whole = await central.read(NET_STATUS_CHAR)
+        ms = (time.monotonic() - t0) * 1000
+        requests = central.requests - n0
+        if not status_json(whole) or net_state(whole) != "disconnected":
+            raise ScenarioFailed(f"long read returned {whole[:80]!r}...")
+        # Device-Status changes in the middle of a long read: the read must
+        # still return the version it started on, whole.
+        first = await central.read_blob(NET_STATUS_CHAR)
+        t1 = time.monotonic()
+        await central.write(IMPROV_RPC_COMMAND, wifi_settings(SSID, PSK))
+        await central.wait_notification(
+            NET_STATUS_CHAR,
+            lambda v: (status_json(v).get("net") or {}).get("ipv4") == ADDRESS,
+            t1, 60)
+        torn = await _read_rest(central, NET_STATUS_CHAR, first)
+        if not status_json(torn) or net_state(torn) != "disconnected":
+            raise ScenarioFailed(f"read across a change returned "
+                                 f"{torn[:80]!r}...")
+        fresh = await central.read(NET_STATUS_CHAR)
+        if net_state(fresh) != "connected":
+            raise ScenarioFailed(f"next read still {net_state(fresh)!r}")
+        # The nmcli path publishes the IP before it reports PROVISIONED; the
+        # next scenario's WIFI_SETTINGS would be refused as in progress.
+        await central.wait_notification(
+            IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_PROVISIONED]), t1, 60)
+    finally:
+        central.mtu = 185
+    return {"bytes": len(whole), "mtu": 23, "requests": requests,
+            "read_ms": round(ms, 1)}, (
+        f"{len(whole)} bytes at MTU 23 in {requests} requests "
+        f"({ms:.0f} ms), one version across a change mid-read")
+
+
+async def scenario_wrong_psk(rig):
+    central = rig.central
+    t0, _ = await _provision_once(rig, "wrong password")
+    t_err, _ = await central.wait_notification(
+        IMPROV_ERROR, lambda v: v[:1] == bytes([ERROR_UNABLE_TO_CONNECT]), t0, 60)
+    await central.wait_notification(
+        IMPROV_STATUS, lambda v: v[:1] == bytes([STATE_AUTHORIZED]), t0, 10)
+    ms = (t_err - t0) * 1000
+    return {"failure_reported_ms": round(ms, 1)}, f"UNABLE_TO_CONNECT after {ms:.0f} ms"
+
+
+async def scenario_advert_drop(rig):
+    # The watchdog leaves the advert alone while a central is connected.
+    await rig.central.disconnect()
+    await asyncio.sleep(0.5)
+    before = await rig.metrics()
+    t0 = time.monotonic()
+    rig.bluez.drop_adverts()
+    t_back = await rig.until(rig.bluez.advert_registered, "re-registration", 30)
+    ms = (t_back - t0) * 1000
+    # BlueZ queries while idle: only the liveness probe should be left.
+    await asyncio.sleep(3)
+    after = await rig.metrics()
+    queries = after["advert"]["queries"] - before["advert"]["queries"]
+    return {"recovery_ms": round(ms), "queries": queries}, (
+        f"advertisement back after {ms:.0f} ms, {queries} BlueZ queries in "
+        f"{after['uptime_s'] - before['uptime_s']:.1f} s")
+
+
+async def scenario_on_air(rig):
+    # While the HCI monitor shows the advert enabled, due bounces are skipped.
+    n_log = len(rig.bluez.advert_log)
+    before = await rig.metrics()
+    await asyncio.sleep(3 * ADVERT_BOUNCE_SECS + 0.5)
+    after = await rig.metrics()
+    bounces = sum(1 for _t, what in rig.bluez.advert_log[n_log:]
+                  if what == "register")
+    verified = after["advert"]["verified"] - before["advert"]["verified"]
+    if bounces or not verified:
+        raise ScenarioFailed(f"{bounces} bounces, {verified} verified in "
+                             f"{3 * ADVERT_BOUNCE_SECS + 0.5:g} s idle")
+    # The controller stops advertising behind BlueZ's back.
+    t0 = time.monotonic()
+    rig.bluez.ghost()
+    t_back = await rig.until(rig.bluez.advert_registered, "re-registration", 30)
+    ms = (t_back - t0) * 1000
+    return {"skipped_bounces": verified, "ghost_recovery_ms": round(ms)}, (
+        f"{verified} bounces skipped while on air, ghost advert re-asserted "
+        f"after {ms:.0f} ms")
+
+
+def _gone(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except OSError:
+        return True
+
+
+async def scenario_stuck_nmcli(rig):
+    # With NM off the bus the monitor is not live and the `net` block is
+    # polled through nmcli; the next `device show` hangs until killed.
+    marker = rig.env["IMPROV_FAKE_NMCLI_HANG"]
+    open(marker, "w").close()
+    timeouts = (await rig.metrics())["status_blocks"]["net"]["timeouts"]
+    await rig.nm.vanish()
+    try:
+        try:
+            await asyncio.wait_for(
+                _until(lambda: os.path.getsize(marker) > 0), 20)
+        except asyncio.TimeoutError:
+            raise ScenarioFailed("no nmcli poll with NetworkManager gone")
+        t_hang = time.monotonic()
+        with open(marker) as f:
+            pid = int(f.read())
+        try:
+            await asyncio.wait_for(_until(lambda: _gone(pid)), 15)
+        except asyncio.TimeoutError:
+            raise ScenarioFailed(f"hung nmcli (pid {pid}) still running 15 s "
+                                 f"later")
+        ms = (time.monotonic() - t_hang) * 1000
+    finally:
+        os.unlink(marker)
+        await rig.nm.reappear()
+    after = (await rig.metrics())["status_blocks"]["net"]["timeouts"]
+    if after <= timeouts:
+        raise ScenarioFailed("the hung compute was not counted as a timeout")
+    return {"hung_nmcli_killed_ms": round(ms)}, (
+        f"hung nmcli killed {ms:.0f} ms after it started")
+
+
+async def scenario_wedge(rig):
+    t0 = time.monotonic()
+    rig.bluez.wedge()
+    loop = asyncio.get_running_loop()
+    try:
+        rc = await asyncio.wait_for(loop.run_in_executor(None, rig.proc.wait), 60)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed("server still running 60s after BlueZ wedged")
+    if rc != EXIT_RESTART:
+        raise ScenarioFailed(f"server exited with {rc}, expected "
+                             f"{EXIT_RESTART}")
+    ms = (time.monotonic() - t0) * 1000
+    if "STOPPING" not in (rig.notify.messages or [(0, {})])[-1][1]:
+        raise ScenarioFailed(f"no STOPPING=1 before the exit (last STATUS "
+                             f"{rig.notify.status()!r})")
+    return {"exit_ms": round(ms)}, f"exited for restart after {ms:.0f} ms"
+
+
+async def scenario_restart(rig):
+    # What the wedged server last advertised; systemd then restarts it against
+    # a recovered BlueZ, which has forgotten the old application.
+    before = advert_summary(rig)
+    with open(rig.env["IMPROV_WARM_STATE"]) as f:
+        saved = json.load(f)["state"]
+    rig.bluez.wedge(False)
+    rig.bluez.drop_adverts()
+    rig.bluez.app = None
+    rig.bluez.app_registered.clear()
+    rig.notify.reset()
+    rig.spawn()
+    t_adv = await rig.until(rig.bluez.advert_registered, "advertisement", 30)
+    t_ready = await rig.until(rig.notify.ready, "READY=1", 10)
+    # The summary is set on the advertisement just before READY=1, from the
+    # saved state: a cold start has none until its first collection.
+    try:
+        await asyncio.wait_for(_until(lambda: advert_summary(rig) == before), 1)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed(f"advertised summary after the restart "
+                             f"{advert_summary(rig)!r}, expected {before!r}")
+    first = advert_summary(rig)
+    if "warm start" not in (rig.notify.status() or ""):
+        raise ScenarioFailed(f"READY status {rig.notify.status()!r}, expected "
+                             f"a warm start")
+    rig.central = await rig.bluez.central().connect()
+    state = (await rig.central.read(IMPROV_STATUS))[0]
+    if state != saved["improv"]["state"]:
+        raise ScenarioFailed(f"Improv state {state:#x} after the restart, "
+                             f"saved {saved['improv']['state']:#x}")
+    metrics = await rig.metrics()
+    if not metrics["warm"]["restored"]:
+        raise ScenarioFailed(f"warm state not restored: {metrics['warm']!r}")
+    # Keep-alives every WATCHDOG_USEC / 2.
+    try:
+        await asyncio.wait_for(_until(lambda: rig.notify.watchdogs >= 2), 10)
+    except asyncio.TimeoutError:
+        raise ScenarioFailed(f"{rig.notify.watchdogs} WATCHDOG=1 keep-alives "
+                             f"in 10 s")
+    adv_ms = (t_adv - rig.spawned) * 1000
+    ready_ms = (t_ready - rig.spawned) * 1000
+    return {"first_advert_ms": round(adv_ms), "ready_ms": round(ready_ms),
+            "state_age_s": metrics["warm"]["age_s"]}, (
+        f"advertising {adv_ms:.0f} ms after respawn, with the saved summary "
+        f"(link {first['link']}), READY=1 after {ready_ms:.0f} ms")
+
+
+SCENARIOS = [
+    ("startup", scenario_startup),
+    ("scan", scenario_scan),
+    ("provision", scenario_provision),
+    ("reprovision", scenario_reprovision),
+    ("adv-status", scenario_advert_status),
+    ("long-read", scenario_long_read),
+    ("wrong-psk", scenario_wrong_psk),
+    ("advert-drop", scenario_advert_drop),
+    ("on-air", scenario_on_air),
+    ("stuck-nmcli", scenario_stuck_nmcli),
+    ("wedge", scenario_wedge),
+    ("restart", scenario_restart),
+]
+
+
+async def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="improv-e2e-") as workdir:
+        rig = Rig(args, workdir)
+        try:
+            await rig.start()
+            for name, fn in SCENARIOS:
+                try:
+                    metrics, summary = await fn(rig)
+                    results[name] = dict(metrics, ok=True)
+                    print(f"{name:<12} ok    {summary}")
+                except (ScenarioFailed, asyncio.TimeoutError) as e:
+                    results[name] = {"ok": False, "error": str(e) or "timeout"}
+                    print(f"{name:<12} FAIL  {results[name]['error']}")
+                    # Later scenarios build on the earlier ones.
+                    break
+        finally:
+            rig.stop()
+            if args.hci_capture and rig.hci is not None:
+                improv_hci.write_btsnoop(args.hci_capture, rig.hci.frames)
+            try:
+                with open(rig.exec_log) as f:
+                    forks = sum(1 for _ in f)
+            except OSError:
+                forks = 0
+            results["forks"] = forks
+            if not all(r.get("ok") for r in results.values()
+                       if isinstance(r, dict)):
+                print("--- server log (tail) ---\n" + rig.log_tail())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--server", default=os.path.join(
+        IMPROV_DIR, "imx93-jaguar-eink", "onboarding-server.py"))
+    parser.add_argument("-n", "--iterations", type=int, default=5,
+                        help="provisioning rounds")
+    parser.add_argument("--assoc-ms", type=float, default=300,
+                        help="fake association time")
+    parser.add_argument("--dhcp-ms", type=float, default=500,
+                        help="fake DHCP time")
+    parser.add_argument("--log-level", default="INFO",
+                        help="server IMPROV_LOG_LEVEL")
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--hci-capture",
+                        help="write the fake HCI monitor stream here "
+                             "(btsnoop, for hci-replay.py or btmon -r)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    ok = all(name in results and results[name].get("ok")
+             for name, _ in SCENARIOS)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1485 @@
+#!/usr/bin/env python3
+"""
+Hardware-free stand-ins for the backends of the Improv onboarding server
+(recipes-devtools/python/python3-improv/*/onboarding-server.py), so the real
+server runs unmodified on a plain Linux box (see improv-e2e.py):
+
+  - PrivateBus: a throwaway dbus-daemon. The server, bless and dbus-fast all
+    honour DBUS_SYSTEM_BUS_ADDRESS, so it stands in for the system bus.
+  - FakeBlueZ: org.bluez with one adapter (Adapter1, GattManager1,
+    LEAdvertisingManager1). Like bluetoothd it pulls the registered GATT
+    application and advertisement back over D-Bus (and follows the
+    advertisement's property changes), and FakeCentral drives the application
+    the way BlueZ does for a connected phone (ReadValue, WriteValue,
+    StartNotify, PropertiesChanged notifications). Faults:
+    drop_adverts() (BlueZ forgets the advertisement), ghost() (the controller
+    stops advertising while BlueZ still counts it) and wedge() (BlueZ stops
+    answering).
+  - FakeHciMonitor: the kernel's HCI monitor channel as a Unix socket. Fed by
+    FakeBlueZ with the controller traffic of its (un)registrations and
+    faults, or replaying a btmon capture (improv_hci.read_btsnoop).
+  - FakeNetworkManager: the subset of org.freedesktop.NetworkManager the
+    server's D-Bus monitor reads and its D-Bus provisioning path calls
+    (Settings, AddAndActivateConnection2, Update2, ActivateConnection),
+    walking the device through NM's state codes on a script (association and
+    DHCP delays, wrong PSK, SSID out of range), plus access points and
+    scanning (GetAllAccessPoints, RequestScan, AccessPointAdded/Removed).
+    A private control interface backs the stub nmcli.
+  - FakeSystemd: Manager.Subscribe/LoadUnit and one unit's ActiveState.
+  - FakeNotifySocket: the service manager's $NOTIFY_SOCKET, recording the
+    server's READY=1, STATUS= and WATCHDOG=1 messages.
+  - write_stubs(): nmcli, sudo, fw_printenv and systemctl on PATH. Each call
+    is appended to $IMPROV_FAKE_EXEC_LOG when set, so forks can be counted.
+    An empty file at $IMPROV_FAKE_NMCLI_HANG makes the next `nmcli device
+    show` hang until killed, with its PID written to that file.
+
+Needs dbus-fast and the dbus-daemon binary.
+"""
+
+import asyncio
+import json
+import os
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+
+from dbus_fast import DBusError, Message, MessageType, Variant
+from dbus_fast.aio import MessageBus
+from dbus_fast.constants import PropertyAccess
+from dbus_fast.service import ServiceInterface, dbus_property, method, signal
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "recipes-devtools", "python",
+                                "python3-improv"))
+import improv_hci  # noqa: E402
+
+BLUEZ = "org.bluez"
+ADAPTER_PATH = "/org/bluez/hci0"
+DEVICE_PATH = ADAPTER_PATH + "/dev_FA_KE_00_00_00_01"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+ADVERT_IFACE = "org.bluez.LEAdvertisement1"
+PROPS_IFACE = "org.freedesktop.DBus.Properties"
+# UUIDs ending in this are 16-bit ones in the Bluetooth base range.
+_BT_BASE_UUID = "-0000-1000-8000-00805f9b34fb"
+
+NM = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_DEVICE_PATH = NM_PATH + "/Devices/3"
+NM_SETTINGS_PATH = NM_PATH + "/Settings"
+NM_FAKE_IFACE = "com.dynamicdevices.ImprovFake1"
+
+SYSTEMD = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+
+# NetworkManager device states (NMDeviceState).
+NM_DEVICE_DISCONNECTED = 30
+NM_DEVICE_PREPARE = 40
+NM_DEVICE_CONFIG = 50
+NM_DEVICE_NEED_AUTH = 60
+NM_DEVICE_IP_CONFIG = 70
+NM_DEVICE_ACTIVATED = 100
+NM_DEVICE_FAILED = 120
+
+# NMActiveConnectionState / NMActiveConnectionStateReason.
+NM_ACTIVE_ACTIVATING = 1
+NM_ACTIVE_ACTIVATED = 2
+NM_ACTIVE_DEACTIVATED = 4
+NM_ACTIVE_REASON_DEVICE_DISCONNECTED = 3
+NM_ACTIVE_REASON_NO_SECRETS = 9
+
+# Settings group -> prefix of its keys in the flat, nmcli-style property
+# names connections are kept under (`ssid`, `wifi-sec.psk`, `ipv4.method`).
+_NM_GROUP_PREFIX = {"802-11-wireless": "", "802-11-wireless-security":
+                    "wifi-sec."}
+
+
+def _flatten(settings):
+    """a{sa{sv}} connection settings -> flat nmcli-style properties."""
+    flat = {}
+    for group, props in settings.items():
+        prefix = _NM_GROUP_PREFIX.get(group, group + ".")
+        for key, value in props.items():
+            value = value.value
+            if isinstance(value, (bytes, bytearray)):
+                value = bytes(value).decode("utf-8", "replace")
+            flat[prefix + key] = value
+    return flat
+
+
+class PrivateBus:
+    """A private dbus-daemon with the permissive session policy."""
+
+    def __init__(self, workdir):
+        self.address = f"unix:path={os.path.join(workdir, 'system_bus_socket')}"
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--nopidfile",
+             f"--address={self.address}", "--print-address=1"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        line = self.proc.stdout.readline().strip()
+        if not line:
+            raise RuntimeError("dbus-daemon did not start")
+        self.address = line
+        return self
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait(timeout=5)
+            self.proc = None
+
+    async def connect(self):
+        return await MessageBus(bus_address=self.address).connect()
+
+
+async def _call(bus, destination, path, interface, member, signature="",
+                body=(), timeout=5.0):
+    reply = await asyncio.wait_for(
+        bus.call(Message(destination=destination, path=path,
+                         interface=interface, member=member,
+                         signature=signature, body=list(body))),
+        timeout=timeout)
+    if reply.message_type == MessageType.ERROR:
+        raise RuntimeError(f"{interface}.{member}: {reply.error_name} "
+                           f"{reply.body}")
+    return reply.body
+
+
+# --- HCI monitor ---------------------------------------------------------------
+
+# HCI commands/events FakeBlueZ sends that the server's parser has no use for.
+LE_SET_EXT_ADV_PARAMS = 0x2036
+EVT_DISCONN_COMPLETE = 0x05
+
+
+def mon_frame(opcode, payload, index=0):
+    return improv_hci.MON_HDR.pack(opcode, index, len(payload)) + payload
+
+
+def hci_command(cmd, params=b"", index=0):
+    return mon_frame(improv_hci.HCI_MON_COMMAND_PKT,
+                     struct.pack("<HB", cmd, len(params)) + params, index)
+
+
+def hci_event(evt, params=b"", index=0):
+    return mon_frame(improv_hci.HCI_MON_EVENT_PKT,
+                     struct.pack("<BB", evt, len(params)) + params, index)
+
+
+def hci_exchange(cmd, params=b"", status=0, index=0):
+    """A command and its Command Complete."""
+    return [hci_command(cmd, params, index),
+            hci_event(improv_hci.EVT_CMD_COMPLETE,
+                      struct.pack("<BHB", 1, cmd, status), index)]
+
+
+class FakeHciMonitor:
+    """The HCI monitor channel on a Unix SOCK_SEQPACKET socket (the server's
+    IMPROV_HCI_MONITOR_SOCKET): one monitor frame per message, sent to every
+    client connected at the time, like the kernel's. Everything sent is kept
+    in `frames` with its wall-clock time, for improv_hci.write_btsnoop()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = []
+        self._listener = None
+        self._clients = []
+
+    async def start(self):
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._listener.bind(self.path)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._listener.fileno(),
+                                              self._accept)
+        return self
+
+    def _accept(self):
+        try:
+            client, _addr = self._listener.accept()
+        except BlockingIOError:
+            return
+        self._clients.append(client)
+
+    def send(self, *frames):
+        for frame in frames:
+            self.frames.append((time.time(), frame))
+            for client in list(self._clients):
+                try:
+                    client.send(frame)
+                except OSError:
+                    self._clients.remove(client)
+                    client.close()
+
+    async def replay(self, frames, speed=0.0):
+        """Send a capture's [(time, frame)]; `speed` 1.0 keeps its pacing,
+        0 sends it at once."""
+        prev = None
+        for t, frame in frames:
+            if speed and prev is not None and t > prev:
+                await asyncio.sleep((t - prev) / speed)
+            prev = t
+            self.send(frame)
+
+    def stop(self):
+        if self._listener is not None:
+            asyncio.get_running_loop().remove_reader(self._listener.fileno())
+            self._listener.close()
+            self._listener = None
+        for client in self._clients:
+            client.close()
+        self._clients = []
+
+
+def _ad_structures(props):
+    """Advertising and scan response data for an LEAdvertisement1, the way
+    bluetoothd lays it out: flags, the 128-bit service UUIDs and the service
+    data first, the name in the scan response when it does not fit. More
+    than 31 bytes of advertising data is refused, as by the kernel."""
+    data = bytes([2, 0x01, 0x06])
+    uuids = b"".join(uuid.UUID(u).bytes[::-1]
+                     for u in props.get("ServiceUUIDs", ()))
+    if uuids:
+        data += bytes([len(uuids) + 1, 0x07]) + uuids
+    for u, value in props.get("ServiceData", {}).items():
+        value = bytes(getattr(value, "value", value))
+        full = uuid.UUID(u)
+        if str(full).endswith(_BT_BASE_UUID):
+            u_bytes, ad_type = struct.pack("<H", full.int >> 96), 0x16
+        else:
+            u_bytes, ad_type = full.bytes[::-1], 0x21
+        data += bytes([len(u_bytes) + len(value) + 1, ad_type]) + u_bytes + value
+    if len(data) > 31:
+        raise ValueError(f"advertising data too long ({len(data)} bytes)")
+    name = props.get("LocalName", "").encode()
+    name_ad = bytes([len(name) + 1, 0x09]) + name if name else b""
+    if len(data) + len(name_ad) <= 31:
+        return data + name_ad, b""
+    return data, name_ad
+
+
+# --- BlueZ --------------------------------------------------------------------
+
+class _Adapter(ServiceInterface):
+
+    def __init__(self):
+        super().__init__("org.bluez.Adapter1")
+        self._powered = False
+        self._alias = "fake-hci0"
+
+    @dbus_property()
+    def Powered(self) -> "b":  # noqa: N802
+        return self._powered
+
+    @Powered.setter
+    def Powered(self, value: "b"):  # noqa: N802
+        self._powered = value
+
+    @dbus_property()
+    def Alias(self) -> "s":  # noqa: N802
+        return self._alias
+
+    @Alias.setter
+    def Alias(self, value: "s"):  # noqa: N802
+        self._alias = value
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> "s":  # noqa: N802
+        return "00:FA:KE:00:00:00"
+
+
+class _Root(ServiceInterface):
+    """Placeholder at "/": dbus-fast only lists ObjectManager (which bless
+    looks for there) on paths that export an interface."""
+
+    def __init__(self):
+        super().__init__(NM_FAKE_IFACE + ".Root")
+
+
+class _GattManager(ServiceInterface):
+
+    def __init__(self, bluez):
+        super().__init__("org.bluez.GattManager1")
+        self.bluez = bluez
+
+    @method()
+    async def RegisterApplication(self, path: "o", options: "a{sv}"):  # noqa: N802
+        await self.bluez._register_app(self.bluez._owners.pop(path), path)
+
+    @method()
+    def UnregisterApplication(self, path: "o"):  # noqa: N802
+        self.bluez.app = None
+
+
+class _AdvertisingManager(ServiceInterface):
+
+    def __init__(self, bluez):
+        super().__init__("org.bluez.LEAdvertisingManager1")
+        self.bluez = bluez
+
+    @method()
+    async def RegisterAdvertisement(self, path: "o", options: "a{sv}"):  # noqa: N802
+        await self.bluez._register_advert(self.bluez._owners.pop(path), path)
+
+    @method()
+    def UnregisterAdvertisement(self, path: "o"):  # noqa: N802
+        self.bluez._unregister_advert(path)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveInstances(self) -> "y":  # noqa: N802
+        return len(self.bluez.adverts)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def SupportedInstances(self) -> "y":  # noqa: N802
+        return max(0, 4 - len(self.bluez.adverts))
+
+
+class _Device(ServiceInterface):
+
+    def __init__(self):
+        super().__init__("org.bluez.Device1")
+        self._connected = False
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Connected(self) -> "b":  # noqa: N802
+        return self._connected
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> "s":  # noqa: N802
+        return "FA:KE:00:00:00:01"
+
+    def set_connected(self, value):
+        if value != self._connected:
+            self._connected = value
+            self.emit_properties_changed({"Connected": value})
+
+
+class FakeBlueZ:
+    """org.bluez with one adapter, as far as bless and the watchdog use it.
+
+    Records every advertisement (un)registration with a monotonic timestamp in
+    `advert_log`, so recovery latency can be measured from the outside. With
+    a FakeHciMonitor the controller side of each (un)registration goes
+    through it too, one extended advertising set per advertisement.
+    """
+
+    def __init__(self, bus, monitor=None):
+        self.bus = bus
+        self.monitor = monitor
+        self._handles = {}  # advertisement path -> advertising set handle
+        self._next_handle = 1
+        self.adapter = _Adapter()
+        self.gatt = _GattManager(self)
+        self.advertising = _AdvertisingManager(self)
+        self.device = _Device()
+        self.app = None  # (owner, application path)
+        self.adverts = {}  # advertisement path -> properties
+        # (monotonic, "register" | "unregister" | "update" | "reject" | "drop"
+        #  | "ghost")
+        self.advert_log = []
+        self.app_registered = asyncio.Event()
+        self.advert_registered = asyncio.Event()
+        self._owners = {}  # object path being registered -> caller
+        self._wedged = False
+
+    async def start(self):
+        # Method handlers cannot see the caller; remember it for them.
+        self.bus.add_message_handler(self._on_call)
+        self.bus.export("/", _Root())
+        for iface in (self.adapter, self.gatt, self.advertising):
+            self.bus.export(ADAPTER_PATH, iface)
+        # bluetoothd follows property changes of registered advertisements.
+        await _call(self.bus, "org.freedesktop.DBus", "/org/freedesktop/DBus",
+                    "org.freedesktop.DBus", "AddMatch", "s",
+                    (f"type='signal',interface='{PROPS_IFACE}',"
+                     f"member='PropertiesChanged',arg0='{ADVERT_IFACE}'",))
+        await self.bus.request_name(BLUEZ)
+        return self
+
+    def _on_call(self, msg):
+        if (msg.message_type == MessageType.SIGNAL
+                and msg.member == "PropertiesChanged"
+                and msg.body and msg.body[0] == ADVERT_IFACE):
+            self._advert_changed(msg.path, msg.body[1])
+            return None
+        if msg.message_type != MessageType.METHOD_CALL:
+            return None
+        if self._wedged and msg.path.startswith(ADAPTER_PATH):
+            return True  # swallowed: the caller waits for a reply forever
+        if msg.member in ("RegisterApplication", "RegisterAdvertisement"):
+            self._owners[msg.body[0]] = msg.sender
+        return None
+
+    async def _register_app(self, owner, path):
+        self.app = (owner, path)
+        self.app_registered.set()
+
+    async def _register_advert(self, owner, path):
+        # bluetoothd reads the advertisement's properties before accepting it.
+        props = (await _call(self.bus, owner, path, PROPS_IFACE, "GetAll", "s",
+                             (ADVERT_IFACE,)))[0]
+        self.adverts[path] = {k: v.value for k, v in props.items()}
+        self._hci_enable(path)
+        self.advert_log.append((time.monotonic(), "register"))
+        self._advert_count_changed()
+        self.advert_registered.set()
+
+    def _unregister_advert(self, path):
+        self.adverts.pop(path, None)
+        self._hci_remove(path)
+        self.advert_log.append((time.monotonic(), "unregister"))
+        self._advert_count_changed()
+
+    def _advert_changed(self, path, changed):
+        """An advertisement's properties changed: bluetoothd refreshes the
+        advertising data in place (logged as "update", or "reject" when the
+        kernel would refuse it)."""
+        if path not in self.adverts:
+            return
+        props = dict(self.adverts[path])
+        props.update({k: v.value for k, v in changed.items()})
+        try:
+            data, _scan_rsp = _ad_structures(props)
+        except ValueError:
+            self.advert_log.append((time.monotonic(), "reject"))
+            return
+        self.adverts[path] = props
+        handle = self._handles.get(path)
+        if self.monitor is not None and handle is not None:
+            self.monitor.send(*hci_exchange(
+                improv_hci.LE_SET_EXT_ADV_DATA,
+                bytes([handle, improv_hci.EXT_OP_COMPLETE, 1, len(data)]) + data))
+        self.advert_log.append((time.monotonic(), "update"))
+
+    def _advert_count_changed(self):
+        self.advertising.emit_properties_changed(
+            {"ActiveInstances": len(self.adverts)})
+
+    def _hci_enable(self, path):
+        if self.monitor is None:
+            return
+        handle = self._handles[path] = self._next_handle
+        self._next_handle += 1
+        data, scan_rsp = _ad_structures(self.adverts[path])
+        h = bytes([handle])
+        hci = improv_hci
+        self.monitor.send(
+            *hci_exchange(LE_SET_EXT_ADV_PARAMS, h + bytes(24)),
+            *hci_exchange(hci.LE_SET_EXT_ADV_DATA,
+                          h + bytes([hci.EXT_OP_COMPLETE, 1, len(data)]) + data),
+            *hci_exchange(hci.LE_SET_EXT_SCAN_RSP_DATA,
+                          h + bytes([hci.EXT_OP_COMPLETE, 1, len(scan_rsp)]) +
+                          scan_rsp),
+            *hci_exchange(hci.LE_SET_EXT_ADV_ENABLE,
+                          bytes([1, 1]) + h + bytes(3)))
+
+    def _hci_remove(self, path):
+        handle = self._handles.pop(path, None)
+        if self.monitor is None or handle is None:
+            return
+        h = bytes([handle])
+        self.monitor.send(
+            *hci_exchange(improv_hci.LE_SET_EXT_ADV_ENABLE,
+                          bytes([0, 1]) + h + bytes(3)),
+            *hci_exchange(improv_hci.LE_REMOVE_ADV_SET, h))
+
+    def ghost(self):
+        """A central connects and the link fails before it is used: the
+        controller ends the advertising sets and bluetoothd never re-enables
+        them, while ActiveInstances stays as it was."""
+        hci = improv_hci
+        conn = 0x0040
+        for handle in self._handles.values():
+            self.monitor.send(hci_event(hci.EVT_LE_META, struct.pack(
+                "<BBBHB", hci.LE_ADV_SET_TERMINATED, 0, handle, conn, 0)))
+        self.monitor.send(
+            hci_event(hci.EVT_LE_META, struct.pack(
+                "<BBHB", hci.LE_ENH_CONN_COMPLETE, 0, conn,
+                hci.ROLE_PERIPHERAL) + bytes(26)),
+            # 0x3E: connection failed to be established
+            hci_event(EVT_DISCONN_COMPLETE, struct.pack("<BHB", 0, conn, 0x3E)))
+        self.advert_registered.clear()
+        self.advert_log.append((time.monotonic(), "ghost"))
+
+    def drop_adverts(self):
+        """BlueZ forgets every advertisement (ActiveInstances -> 0)."""
+        for path in list(self.adverts):
+            self._hci_remove(path)
+        self.adverts.clear()
+        self.advert_registered.clear()
+        self.advert_log.append((time.monotonic(), "drop"))
+        self._advert_count_changed()
+
+    def wedge(self, wedged=True):
+        """Stop answering calls on the adapter (a hung bluetoothd)."""
+        self._wedged = wedged
+
+    def central(self):
+        if self.app is None:
+            raise RuntimeError("no GATT application registered")
+        return FakeCentral(self)
+
+
+class FakeCentral:
+    """A phone connected through FakeBlueZ to the registered GATT application.
+
+    Reads, writes and subscriptions go to the application's objects exactly
+    as bluetoothd sends them; notifications are the application's Value
+    PropertiesChanged signals, timestamped on arrival.
+    """
+
+    def __init__(self, bluez):
+        self.bluez = bluez
+        self.bus = bluez.bus
+        self.owner, self.app_path = bluez.app
+        self.chars = {}  # uuid -> object path
+        self.paths = {}  # object path -> uuid
+        self.notifications = {}  # uuid -> [(monotonic, bytes)]
+        self.mtu = 185  # ATT MTU: a response carries at most mtu - 1 bytes
+        self.requests = 0  # ATT Read / Read Blob requests sent
+        self._changed = asyncio.Condition()
+        self._match = None
+
+    async def connect(self):
+        objects = (await _call(self.bus, self.owner, self.app_path,
+                               "org.freedesktop.DBus.ObjectManager",
+                               "GetManagedObjects"))[0]
+        for path, ifaces in objects.items():
+            chrc = ifaces.get(GATT_CHRC_IFACE)
+            if chrc is not None:
+                uuid = chrc["UUID"].value.lower()
+                self.chars[uuid] = path
+                self.paths[path] = uuid
+        self._match = (f"type='signal',sender='{self.owner}',"
+                       f"interface='{PROPS_IFACE}',member='PropertiesChanged'")
+        await _call(self.bus, "org.freedesktop.DBus", "/org/freedesktop/DBus",
+                    "org.freedesktop.DBus", "AddMatch", "s", (self._match,))
+        self.bus.add_message_handler(self._on_signal)
+        self.bluez.bus.export(DEVICE_PATH, self.bluez.device)
+        self.bluez.device.set_connected(True)
+        return self
+
+    async def disconnect(self):
+        for char_uuid in list(self.notifications):
+            try:
+                await self.unsubscribe(char_uuid)
+            except Exception:
+                pass
+        self.bluez.device.set_connected(False)
+        self.bluez.bus.unexport(DEVICE_PATH, self.bluez.device)
+        self.bus.remove_message_handler(self._on_signal)
+        if self._match is not None:
+            await _call(self.bus, "org.freedesktop.DBus",
+                        "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                        "RemoveMatch", "s", (self._match,))
+
+    def _on_signal(self, msg):
+        if (msg.message_type != MessageType.SIGNAL
+                or msg.member != "PropertiesChanged"
+                or msg.path not in self.paths):
+            return None
+        iface, changed = msg.body[0], msg.body[1]
+        uuid = self.paths[msg.path]
+        if iface == GATT_CHRC_IFACE and "Value" in changed \
+                and uuid in self.notifications:
+            self.notifications[uuid].append(
+                (time.monotonic(), bytes(changed["Value"].value)))
+            asyncio.ensure_future(self._wake())
+        return None
+
+    async def _wake(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _options(self, offset=0):
+        opts = {"device": Variant("o", DEVICE_PATH),
+                "mtu": Variant("q", self.mtu)}
+        if offset:
+            opts["offset"] = Variant("q", offset)
+        return opts
+
+    async def read_blob(self, uuid, offset=0):
+        """One ATT Read (offset 0) or Read Blob request. bluetoothd passes
+        the offset to the application and cuts its answer to 512 bytes, then
+        to what fits in the response (mtu - 1); it does not slice by offset."""
+        self.requests += 1
+        body = await _call(self.bus, self.owner, self.chars[uuid.lower()],
+                           GATT_CHRC_IFACE, "ReadValue", "a{sv}",
+                           (self._options(offset),))
+        return bytes(body[0])[:512][:self.mtu - 1]
+
+    async def read(self, uuid):
+        """A whole value, read as a phone's GATT client does: Read, then Read
+        Blob at the next offset until a response comes back short."""
+        value = chunk = await self.read_blob(uuid)
+        # (An ATT offset is 16 bits.)
+        while len(chunk) == self.mtu - 1 and len(value) <= 0xFFFF:
+            chunk = await self.read_blob(uuid, len(value))
+            value += chunk
+        return value
+
+    async def write(self, uuid, value):
+        await _call(self.bus, self.owner, self.chars[uuid.lower()],
+                    GATT_CHRC_IFACE, "WriteValue", "aya{sv}",
+                    (bytes(value), self._options()))
+
+    async def subscribe(self, uuid):
+        uuid = uuid.lower()
+        self.notifications.setdefault(uuid, [])
+        await _call(self.bus, self.owner, self.chars[uuid], GATT_CHRC_IFACE,
+                    "StartNotify")
+
+    async def unsubscribe(self, uuid):
+        uuid = uuid.lower()
+        await _call(self.bus, self.owner, self.chars[uuid], GATT_CHRC_IFACE,
+                    "StopNotify")
+        self.notifications.pop(uuid, None)
+
+    async def wait_notification(self, uuid, predicate=lambda v: True,
+                                since=0.0, timeout=30.0):
+        """First notification on `uuid` at or after `since` that satisfies
+        `predicate`, as (monotonic arrival time, value)."""
+        uuid = uuid.lower()
+
+        def find():
+            for t, value in self.notifications.get(uuid, ()):
+                if t >= since and predicate(value):
+                    return t, value
+            return None
+
+        async def wait():
+            async with self._changed:
+                await self._changed.wait_for(find)
+            return find()
+
+        return await asyncio.wait_for(wait(), timeout=timeout)
+
+
+# --- NetworkManager -----------------------------------------------------------
+
+class _NMManager(ServiceInterface):
+
+    def __init__(self, nm):
+        super().__init__(NM)
+        self.nm = nm
+
+    @method()
+    def GetDeviceByIpIface(self, iface: "s") -> "o":  # noqa: N802
+        if iface != self.nm.iface:
+            raise Exception(f"no device for {iface}")
+        return NM_DEVICE_PATH
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> "u":  # noqa: N802
+        return 70 if self.nm.device._state == NM_DEVICE_ACTIVATED else 20
+
+    @method()
+    def AddAndActivateConnection2(  # noqa: N802
+            self, connection: "a{sa{sv}}", device: "o", specific_object: "o",
+            options: "a{sv}") -> "ooa{sv}":
+        name = self.nm.add_dbus_connection(connection)
+        return [self.nm.settings_path(name), self.nm.start_activation(name), {}]
+
+    @method()
+    def ActivateConnection(self, connection: "o", device: "o",  # noqa: N802
+                           specific_object: "o") -> "o":
+        return self.nm.start_activation(self.nm.connection_at(connection))
+
+
+class _NMSettings(ServiceInterface):
+
+    def __init__(self, nm):
+        super().__init__(NM + ".Settings")
+        self.nm = nm
+
+    @method()
+    def ListConnections(self) -> "ao":  # noqa: N802
+        return [path for path, _ in self.nm.profiles.values()]
+
+    @method()
+    def GetConnectionByUuid(self, con_uuid: "s") -> "o":  # noqa: N802
+        for path, profile in self.nm.profiles.values():
+            if profile.uuid == con_uuid:
+                return path
+        raise DBusError(NM + ".Settings.InvalidConnection",
+                        "No connection with the UUID was found.")
+
+
+class _NMSettingsConnection(ServiceInterface):
+
+    def __init__(self, nm, name, uuid):
+        super().__init__(NM + ".Settings.Connection")
+        self.nm = nm
+        self.con_id = name
+        self.uuid = uuid
+
+    @method()
+    def GetSettings(self) -> "a{sa{sv}}":  # noqa: N802
+        # Like NM: no secrets.
+        settings = self.nm.connections.get(self.con_id, {})
+        return {
+            "connection": {"id": Variant("s", self.con_id),
+                           "uuid": Variant("s", self.uuid),
+                           "type": Variant("s", "802-11-wireless")},
+            "802-11-wireless": {
+                "ssid": Variant("ay", settings.get("ssid", "").encode())},
+        }
+
+    @method()
+    def GetSecrets(self, setting: "s") -> "a{sa{sv}}":  # noqa: N802
+        if setting != "802-11-wireless-security":
+            return {}
+        psk = self.nm.connections.get(self.con_id, {}).get("wifi-sec.psk", "")
+        return {setting: {"psk": Variant("s", psk)}}
+
+    @method()
+    def Update2(self, settings: "a{sa{sv}}", flags: "u",  # noqa: N802
+                args: "a{sv}") -> "a{sv}":
+        self.nm.add_connection(self.con_id, _flatten(settings), self.uuid)
+        return {}
+
+    @method()
+    def Delete(self):  # noqa: N802
+        self.nm.delete_connection(self.con_id)
+
+
+class _NMDevice(ServiceInterface):
+
+    def __init__(self):
+        super().__init__(NM + ".Device")
+        self._state = NM_DEVICE_DISCONNECTED
+        self._ip4 = "/"
+        self._active = "/"
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> "u":  # noqa: N802
+        return self._state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ip4Config(self) -> "o":  # noqa: N802
+        return self._ip4
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveConnection(self) -> "o":  # noqa: N802
+        return self._active
+
+    @signal()
+    def StateChanged(self, new, old, reason) -> "uuu":  # noqa: N802
+        return [new, old, reason]
+
+
+class _NMWireless(ServiceInterface):
+
+    def __init__(self, nm):
+        super().__init__(NM + ".Device.Wireless")
+        self.nm = nm
+        self._ap = "/"
+        self.last_scan = -1
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveAccessPoint(self) -> "o":  # noqa: N802
+        return self._ap
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LastScan(self) -> "x":  # noqa: N802
+        return self.last_scan
+
+    @method()
+    def GetAllAccessPoints(self) -> "ao":  # noqa: N802
+        return list(self.nm.aps)
+
+    @method()
+    def RequestScan(self, options: "a{sv}"):  # noqa: N802
+        self.nm.request_scan()
+
+    @signal()
+    def AccessPointAdded(self, path) -> "o":  # noqa: N802
+        return path
+
+    @signal()
+    def AccessPointRemoved(self, path) -> "o":  # noqa: N802
+        return path
+
+
+class _NMAccessPoint(ServiceInterface):
+
+    def __init__(self, ssid, strength, bssid, frequency, secured=True):
+        super().__init__(NM + ".AccessPoint")
+        self.ssid = ssid
+        self.strength = strength
+        self.bssid = bssid
+        self.frequency = frequency
+        self.secured = secured
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ssid(self) -> "ay":  # noqa: N802
+        return self.ssid.encode()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Strength(self) -> "y":  # noqa: N802
+        return self.strength
+
+    @dbus_property(access=PropertyAccess.READ)
+    def HwAddress(self) -> "s":  # noqa: N802
+        return self.bssid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Frequency(self) -> "u":  # noqa: N802
+        return self.frequency
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "u":  # noqa: N802
+        return 0x1 if self.secured else 0  # PRIVACY
+
+    @dbus_property(access=PropertyAccess.READ)
+    def WpaFlags(self) -> "u":  # noqa: N802
+        return 0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def RsnFlags(self) -> "u":  # noqa: N802
+        # PAIR_CCMP | GROUP_CCMP | KEY_MGMT_PSK
+        return 0x188 if self.secured else 0
+
+
+class _NMIP4Config(ServiceInterface):
+
+    def __init__(self, address, prefix):
+        super().__init__(NM + ".IP4Config")
+        self.address = address
+        self.prefix = prefix
+
+    @dbus_property(access=PropertyAccess.READ)
+    def AddressData(self) -> "aa{sv}":  # noqa: N802
+        return [{"address": Variant("s", self.address),
+                 "prefix": Variant("u", self.prefix)}]
+
+
+class _NMActive(ServiceInterface):
+
+    def __init__(self, name, profile):
+        super().__init__(NM + ".Connection.Active")
+        self.con_id = name
+        self.profile = profile
+        self._state = NM_ACTIVE_ACTIVATING
+        self._ip4 = "/"
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> "u":  # noqa: N802
+        return self._state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Id(self) -> "s":  # noqa: N802
+        return self.con_id
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Connection(self) -> "o":  # noqa: N802
+        return self.profile
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ip4Config(self) -> "o":  # noqa: N802
+        return self._ip4
+
+    @signal()
+    def StateChanged(self, state, reason) -> "uu":  # noqa: N802
+        return [state, reason]
+
+    def set_state(self, state, reason=0, ip4=None):
+        self._state = state
+        changed = {"State": state}
+        if ip4 is not None:
+            self._ip4 = ip4
+            changed["Ip4Config"] = ip4
+        self.emit_properties_changed(changed)
+        self.StateChanged(state, reason)
+
+
+class _NMControl(ServiceInterface):
+    """Private interface the stub nmcli talks to."""
+
+    def __init__(self, nm):
+        super().__init__(NM_FAKE_IFACE)
+        self.nm = nm
+
+    @method()
+    def AddConnection(self, name: "s", settings: "a{ss}"):  # noqa: N802
+        self.nm.add_connection(name, settings)
+
+    @method()
+    def DeleteConnection(self, name: "s") -> "b":  # noqa: N802
+        return self.nm.delete_connection(name)
+
+    @method()
+    async def ActivateConnection(self, name: "s") -> "bs":  # noqa: N802
+        ok, reason = await self.nm.activate(name)
+        return [ok, reason]
+
+    @method()
+    def DeviceDetails(self, iface: "s") -> "a{ss}":  # noqa: N802
+        return self.nm.device_details(iface)
+
+    @method()
+    def ConnectionSetting(self, name: "s", key: "s") -> "s":  # noqa: N802
+        return self.nm.connections.get(name, {}).get(key, "")
+
+    @method()
+    def ConnectionDetails(self, name: "s",  # noqa: N802
+                          secrets: "b") -> "a{ss}":
+        return self.nm.connection_details(name, secrets)
+
+    @method()
+    def Scanning(self) -> "b":  # noqa: N802
+        return self.nm._scan is not None and not self.nm._scan.done()
+
+    @method()
+    def WifiList(self) -> "a(bsysbu)":  # noqa: N802
+        return [[ap.ssid == self.nm.active_ssid, ap.ssid, ap.strength,
+                 ap.bssid, ap.secured, ap.frequency]
+                for ap in self.nm.aps.values()]
+
+
+class FakeNetworkManager:
+    """NetworkManager for one Wi-Fi device, activated on a script.
+
+    `networks` maps SSID -> {"psk": ..., "strength": 0-100}, plus "bss": a
+    list of the strengths of further BSSs of that SSID; no "psk" is an open
+    network. Each BSS is an AccessPoint object, from a scan last_scan_age
+    seconds before start(); RequestScan finishes after scan_secs. Activating a
+    connection walks the device through prepare/config (assoc_secs), then
+    ip-config (dhcp_secs) to activated with `address`, emitting StateChanged
+    and PropertiesChanged as NM does. A wrong PSK fails in need-auth; an SSID
+    not in `networks` fails after assoc_secs. vanish() and reappear() release
+    and take back the bus name, as an NM restart does.
+    """
+
+    def __init__(self, bus, iface="wlan0", networks=None, address="10.42.0.23",
+                 assoc_secs=0.3, dhcp_secs=0.5, scan_secs=0.5,
+                 last_scan_age=0.0, connections_dir=None):
+        self.bus = bus
+        self.iface = iface
+        self.networks = networks if networks is not None else {
+            "FakeNet": {"psk": "correct horse", "strength": 72}}
+        self.address = address
+        self.assoc_secs = assoc_secs
+        self.dhcp_secs = dhcp_secs
+        self.scan_secs = scan_secs
+        self.last_scan_age = last_scan_age
+        self.connections_dir = connections_dir
+        self.connections = {}  # name -> settings
+        self.profiles = {}  # name -> (object path, _NMSettingsConnection)
+        self.profile_writes = 0  # add/Update2 of a profile, over either API
+        self.activations = []  # (name, ok, reason, seconds)
+        self.active_ssid = None
+        self.device = _NMDevice()
+        self.wireless = _NMWireless(self)
+        self.aps = {}  # path -> _NMAccessPoint
+        self.scans = 0
+        self._scan = None
+        self._serial = 0
+        self._ip4 = None
+        self._active = None
+        self._activation = None
+
+    async def start(self):
+        self.bus.export(NM_PATH, _NMManager(self))
+        self.bus.export(NM_PATH, _NMControl(self))
+        self.bus.export(NM_SETTINGS_PATH, _NMSettings(self))
+        self.bus.export(NM_DEVICE_PATH, self.device)
+        self.bus.export(NM_DEVICE_PATH, self.wireless)
+        for ssid in self.networks:
+            self._export_aps(ssid)
+        self._scanned(self.last_scan_age)
+        await self.bus.request_name(NM)
+        return self
+
+    async def vanish(self):
+        """Leave the bus (NameOwnerChanged to no owner); calls to NM fail."""
+        await self.bus.release_name(NM)
+
+    async def reappear(self):
+        await self.bus.request_name(NM)
+
+    def _export_aps(self, ssid):
+        net = self.networks[ssid]
+        paths = []
+        for strength in [net.get("strength", 60)] + list(net.get("bss", ())):
+            path = self._object_path("AccessPoint")
+            ap = _NMAccessPoint(ssid, strength,
+                                f"02:00:00:00:00:{self._serial:02X}",
+                                net.get("frequency", 2437),
+                                net.get("psk") is not None)
+            self.aps[path] = ap
+            self.bus.export(path, ap)
+            paths.append(path)
+        return paths
+
+    def _scanned(self, age=0.0):
+        self.wireless.last_scan = int(
+            (time.clock_gettime(time.CLOCK_BOOTTIME) - age) * 1000)
+        self.wireless.emit_properties_changed(
+            {"LastScan": self.wireless.last_scan})
+
+    def request_scan(self):
+        if self._scan is not None and not self._scan.done():
+            raise DBusError(NM + ".Device.NotAllowed",
+                            "Scanning not allowed while already scanning")
+        self._scan = asyncio.ensure_future(self._timed_scan())
+
+    async def _timed_scan(self):
+        await asyncio.sleep(self.scan_secs)
+        self.scans += 1
+        self._scanned()
+
+    def add_network(self, ssid, psk=None, strength=60, **net):
+        """A network comes into range, as NM's background scanning reports
+        it: AccessPointAdded for each BSS."""
+        self.networks[ssid] = dict(net, psk=psk, strength=strength)
+        for path in self._export_aps(ssid):
+            self.wireless.AccessPointAdded(path)
+        self._scanned()
+
+    def remove_network(self, ssid):
+        """The network goes out of range (AccessPointRemoved)."""
+        self.networks.pop(ssid, None)
+        for path, ap in list(self.aps.items()):
+            if ap.ssid == ssid:
+                del self.aps[path]
+                self.bus.unexport(path)
+                self.wireless.AccessPointRemoved(path)
+        self._scanned()
+
+    def _object_path(self, kind):
+        self._serial += 1
+        return f"{NM_PATH}/{kind}/{self._serial}"
+
+    def _set_device(self, state, reason=0, **props):
+        old = self.device._state
+        self.device._state = state
+        changed = {"State": state}
+        if "ip4" in props:
+            self.device._ip4 = props["ip4"]
+            changed["Ip4Config"] = props["ip4"]
+        if "active" in props:
+            self.device._active = props["active"]
+            changed["ActiveConnection"] = props["active"]
+        self.device.StateChanged(state, old, reason)
+        self.device.emit_properties_changed(changed)
+        if "ap" in props:
+            self.wireless._ap = props["ap"]
+            self.wireless.emit_properties_changed(
+                {"ActiveAccessPoint": props["ap"]})
+
+    def _teardown(self, state=NM_DEVICE_DISCONNECTED, reason=0,
+                  active_reason=NM_ACTIVE_REASON_DEVICE_DISCONNECTED):
+        if self._active is not None and \
+                self._active[1]._state != NM_ACTIVE_DEACTIVATED:
+            self._active[1].set_state(NM_ACTIVE_DEACTIVATED, active_reason)
+        for obj in (self._ip4, self._active):
+            if obj is not None:
+                self.bus.unexport(obj[0])
+        self._ip4 = self._active = None
+        self.active_ssid = None
+        self._set_device(state, reason, ip4="/", active="/", ap="/")
+
+    def add_connection(self, name, settings, uuid_=None):
+        self.connections[name] = dict(settings)
+        self.profile_writes += 1
+        if name not in self.profiles:
+            path = self._object_path("Settings")
+            profile = _NMSettingsConnection(self, name,
+                                            uuid_ or str(uuid.uuid4()))
+            self.bus.export(path, profile)
+            self.profiles[name] = (path, profile)
+        if self.connections_dir:
+            # What NetworkManager 1.46 writes: note no psk-flags line, which
+            # the server patches in.
+            os.makedirs(self.connections_dir, exist_ok=True)
+            with open(os.path.join(self.connections_dir,
+                                   f"{name}.nmconnection"), "w") as f:
+                f.write(f"[connection]\nid={name}\ntype=wifi\n"
+                        f"interface-name={self.iface}\n\n"
+                        f"[wifi]\nssid={settings.get('ssid', '')}\n\n"
+                        f"[wifi-security]\nkey-mgmt=wpa-psk\n"
+                        f"psk={settings.get('wifi-sec.psk', '')}\n")
+
+    def add_dbus_connection(self, settings):
+        flat = _flatten(settings)
+        name = flat.pop("connection.id", "wifi")
+        self.add_connection(name, flat, flat.get("connection.uuid"))
+        return name
+
+    def settings_path(self, name):
+        return self.profiles[name][0]
+
+    def connection_at(self, path):
+        for name, (p, _profile) in self.profiles.items():
+            if p == path:
+                return name
+        raise DBusError(NM + ".Settings.InvalidConnection",
+                        f"no connection at {path}")
+
+    def connection_details(self, name, secrets=False):
+        """`nmcli connection show NAME [--show-secrets]` properties (the ones
+        the servers read); empty if there is no such profile."""
+        if name not in self.connections:
+            return {}
+        settings = self.connections[name]
+        return {
+            "connection.id": name,
+            "connection.uuid": self.profiles[name][1].uuid,
+            "connection.type": "802-11-wireless",
+            "802-11-wireless.ssid": settings.get("ssid", ""),
+            "802-11-wireless-security.key-mgmt": "wpa-psk",
+            "802-11-wireless-security.psk": (
+                settings.get("wifi-sec.psk", "") if secrets else "<hidden>"),
+        }
+
+    def drop_link(self):
+        """Lose the association (AP out of range, say): the active connection
+        goes away, the profile stays."""
+        if self._activation is not None and not self._activation.done():
+            self._activation.cancel()
+        self._teardown()
+
+    def delete_connection(self, name):
+        if name not in self.connections:
+            return False
+        del self.connections[name]
+        path, _profile = self.profiles.pop(name)
+        self.bus.unexport(path)
+        if self._active is not None and self._active[1].con_id == name:
+            self._teardown()
+        if self.connections_dir:
+            try:
+                os.unlink(os.path.join(self.connections_dir,
+                                       f"{name}.nmconnection"))
+            except FileNotFoundError:
+                pass
+        return True
+
+    async def activate(self, name):
+        """Activate `name` and wait for the outcome (nmcli connection up)."""
+        if name not in self.connections:
+            return False, "unknown connection"
+        self.start_activation(name)
+        return await self._activation
+
+    def start_activation(self, name):
+        """Begin activating `name`; returns the ActiveConnection path at once,
+        as NM's ActivateConnection/AddAndActivateConnection2 do."""
+        if self._activation is not None and not self._activation.done():
+            self._activation.cancel()
+        if self._active is not None:
+            self._teardown()
+        active_path = self._object_path("ActiveConnection")
+        active = _NMActive(name, self.profiles[name][0])
+        self.bus.export(active_path, active)
+        self._active = (active_path, active)
+        self._set_device(NM_DEVICE_PREPARE, active=active_path)
+        self._activation = asyncio.ensure_future(self._timed_activation(name))
+        return active_path
+
+    async def _timed_activation(self, name):
+        t0 = time.monotonic()
+        ok, reason = await self._activate(name)
+        self.activations.append((name, ok, reason, time.monotonic() - t0))
+        return ok, reason
+
+    async def _activate(self, name):
+        settings = self.connections[name]
+        ssid = settings.get("ssid", "")
+        active = self._active[1]
+        self._set_device(NM_DEVICE_CONFIG)
+        await asyncio.sleep(self.assoc_secs)
+        net = self.networks.get(ssid)
+        if net is None:
+            self._teardown(NM_DEVICE_FAILED, 53)  # SSID not found
+            self._teardown()
+            return False, "ssid not found"
+        if settings.get("wifi-sec.psk") != net.get("psk"):
+            self._set_device(NM_DEVICE_NEED_AUTH)
+            await asyncio.sleep(self.assoc_secs)
+            self._teardown(NM_DEVICE_FAILED, 7,  # no secrets
+                           NM_ACTIVE_REASON_NO_SECRETS)
+            self._teardown()
+            return False, "secrets were required"
+        ap_path = next(p for p, ap in self.aps.items() if ap.ssid == ssid)
+        self.active_ssid = ssid
+        self._set_device(NM_DEVICE_IP_CONFIG, ap=ap_path)
+        await asyncio.sleep(self.dhcp_secs)
+        ip4_path = self._object_path("IP4Config")
+        ip4 = _NMIP4Config(self.address, 24)
+        self.bus.export(ip4_path, ip4)
+        self._ip4 = (ip4_path, ip4)
+        active.set_state(NM_ACTIVE_ACTIVATED, ip4=ip4_path)
+        self._set_device(NM_DEVICE_ACTIVATED, ip4=ip4_path)
+        return True, ""
+
+    def device_details(self, iface):
+        state = self.device._state
+        labels = {NM_DEVICE_DISCONNECTED: "disconnected",
+                  NM_DEVICE_ACTIVATED: "connected"}
+        details = {
+            "GENERAL.DEVICE": iface,
+            "GENERAL.TYPE": "wifi",
+            "GENERAL.STATE": f"{state} ({labels.get(state, 'connecting')})",
+            "GENERAL.CONNECTION": (self._active[1].con_id
+                                   if self._active is not None else "--"),
+        }
+        if state == NM_DEVICE_ACTIVATED and self._ip4 is not None:
+            details["IP4.ADDRESS[1]"] = f"{self.address}/24"
+        return details
+
+
+# --- systemd ------------------------------------------------------------------
+
+class _SystemdManager(ServiceInterface):
+
+    def __init__(self, systemd):
+        super().__init__(SYSTEMD + ".Manager")
+        self.systemd = systemd
+
+    @method()
+    def Subscribe(self):  # noqa: N802
+        pass
+
+    @method()
+    def LoadUnit(self, name: "s") -> "o":  # noqa: N802
+        return self.systemd.unit_path(name)
+
+
+class _SystemdUnit(ServiceInterface):
+
+    def __init__(self, state):
+        super().__init__(SYSTEMD + ".Unit")
+        self._state = state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveState(self) -> "s":  # noqa: N802
+        return self._state
+
+
+class FakeSystemd:
+    """Manager.Subscribe/LoadUnit plus ActiveState of the units asked for."""
+
+    def __init__(self, bus, states=None):
+        self.bus = bus
+        self.states = dict(states or {})
+        self.units = {}
+
+    async def start(self):
+        self.bus.export(SYSTEMD_PATH, _SystemdManager(self))
+        await self.bus.request_name(SYSTEMD)
+        return self
+
+    def unit_path(self, name):
+        path = (SYSTEMD_PATH + "/unit/" +
+                "".join(c if c.isalnum() else f"_{ord(c):02x}" for c in name))
+        if name not in self.units:
+            unit = _SystemdUnit(self.states.get(name, "inactive"))
+            self.units[name] = unit
+            self.bus.export(path, unit)
+        return path
+
+    def set_active_state(self, name, state):
+        self.unit_path(name)
+        unit = self.units[name]
+        unit._state = state
+        unit.emit_properties_changed({"ActiveState": state})
+
+
+class FakeNotifySocket:
+    """systemd's notification socket ($NOTIFY_SOCKET, sd_notify(3)): records
+    every datagram as (monotonic, {field: value}) in `messages`, sets `ready`
+    on READY=1 and counts WATCHDOG=1 keep-alives."""
+
+    def __init__(self, path):
+        self.path = path
+        self.messages = []
+        self.ready = asyncio.Event()
+        self.watchdogs = 0
+        self._sock = None
+
+    async def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._recv)
+        return self
+
+    def _recv(self):
+        while True:
+            try:
+                data = self._sock.recv(4096)
+            except BlockingIOError:
+                return
+            fields = dict(line.split("=", 1)
+                          for line in data.decode().splitlines() if "=" in line)
+            self.messages.append((time.monotonic(), fields))
+            if fields.get("READY") == "1":
+                self.ready.set()
+            if fields.get("WATCHDOG") == "1":
+                self.watchdogs += 1
+
+    def status(self):
+        """The last STATUS= sent."""
+        for _t, fields in reversed(self.messages):
+            if "STATUS" in fields:
+                return fields["STATUS"]
+        return None
+
+    def reset(self):
+        self.messages = []
+        self.ready.clear()
+        self.watchdogs = 0
+
+    def stop(self):
+        if self._sock is not None:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+
+# --- Stub binaries ------------------------------------------------------------
+
+def write_stubs(bindir, python=sys.executable):
+    """Write nmcli, sudo, fw_printenv and systemctl stubs into `bindir`."""
+    os.makedirs(bindir, exist_ok=True)
+    log = ('[ -n "$IMPROV_FAKE_EXEC_LOG" ] && '
+           'echo "$(basename "$0") $*" >> "$IMPROV_FAKE_EXEC_LOG"\n')
+    stubs = {
+        # nmcli runs its commands against FakeNetworkManager.
+        "nmcli": (f"#!/bin/sh\n{log}"
+                  'if [ "$1 $2" = "device show" ] && '
+                  '[ -f "$IMPROV_FAKE_NMCLI_HANG" ] && '
+                  '[ ! -s "$IMPROV_FAKE_NMCLI_HANG" ]; then\n'
+                  '  echo $$ > "$IMPROV_FAKE_NMCLI_HANG"; exec sleep 600\n'
+                  'fi\n'
+                  f"exec {shlex.quote(python)} "
+                  f"{shlex.quote(os.path.abspath(__file__))} nmcli \"$@\"\n"),
+        # The nmcli Python binding prefixes every command with sudo.
+        "sudo": "#!/bin/sh\nexec \"$@\"\n",
+        "fw_printenv": (f"#!/bin/sh\n{log}"
+                        'val="${IMPROV_FAKE_SEC_BOOT:-no}"\n'
+                        'if [ "$1" = "-n" ]; then echo "$val"; '
+                        'else echo "$1=$val"; fi\n'),
+        "systemctl": (f"#!/bin/sh\n{log}"
+                      'if [ "$1" = "is-active" ]; then echo inactive; exit 3; fi\n'
+                      "exit 0\n"),
+    }
+    for name, body in stubs.items():
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(body)
+        os.chmod(path, 0o755)
+    return bindir
+
+
+async def _nmcli(argv):
+    """Stub nmcli: the invocations the onboarding servers make, served by
+    FakeNetworkManager. Exit codes follow nmcli(1)."""
+    fields = None
+    getter = None
+    args = list(argv)
+    while args and args[0].startswith("-"):
+        opt = args.pop(0)
+        if opt in ("-f", "--fields"):
+            fields = args.pop(0)
+        elif opt in ("-g", "--get-values"):
+            getter = args.pop(0)
+        elif opt in ("-w", "--wait"):
+            args.pop(0)
+    if len(args) < 2:
+        return 2
+    obj, verb, rest = args[0], args[1], args[2:]
+    bus = await MessageBus(bus_address=os.environ["DBUS_SYSTEM_BUS_ADDRESS"]).connect()
+
+    async def ctl(member, signature="", body=()):
+        return await _call(bus, NM, NM_PATH, NM_FAKE_IFACE, member, signature,
+                           body, timeout=600)
+
+    if obj in ("c", "con", "connection"):
+        if verb == "add":
+            opts = dict(zip(rest[::2], rest[1::2]))
+            name = opts.pop("con-name", "wifi")
+            for key in ("type", "ifname", "autoconnect"):
+                opts.pop(key, None)
+            await ctl("AddConnection", "sa{ss}", (name, opts))
+            return 0
+        if verb == "delete":
+            return 0 if (await ctl("DeleteConnection", "s", rest[:1]))[0] else 10
+        if verb == "up":
+            ok, reason = await ctl("ActivateConnection", "s", rest[:1])
+            if not ok:
+                print(f"Error: Connection activation failed: {reason}",
+                      file=sys.stderr)
+                return 4
+            return 0
+        if verb in ("reload", "modify"):
+            return 0
+        if verb == "show" and rest and getter:
+            key = getter.replace("802-11-wireless.", "")
+            print((await ctl("ConnectionSetting", "ss", (rest[-1], key)))[0])
+            return 0
+        if verb == "show" and rest:
+            secrets = "--show-secrets" in rest
+            name = next(a for a in rest if not a.startswith("-"))
+            details = (await ctl("ConnectionDetails", "sb",
+                                 (name, secrets)))[0]
+            if not details:
+                print(f"Error: {name} - no such connection profile.",
+                      file=sys.stderr)
+                return 10
+            for k, v in details.items():
+                print(f"{k + ':':<40}{v}")
+            return 0
+        return 2
+    if obj in ("d", "dev", "device"):
+        if verb == "show" and rest:
+            for k, v in (await ctl("DeviceDetails", "s", rest[:1]))[0].items():
+                print(f"{k + ':':<40}{v}")
+            return 0
+        if verb == "wifi":
+            if "--rescan" in rest and \
+                    rest[rest.index("--rescan") + 1:][:1] == ["yes"]:
+                try:
+                    await _call(bus, NM, NM_DEVICE_PATH, NM + ".Device.Wireless",
+                                "RequestScan", "a{sv}", ({},))
+                except RuntimeError:
+                    pass  # already scanning; wait for that one
+                while (await ctl("Scanning"))[0]:
+                    await asyncio.sleep(0.05)
+            for active, ssid, strength, bssid, secured, freq in \
+                    (await ctl("WifiList"))[0]:
+                row = {"ACTIVE": "yes" if active else "no",
+                       "IN-USE": "*" if active else " ", "SSID": ssid,
+                       "BSSID": bssid, "MODE": "Infra",
+                       "CHAN": str((freq - 2407) // 5 if freq < 5000
+                                   else (freq - 5000) // 5),
+                       "FREQ": f"{freq} MHz", "RATE": "130 Mbit/s",
+                       "SIGNAL": str(strength),
+                       "SECURITY": "WPA2" if secured else ""}
+                cols = (fields or "ACTIVE,SSID").split(",")
+                print(":".join(row.get(c, "").replace(":", "\\:")
+                               for c in cols))
+            return 0
+    return 2
+
+
+def nmcli_main(argv):
+    try:
+        return asyncio.run(_nmcli(argv))
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 8  # NetworkManager is not running
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["nmcli"]:
+        sys.exit(nmcli_main(sys.argv[2:]))
+    print(json.dumps({"usage": "imported by improv-e2e.py"}))
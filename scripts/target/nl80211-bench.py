@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+nl80211 vs nmcli link-query benchmark for the Improv onboarding server.
+
+Compares the in-process nl80211 client (recipes-devtools/python/python3-improv/
+nl80211.py, installed as /usr/share/improv/nl80211.py) with the subprocess path
+the server used before: `nmcli -t -f ACTIVE,SSID dev wifi` for the SSID plus a
+/proc/net/wireless parse for RSSI.
+
+On the target:
+    ./nl80211-bench.py                   # wlan0, 50 iterations each
+    ./nl80211-bench.py -i wlan0 -n 200
+
+Off-target (or in CI) with a fake netlink socket that replays canned
+nl80211 replies, and a stub `nmcli` so the fork/exec cost is still real:
+    ./nl80211-bench.py --fake
+"""
+
+import argparse
+import os
+import resource
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.join(HERE, "..", "..", "recipes-devtools", "python", "python3-improv"),
+    "/usr/share/improv",
+]
+import nl80211  # noqa: E402
+
+FAKE_FAMILY_ID = 0x1C
+
+
+class FakeNetlinkSocket:
+    """Replays what the kernel answers for the requests nl80211.Nl80211 sends:
+    CTRL_CMD_GETFAMILY, NL80211_CMD_GET_INTERFACE and a GET_STATION dump."""
+
+    def __init__(self, ssid=b"FakeNet", bssid=b"\x02\x11\x22\x33\x44\x55",
+                 signal=-57, bitrate_100kbps=1445):
+        self.ssid = ssid
+        self.bssid = bssid
+        self.signal = signal
+        self.bitrate = bitrate_100kbps
+        self._out = []
+
+    def _reply(self, msg_type, flags, seq, cmd, attrs=b""):
+        return nl80211.pack_genl(msg_type, flags, seq, cmd, attrs)
+
+    @staticmethod
+    def _ack(seq, err=0):
+        payload = struct.pack("=i", err) + b"\0" * nl80211.NLMSGHDR.size
+        return nl80211.NLMSGHDR.pack(nl80211.NLMSGHDR.size + len(payload),
+                                     nl80211.NLMSG_ERROR, 0, seq, 0) + payload
+
+    @staticmethod
+    def _done(seq):
+        payload = struct.pack("=i", 0)
+        return nl80211.NLMSGHDR.pack(nl80211.NLMSGHDR.size + len(payload),
+                                     nl80211.NLMSG_DONE, 0x2, seq, 0) + payload
+
+    def send(self, data):
+        for msg_type, _flags, seq, payload in nl80211.iter_messages(data):
+            cmd = payload[0]
+            if msg_type == nl80211.GENL_ID_CTRL:
+                self._out.append(self._reply(
+                    nl80211.GENL_ID_CTRL, 0, seq, 1,
+                    nl80211.pack_attr(nl80211.CTRL_ATTR_FAMILY_ID,
+                                      struct.pack("=H", FAKE_FAMILY_ID))))
+                self._out.append(self._ack(seq))
+            elif cmd == nl80211.NL80211_CMD_GET_INTERFACE:
+                self._out.append(self._reply(
+                    FAKE_FAMILY_ID, 0, seq, 7,
+                    nl80211.pack_attr(nl80211.NL80211_ATTR_SSID, self.ssid)))
+                self._out.append(self._ack(seq))
+            elif cmd == nl80211.NL80211_CMD_GET_STATION:
+                rate = nl80211.pack_attr(nl80211.NL80211_RATE_INFO_BITRATE32,
+                                         struct.pack("=I", self.bitrate))
+                sinfo = (nl80211.pack_attr(nl80211.NL80211_STA_INFO_SIGNAL,
+                                           struct.pack("=b", self.signal)) +
+                         nl80211.pack_attr(nl80211.NL80211_STA_INFO_TX_BITRATE, rate))
+                self._out.append(self._reply(
+                    FAKE_FAMILY_ID, 0x2, seq, 19,
+                    nl80211.pack_attr(nl80211.NL80211_ATTR_MAC, self.bssid) +
+                    nl80211.pack_attr(nl80211.NL80211_ATTR_STA_INFO, sinfo)))
+                self._out.append(self._done(seq))
+        return len(data)
+
+    def recv(self, _bufsize):
+        # The kernel may split replies across datagrams; hand them back one
+        # message at a time to exercise the client's reassembly loop.
+        if not self._out:
+            raise socket.timeout("fake netlink socket: no reply queued")
+        return self._out.pop(0)
+
+    def close(self):
+        self._out.clear()
+
+
+def subprocess_link(iface, nmcli):
+    """The pre-nl80211 path: nmcli fork for SSID, /proc parse for RSSI."""
+    ssid = None
+    out = subprocess.run([nmcli, "-t", "-f", "ACTIVE,SSID", "dev", "wifi"],
+                         capture_output=True, timeout=4, text=True)
+    for line in out.stdout.splitlines():
+        if line.startswith("yes:"):
+            ssid = line.split(":", 1)[1].strip()
+    rssi = None
+    try:
+        with open("/proc/net/wireless") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith(iface + ":"):
+                    rssi = int(float(line.split()[3].rstrip(".")))
+    except (OSError, IndexError, ValueError):
+        pass
+    return {"ssid": ssid, "signal": rssi}
+
+
+def measure(fn, n):
+    wall = []
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = None
+    for _ in range(n):
+        t0 = time.perf_counter()
+        result = fn()
+        wall.append((time.perf_counter() - t0) * 1000.0)
+    self1 = resource.getrusage(resource.RUSAGE_SELF)
+    child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = ((self1.ru_utime + self1.ru_stime - self0.ru_utime - self0.ru_stime) +
+           (child1.ru_utime + child1.ru_stime - child0.ru_utime - child0.ru_stime))
+    return {
+        "result": result,
+        "mean_ms": statistics.mean(wall),
+        "p50_ms": statistics.median(wall),
+        "p95_ms": sorted(wall)[int(0.95 * (len(wall) - 1))],
+        "cpu_ms": cpu * 1000.0 / n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-i", "--interface", default="wlan0")
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    parser.add_argument("--nmcli", default="nmcli", help="nmcli binary to fork")
+    parser.add_argument("--fake", action="store_true",
+                        help="fake netlink socket + stub nmcli (no Wi-Fi needed)")
+    args = parser.parse_args()
+
+    stub_dir = None
+    if args.fake:
+        stub_dir = tempfile.TemporaryDirectory()
+        args.nmcli = os.path.join(stub_dir.name, "nmcli")
+        with open(args.nmcli, "w") as f:
+            f.write("#!/bin/sh\necho 'no:Neighbour'\necho 'yes:FakeNet'\n")
+        os.chmod(args.nmcli, 0o755)
+        # Any interface index will do for the fake; use loopback's name.
+        args.interface = "lo"
+        client = nl80211.Nl80211(sock_factory=FakeNetlinkSocket)
+    else:
+        client = nl80211.Nl80211()
+
+    rows = [
+        ("nl80211 (in-process)", measure(lambda: client.link_info(args.interface),
+                                         args.iterations)),
+        ("nmcli + /proc/net/wireless", measure(
+            lambda: subprocess_link(args.interface, args.nmcli), args.iterations)),
+    ]
+    print(f"{'path':<28} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'cpu ms':>9}")
+    for name, r in rows:
+        print(f"{name:<28} {r['mean_ms']:>9.3f} {r['p50_ms']:>9.3f} "
+              f"{r['p95_ms']:>9.3f} {r['cpu_ms']:>9.3f}")
+    for name, r in rows:
+        print(f"{name}: {r['result']}")
+    speedup = rows[1][1]["mean_ms"] / max(rows[0][1]["mean_ms"], 1e-6)
+    print(f"nl80211 is {speedup:.0f}x faster per query")
+    if stub_dir is not None:
+        stub_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
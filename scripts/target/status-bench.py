@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Device-Status pipeline benchmark for the Improv onboarding server.
+
+Runs the e-ink server's status refresh (compute_net_status ->
+StatusRegistry.collect -> shrink_to_att -> _publish_net_status) in-process
+against fixture providers: canned nmcli / fw_printenv / systemctl stubs on
+PATH, a fixture /proc/net/wireless, os-release, sota.toml and timesyncd stamp,
+a fake nl80211 socket and a stand-in for the NetworkManager D-Bus monitor. No
+Wi-Fi, BlueZ or root needed.
+
+Per scenario and cache mode it reports, per refresh cycle: wall time of each
+stage, CPU time (including forked children), peak Python allocation,
+subprocess count and the encoded payload sizes (JSON as built, JSON as
+published, CBOR, delta).
+
+    ./scripts/target/status-bench.py                 # report
+    ./scripts/target/status-bench.py --check         # compare to the baseline
+    ./scripts/target/status-bench.py --update-baseline
+
+--check fails (exit 1) if any cycle forks more than the stored baseline, if
+any encoded payload is over the 512-byte ATT value ceiling, or if a scenario
+with a hung collector publishes later than its collection deadline or never
+publishes the late block. Other timing is host dependent, so a slowdown
+against the baseline is only reported.
+
+  warm  steady state: the slow-moving blocks are served from StatusCache
+  cold  every block recomputed, as when the cache TTLs expire because the
+        inotify / systemd watchers are not running
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPROV_DIR = os.path.join(HERE, "..", "..", "recipes-devtools", "python",
+                          "python3-improv")
+DEFAULT_SERVER = os.path.join(IMPROV_DIR, "imx93-jaguar-eink",
+                              "onboarding-server.py")
+DEFAULT_BASELINE = os.path.join(HERE, "status-bench-baseline.json")
+ATT_VALUE_MAX = 512
+# The fixtures use loopback so get_ipv4() has a real address to return.
+IFACE = "lo"
+
+OS_RELEASE = """\
+ID=lmp-dynamicdevices
+NAME="Linux-microPlatform"
+VERSION="4.0.20-2139-94"
+VERSION_ID=4.0.20-2139-94
+PRETTY_NAME="Linux-microPlatform 4.0.20-2139-94"
+IMAGE_VERSION=2139
+LMP_MACHINE=imx93-jaguar-eink
+LMP_FACTORY=dynamic-devices
+LMP_FACTORY_TAG=main
+"""
+
+# Longest values the schema allows or the factory could plausibly ship: a
+# 32-byte SSID, long factory/tag names and version strings.
+OS_RELEASE_LONG = """\
+ID=lmp-dynamicdevices
+VERSION_ID=4.0.20-2139-94-gabcdef0123-dirty
+IMAGE_VERSION=2147483647
+LMP_MACHINE=imx93-jaguar-eink-rev-c-prototype
+LMP_FACTORY=dynamic-devices-active-esl-prod
+LMP_FACTORY_TAG=release-candidate-2026-10-eu
+"""
+
+SCENARIOS = {
+    # NM D-Bus monitor live, nl80211 present: the production steady state.
+    "dbus-connected": {
+        "monitor": (100, "127.0.0.1", "FakeNet"), "nl80211": True,
+        "os_release": OS_RELEASE,
+    },
+    # Polling fallback (no dbus-fast, no nl80211): nmcli + /proc/net/wireless.
+    "nmcli-connected": {
+        "monitor": None, "nl80211": False, "nm_state": 100, "ssid": "FakeNet",
+        "os_release": OS_RELEASE,
+    },
+    "nmcli-disconnected": {
+        "monitor": None, "nl80211": False, "nm_state": 30, "ssid": None,
+        "os_release": OS_RELEASE,
+    },
+    # A collector that hangs (fw_printenv on a cold boot): the first publish
+    # must still land within the collection deadline, with `sec` following.
+    "slow-collector": {
+        "monitor": (100, "127.0.0.1", "FakeNet"), "nl80211": True,
+        "os_release": OS_RELEASE, "sec_boot_delay": 1.0, "deadline": 0.2,
+        "modes": ("warm",), "iterations": 20,
+    },
+    # Largest document the board can produce; must still fit one ATT value
+    # after shrink_to_att.
+    "worst-case-payload": {
+        "monitor": (100, "127.0.0.1", "X" * 32), "nl80211": True,
+        "os_release": OS_RELEASE_LONG, "sec_boot": "yes", "shrinks": True,
+    },
+}
+
+
+class FixtureServer:
+    """Just enough of BlessServer for _publish_net_status / _update_value."""
+
+    def __init__(self):
+        self.chars = {}
+        self.notifications = 0
+
+    def get_characteristic(self, char_uuid):
+        return self.chars.setdefault(char_uuid, types.SimpleNamespace(value=None))
+
+    def update_value(self, _service_uuid, _char_uuid):
+        self.notifications += 1
+        return True
+
+
+class ForkCounter:
+    """Counts process creation through the audit hooks CPython raises for
+    subprocess, os.system, fork and posix_spawn."""
+
+    EVENTS = {"subprocess.Popen", "os.system", "os.fork", "os.forkpty",
+              "os.posix_spawn"}
+
+    def __init__(self):
+        self.count = 0
+        self.argv = []
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if event in self.EVENTS:
+            self.count += 1
+            if event == "subprocess.Popen":
+                self.argv.append(" ".join(map(str, args[1])))
+
+
+def write_stubs(bindir, fixture_dir):
+    """nmcli (via the binding's sudo prefix), fw_printenv and systemctl,
+    answering from files in `fixture_dir` so scenarios can change them."""
+    os.makedirs(bindir, exist_ok=True)
+    d = fixture_dir
+    stubs = {
+        "sudo": '#!/bin/sh\nexec "$@"\n',
+        "nmcli": ("#!/bin/sh\n"
+                  'case "$*" in\n'
+                  f'  *"device show"*) cat "{d}/device-show" ;;\n'
+                  f'  *"dev wifi"*) cat "{d}/dev-wifi" ;;\n'
+                  f'  *"connection show"*) cat "{d}/con-ssid" ;;\n'
+                  "  *) exit 2 ;;\n"
+                  "esac\n"),
+        "fw_printenv": (f'#!/bin/sh\nsleep $(cat "{d}/sec_boot_delay")\n'
+                        f'val=$(cat "{d}/sec_boot")\n'
+                        'if [ "$1" = "-n" ]; then echo "$val"; '
+                        'else echo "$1=$val"; fi\n'),
+        "systemctl": "#!/bin/sh\necho inactive\nexit 3\n",
+    }
+    for name, body in stubs.items():
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(body)
+        os.chmod(path, 0o755)
+
+
+def load_server(path):
+    sys.path[:0] = [IMPROV_DIR, HERE]
+    spec = importlib.util.spec_from_file_location("improv_onboarding_server", path)
+    srv = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(srv)
+    return srv
+
+
+def load_fake_netlink():
+    """FakeNetlinkSocket from nl80211-bench.py (hyphenated, so by path)."""
+    spec = importlib.util.spec_from_file_location(
+        "nl80211_bench", os.path.join(HERE, "nl80211-bench.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def setup_scenario(srv, fx, root, fake_nl):
+    """Point the server's providers at this scenario's fixtures and reset the
+    publish state, as after a fresh start."""
+    def put(name, text):
+        with open(os.path.join(root, name), "w") as f:
+            f.write(text)
+
+    state = fx.get("nm_state", 100)
+    put("device-show", f"GENERAL.STATE: {state} (fixture)\n"
+                       f"GENERAL.CONNECTION: {'improv-eink' if state >= 100 else '--'}\n")
+    ssid = fx.get("ssid") or ""
+    put("dev-wifi", "no:Neighbour\n" + (f"yes:{ssid}\n" if ssid else ""))
+    put("con-ssid", ssid + "\n")
+    put("sec_boot", fx.get("sec_boot", "no") + "\n")
+    put("sec_boot_delay", f"{fx.get('sec_boot_delay', 0)}\n")
+    put("os-release", fx["os_release"])
+    put("wireless", "Inter-| sta-|   Quality        |   Discarded packets\n"
+                    " face | tus | link level noise |  nwid  crypt   frag\n"
+                    f"{IFACE}: 0000   53.  -57.  -256        0      0      0\n")
+    put("sota.toml", "[tls]\nserver = fixture\n")
+    put("synchronized", "")
+
+    status = srv.improv_status
+    srv.INTERFACE = IFACE
+    status.OS_RELEASE = os.path.join(root, "os-release")
+    status.SOTA_CONFIG = os.path.join(root, "sota.toml")
+    status.TIMESYNC_STAMP = os.path.join(root, "synchronized")
+    status.PROC_NET_WIRELESS = os.path.join(root, "wireless")
+    if fx["monitor"] is not None:
+        srv._nm_monitor = types.SimpleNamespace(live=True, snapshot=fx["monitor"])
+    else:
+        srv._nm_monitor = None
+    if fx["nl80211"]:
+        ssid = fx["monitor"][2] if fx["monitor"] else "FakeNet"
+        sock = lambda: fake_nl.FakeNetlinkSocket(ssid=ssid.encode())  # noqa: E731
+        status.nl80211 = fake_nl.nl80211
+        status._nl80211_client = fake_nl.nl80211.Nl80211(sock_factory=sock)
+    else:
+        status.nl80211 = None
+        status._nl80211_client = None
+    srv._status.cache = status.StatusCache()
+    srv._status.deadline = fx.get("deadline", status.STATUS_DEADLINE_SECS)
+    srv._status_deltas.reset()
+    srv.server = FixtureServer()
+
+
+def cold(srv):
+    srv._status.cache.invalidate("timesync", "sec", "os-release", "ota")
+
+
+def cycle(srv, stages):
+    """One refresh as net_status_loop runs it, timed per stage."""
+    t0 = time.perf_counter()
+    net = srv.compute_net_status()
+    t1 = time.perf_counter()
+    doc = srv._status.collect(net=net)
+    t2 = time.perf_counter()
+    srv.improv_status.shrink_to_att(doc)
+    t3 = time.perf_counter()
+    srv._publish_net_status(doc)
+    t4 = time.perf_counter()
+    # _publish_net_status shrinks again itself; the standalone shrink_to_att
+    # call is timed on its own and left out of the cycle total.
+    for name, dt in (("net", t1 - t0), ("build", t2 - t1), ("shrink", t3 - t2),
+                     ("publish", t4 - t3), ("total", t4 - t0 - (t3 - t2))):
+        stages[name].append(dt * 1000.0)
+    return doc
+
+
+def bench(srv, forks, fx, mode, n):
+    prep = cold if mode == "cold" else (lambda _srv: None)
+    # Prime once: the first cycle after start pays for the sec block's
+    # fw_printenv and the first notification; it is reported separately.
+    forks.count = 0
+    t0 = time.perf_counter()
+    doc = cycle(srv, {k: [] for k in ("net", "build", "shrink", "publish", "total")})
+    first_ms = (time.perf_counter() - t0) * 1000.0
+    first_forks = forks.count
+    full_json = json.dumps(doc, separators=(",", ":")).encode()
+    delta_bytes = len(srv._net_status_delta_bytes)
+
+    stages = {k: [] for k in ("net", "build", "shrink", "publish", "total")}
+    forks.count = 0
+    forks.argv.clear()
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for _ in range(n):
+        prep(srv)
+        doc = cycle(srv, stages)
+    self1 = resource.getrusage(resource.RUSAGE_SELF)
+    child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = ((self1.ru_utime + self1.ru_stime - self0.ru_utime - self0.ru_stime) +
+           (child1.ru_utime + child1.ru_stime - child0.ru_utime - child0.ru_stime))
+    cycle_forks = forks.count / n
+    forked = sorted(set(forks.argv))
+
+    # Allocation pass, separate so tracemalloc's overhead stays out of timing.
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(n, 20)):
+        prep(srv)
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        cycle(srv, {k: [] for k in stages})
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    # Let a late block land, then take the document once more.
+    for _ in range(50):
+        if srv._status.collect().keys() >= set(srv._status._providers):
+            break
+        time.sleep(0.1)
+    published = bytes(srv._net_status_json_bytes)
+    try:
+        json.loads(published)
+        truncated = False
+    except ValueError:
+        truncated = True
+    return {
+        "wall_ms": {k: round(statistics.median(v), 3) for k, v in stages.items()},
+        "wall_p95_ms": round(sorted(stages["total"])[int(0.95 * (n - 1))], 3),
+        "cpu_ms": round(cpu * 1000.0 / n, 3),
+        "peak_alloc_kib": round(statistics.median(peaks) / 1024.0, 1),
+        "first_ms": round(first_ms, 1),
+        "missing_blocks": sorted(set(srv._status._providers) -
+                                 set(srv._status.collect())),
+        "forks_first": first_forks,
+        "forks": cycle_forks,
+        "forked": forked,
+        "json_bytes": len(full_json),
+        "published_bytes": len(published),
+        "truncated": truncated,
+        "cbor_bytes": len(srv._net_status_cbor_bytes),
+        "delta_bytes": delta_bytes,
+    }
+
+
+def check(results, baseline, slack):
+    """Failures (forks, payload ceiling) and warnings (slowdown, growth)."""
+    failures, warnings = [], []
+    for key, r in results.items():
+        fx = SCENARIOS[key.split("/")[0]]
+        sizes = {"cbor": r["cbor_bytes"], "delta": r["delta_bytes"],
+                 "published json": r["published_bytes"]}
+        if not fx.get("shrinks"):
+            sizes["json"] = r["json_bytes"]
+        for name, size in sizes.items():
+            if size > ATT_VALUE_MAX:
+                failures.append(f"{key}: {name} payload {size} B > "
+                                f"{ATT_VALUE_MAX} B ATT ceiling")
+        deadline = fx.get("deadline")
+        if deadline is not None and r["first_ms"] > deadline * 1000.0 + 150:
+            failures.append(f"{key}: first publish after {r['first_ms']:.0f} ms, "
+                            f"collection deadline {deadline * 1000:.0f} ms")
+        if r["missing_blocks"]:
+            failures.append(f"{key}: {', '.join(r['missing_blocks'])} never "
+                            "published")
+        if r["truncated"]:
+            failures.append(f"{key}: published JSON truncated at "
+                            f"{ATT_VALUE_MAX} B ({r['json_bytes']} B built)")
+        base = baseline.get(key)
+        if base is None:
+            warnings.append(f"{key}: no baseline")
+            continue
+        for field in ("forks", "forks_first"):
+            if r[field] > base[field]:
+                failures.append(f"{key}: {field} {r[field]:g} per cycle, "
+                                f"baseline {base[field]:g} ({', '.join(r['forked']) or '-'})")
+        for field in ("json_bytes", "cbor_bytes", "delta_bytes"):
+            if r[field] > base[field]:
+                warnings.append(f"{key}: {field} {base[field]} -> {r[field]}")
+        if r["wall_ms"]["total"] > slack * max(base["wall_ms"]["total"], 0.05):
+            warnings.append(f"{key}: total {r['wall_ms']['total']:.3f} ms, "
+                            f"baseline {base['wall_ms']['total']:.3f} ms")
+    return failures, warnings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--server", default=DEFAULT_SERVER)
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--check", action="store_true",
+                        help="fail on added forks or payloads over 512 B")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--slack", type=float, default=2.0,
+                        help="wall-time ratio over baseline reported as slower")
+    parser.add_argument("--json", help="write results here")
+    args = parser.parse_args()
+
+    os.environ.setdefault("IMPROV_LOG_LEVEL", "WARNING")
+    tmp = tempfile.TemporaryDirectory()
+    root = os.path.join(tmp.name, "fixtures")
+    bindir = os.path.join(tmp.name, "bin")
+    os.makedirs(root)
+    write_stubs(bindir, root)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+
+    srv = load_server(args.server)
+    fake_nl = load_fake_netlink()
+    forks = ForkCounter()
+
+    results = {}
+    for name, fx in SCENARIOS.items():
+        for mode in fx.get("modes", ("warm", "cold")):
+            setup_scenario(srv, fx, root, fake_nl)
+            results[f"{name}/{mode}"] = bench(
+                srv, forks, fx, mode, fx.get("iterations", args.iterations))
+
+    print(f"{'scenario':<26} {'total ms':>9} {'net':>7} {'build':>7} "
+          f"{'shrink':>7} {'publish':>7} {'first':>7} {'cpu ms':>7} {'KiB':>6} {'forks':>6} "
+          f"{'json':>5} {'cbor':>5} {'delta':>5}")
+    for key, r in results.items():
+        w = r["wall_ms"]
+        print(f"{key:<26} {w['total']:>9.3f} {w['net']:>7.3f} {w['build']:>7.3f} "
+              f"{w['shrink']:>7.3f} {w['publish']:>7.3f} {r['first_ms']:>7.1f} "
+              f"{r['cpu_ms']:>7.3f} "
+              f"{r['peak_alloc_kib']:>6.1f} {r['forks']:>6g} "
+              f"{r['json_bytes']:>5} {r['cbor_bytes']:>5} {r['delta_bytes']:>5}")
+    for key, r in results.items():
+        if r["forked"]:
+            print(f"{key}: forks {', '.join(r['forked'])}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({k: {f: v for f, v in r.items() if f != "forked"}
+                       for k, r in results.items()}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+
+    rc = 0
+    if args.check:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            baseline = {}
+        failures, warnings = check(results, baseline, args.slack)
+        for w in warnings:
+            print(f"WARN {w}")
+        for fail in failures:
+            print(f"FAIL {fail}")
+        rc = 1 if failures else 0
+        print("status-bench: " + ("FAILED" if rc else "ok"))
+    tmp.cleanup()
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())